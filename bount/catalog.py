@@ -0,0 +1,144 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from bount.utils import write_atomic
+
+__author__ = 'mturilin'
+
+
+class CatalogException(StandardError):
+    pass
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as dump_file:
+        for data in iter(lambda: dump_file.read(chunk_size), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class DumpCatalog(object):
+    """
+    JSON index of the dumps in a local backup dir, so the latest dump is found without listing and
+    sorting the dir. Every dump has a kind ('db', 'media') and an entry with the creation time, size, codec,
+    SHA-256, source host and the code revisions deployed when the dump was taken (the schema state).
+
+    The catalog keeps a pointer to the latest dump of every kind and is rewritten atomically on every
+    change, the changes lock the catalog so the concurrent deploy tasks don't lose each other's entries.
+    Dump names are paths relative to the catalog dir.
+    """
+
+    def __init__(self, dir, file_name='catalog.json'):
+        self.dir = dir
+        self.catalog_path = os.path.join(dir, file_name)
+
+    def load(self):
+        if not os.path.exists(self.catalog_path):
+            return dict(dumps={}, latest={})
+        with open(self.catalog_path) as catalog_file:
+            return json.load(catalog_file)
+
+    def save(self, catalog):
+        self.dir_ensure()
+        write_atomic(self.catalog_path, json.dumps(catalog, indent=1, sort_keys=True))
+
+    def dir_ensure(self):
+        try:
+            os.makedirs(self.dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds an exclusive lock for a load and save. The lock is taken on a separate file, save replaces
+        the catalog file itself.
+        """
+        self.dir_ensure()
+        with open(self.catalog_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def dump_name(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), os.path.abspath(self.dir)).replace(os.sep, '/')
+
+    def dump_path(self, name):
+        return os.path.join(self.dir, *name.split('/'))
+
+    def add(self, kind, file_path, codec=None, host=None, revisions=None):
+        """
+        Registers the dump written to file_path as the latest dump of the kind. Returns its name.
+        """
+        name = self.dump_name(file_path)
+        entry = dict(kind=kind, created=time.time(), size=os.path.getsize(file_path), codec=codec,
+                     sha256=file_sha256(file_path), host=host, revisions=revisions or {})
+
+        with self.locked():
+            catalog = self.load()
+            catalog['dumps'][name] = entry
+            catalog['latest'][kind] = name
+            self.save(catalog)
+        return name
+
+    def get(self, name):
+        return self.load()['dumps'].get(name)
+
+    def latest(self, kind):
+        return self.load()['latest'].get(kind)
+
+    def dumps(self, kind):
+        """
+        Returns [(name, entry)] of the kind, oldest first.
+        """
+        return sorted(((name, entry) for name, entry in self.load()['dumps'].iteritems() if entry['kind'] == kind),
+                      key=lambda (name, entry): entry['created'])
+
+    def verify(self, name):
+        """
+        Raises CatalogException if the dump is missing or its checksum doesn't match the catalog.
+        """
+        entry = self.get(name)
+        if not entry:
+            raise CatalogException("Dump is not in the catalog: %s" % name)
+
+        dump_path = self.dump_path(name)
+        if not os.path.exists(dump_path):
+            raise CatalogException("Dump file is missing: %s" % dump_path)
+        if os.path.getsize(dump_path) != entry['size'] or file_sha256(dump_path) != entry['sha256']:
+            raise CatalogException("Dump is corrupted, checksum mismatch: %s" % dump_path)
+
+    def prune(self, kind, keep=None, max_age_days=None):
+        """
+        Deletes the dumps of the kind beyond the keep newest ones or older than max_age_days. The latest
+        dump is always kept. Returns the names of the deleted dumps.
+        """
+        with self.locked():
+            dumps = self.dumps(kind)
+            if not dumps:
+                return []
+
+            expired = set()
+            if keep is not None:
+                expired.update(name for name, entry in dumps[:max(len(dumps) - keep, 0)])
+            if max_age_days is not None:
+                min_created = time.time() - max_age_days * 24 * 3600
+                expired.update(name for name, entry in dumps if entry['created'] < min_created)
+            expired.discard(dumps[-1][0])
+
+            catalog = self.load()
+            for name in sorted(expired):
+                dump_path = self.dump_path(name)
+                if os.path.exists(dump_path):
+                    os.remove(dump_path)
+                del catalog['dumps'][name]
+            self.save(catalog)
+        return sorted(expired)
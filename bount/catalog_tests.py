@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from bount.catalog import DumpCatalog, CatalogException
+
+__author__ = 'mturilin'
+
+
+def add_dumps(job):
+    """
+    Pool worker for test_concurrent_add, adds its dumps through its own catalog object.
+    """
+    dir, worker = job
+    catalog = DumpCatalog(dir)
+    for i in range(10):
+        dump_path = os.path.join(dir, 'proj_db_%d_%d.sql' % (worker, i))
+        with open(dump_path, 'w') as dump_file:
+            dump_file.write('dump')
+        catalog.add('db', dump_path)
+
+
+class DumpCatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.catalog = DumpCatalog(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def dump(self, name, content, created=None):
+        dump_path = os.path.join(self.temp_dir, 'db_dump', name)
+        if not os.path.exists(os.path.dirname(dump_path)):
+            os.makedirs(os.path.dirname(dump_path))
+        with open(dump_path, 'w') as dump_file:
+            dump_file.write(content)
+
+        name = self.catalog.add('db', dump_path, codec='gzip', host='web1', revisions={'': 'abc'})
+        if created is not None:
+            catalog = self.catalog.load()
+            catalog['dumps'][name]['created'] = created
+            self.catalog.save(catalog)
+        return name
+
+    def test_latest(self):
+        self.assertEquals(self.catalog.latest('db'), None)
+
+        self.dump('proj_db_1.sql.gz', 'first', created=1)
+        name = self.dump('proj_db_2.sql.gz', 'second', created=2)
+
+        self.assertEquals(name, 'db_dump/proj_db_2.sql.gz')
+        self.assertEquals(self.catalog.latest('db'), name)
+        self.assertEquals(self.catalog.latest('media'), None)
+        self.assertEquals(self.catalog.get(name)['host'], 'web1')
+
+    def test_verify(self):
+        name = self.dump('proj_db_1.sql.gz', 'dump')
+        self.catalog.verify(name)
+
+        with open(self.catalog.dump_path(name), 'w') as dump_file:
+            dump_file.write('dumb')
+        self.assertRaises(CatalogException, self.catalog.verify, name)
+        self.assertRaises(CatalogException, self.catalog.verify, 'db_dump/missing.sql.gz')
+
+    def test_prune(self):
+        names = [self.dump('proj_db_%d.sql.gz' % i, 'dump %d' % i, created=i) for i in range(1, 5)]
+
+        self.assertEquals(self.catalog.prune('db', keep=2), names[:2])
+        self.assertFalse(os.path.exists(self.catalog.dump_path(names[0])))
+        self.assertEquals([name for name, entry in self.catalog.dumps('db')], names[2:])
+
+        # the latest dump survives any policy
+        self.assertEquals(self.catalog.prune('db', max_age_days=1), names[2:3])
+        self.assertEquals(self.catalog.latest('db'), names[3])
+
+    def test_concurrent_add(self):
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(add_dumps, [(self.temp_dir, worker) for worker in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEquals(len(self.catalog.dumps('db')), 40)
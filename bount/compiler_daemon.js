@@ -0,0 +1,184 @@
+// Bount compiler daemon - compiles all the LESS and CoffeeScript files of a deploy in one Node process.
+//
+// Requests come on stdin and responses go to stdout as JSON messages, each prefixed with its length
+// as a 4-byte big-endian integer:
+//   request:  {"id": 1, "compiler": "less", "input": "/abs/site.less", "output": "/abs/site.css", "options": {}}
+//   response: {"id": 1, "error": null}
+// The process exits when stdin is closed and all the requests are answered. The files imported by
+// the LESS files are read once and shared between the compiles. Only the file contents are cached, less
+// parses an import again for every file that imports it.
+//
+// Needs a native Promise (Node 0.12 or newer), CompilerDaemon checks the version before starting it.
+
+'use strict';
+
+var fs = require('fs');
+var path = require('path');
+
+if (typeof Promise !== 'function') {
+    process.stderr.write('The compiler daemon needs Node 0.12 or newer, found ' + process.version + '\n');
+    process.exit(2);
+}
+
+var compilers = {};
+
+// Buffer.from and Buffer.alloc came with Node 4.5 and Object.assign with Node 4, fall back to the old
+// API (Node 4.0-4.4 has the Buffer.from inherited from Uint8Array, which doesn't take strings)
+function bufferFrom(string) {
+    if (Buffer.from && Buffer.from !== Uint8Array.from) {
+        return Buffer.from(string, 'utf8');
+    }
+    return new Buffer(string, 'utf8');
+}
+
+function bufferAlloc(size) {
+    if (Buffer.alloc) {
+        return Buffer.alloc(size);
+    }
+    var buffer = new Buffer(size);
+    buffer.fill(0);
+    return buffer;
+}
+
+function extend(target, source) {
+    Object.keys(source || {}).forEach(function (key) {
+        target[key] = source[key];
+    });
+    return target;
+}
+
+function mkdirs(dir) {
+    if (!fs.existsSync(dir)) {
+        mkdirs(path.dirname(dir));
+        fs.mkdirSync(dir);
+    }
+}
+
+function loadLess() {
+    var less = require('less');
+    var importCache = {};
+
+    // the default file manager with a cache, works with both the callback (less 2) and the promise
+    // (less 3+) API of loadFile
+    var manager = new less.FileManager();
+    var loadFile = manager.loadFile;
+    manager.loadFile = function (filename, currentDirectory, options, environment, callback) {
+        var key = [currentDirectory, filename, (options.paths || []).join(':')].join('\n');
+        if (!importCache[key]) {
+            importCache[key] = new Promise(function (resolve, reject) {
+                var result = loadFile.call(manager, filename, currentDirectory, options, environment,
+                    function (error, file) {
+                        if (error) {
+                            reject(error);
+                        } else {
+                            resolve(file);
+                        }
+                    });
+                if (result && typeof result.then === 'function') {
+                    result.then(resolve, reject);
+                }
+            });
+            importCache[key].catch(function () {
+                delete importCache[key];
+            });
+        }
+
+        if (callback) {
+            importCache[key].then(function (file) {
+                callback(null, file);
+            }, callback);
+            return;
+        }
+        return importCache[key];
+    };
+
+    var plugin = {
+        install: function (less, pluginManager) {
+            pluginManager.addFileManager(manager);
+        }
+    };
+
+    return function (source, request) {
+        var options = extend({filename: request.input, plugins: [plugin]}, request.options);
+        return less.render(source, options).then(function (result) {
+            return result.css;
+        });
+    };
+}
+
+function loadCoffee() {
+    var coffee;
+    try {
+        coffee = require('coffeescript');
+    } catch (error) {
+        coffee = require('coffee-script');
+    }
+
+    return function (source, request) {
+        return coffee.compile(source, extend({filename: request.input}, request.options));
+    };
+}
+
+var loaders = {less: loadLess, coffee: loadCoffee};
+
+function compiler(name) {
+    if (!compilers[name]) {
+        if (!loaders[name]) {
+            throw new Error('Unknown compiler: ' + name);
+        }
+        compilers[name] = loaders[name]();
+    }
+    return compilers[name];
+}
+
+function respond(message) {
+    var body = bufferFrom(JSON.stringify(message));
+    var header = bufferAlloc(4);
+    header.writeUInt32BE(body.length, 0);
+    process.stdout.write(Buffer.concat([header, body]));
+}
+
+function errorMessage(request, error) {
+    var message = (error && error.message) || String(error);
+    var location = (error && error.filename) || request.input;
+    if (error && error.line) {
+        location += ':' + error.line;
+    }
+    return location + ': ' + message;
+}
+
+function handle(request) {
+    return new Promise(function (resolve) {
+        resolve(compiler(request.compiler)(fs.readFileSync(request.input, 'utf8'), request));
+    }).then(function (output) {
+        mkdirs(path.dirname(request.output));
+        fs.writeFileSync(request.output, output);
+        respond({id: request.id, error: null});
+    }, function (error) {
+        respond({id: request.id, error: errorMessage(request, error)});
+    });
+}
+
+var buffered = bufferAlloc(0);
+var pending = [];
+
+process.stdin.on('data', function (chunk) {
+    buffered = Buffer.concat([buffered, chunk]);
+    while (buffered.length >= 4) {
+        var length = buffered.readUInt32BE(0);
+        if (buffered.length < 4 + length) {
+            break;
+        }
+        pending.push(handle(JSON.parse(buffered.slice(4, 4 + length).toString('utf8'))));
+        buffered = buffered.slice(4 + length);
+    }
+});
+
+process.stdin.on('end', function () {
+    Promise.all(pending).then(function () {
+        if (buffered.length) {
+            process.stderr.write('Incomplete request at the end of the input\n');
+            process.exitCode = 1;
+        }
+    });
+});
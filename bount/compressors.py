@@ -0,0 +1,130 @@
+from bount.utils import pipefail
+
+__author__ = 'mturilin'
+
+
+class CompressorException(StandardError):
+    pass
+
+
+class Compressor(object):
+    """
+    Builds the shell commands of a compression codec. The commands read stdin and write stdout.
+
+    level - compression level, None for the codec's default
+    threads - number of compression threads, 0 means all the CPUs (ignored by single-threaded codecs)
+    """
+    name = None
+    suffix = None
+    package = None  # Ubuntu package providing the command
+    default_level = None
+
+    def __init__(self, level=None, threads=0):
+        self.level = level if level is not None else self.default_level
+        self.threads = int(threads)
+
+    def compress_command(self):
+        raise NotImplementedError('Method is not implemented')
+
+    def decompress_command(self):
+        raise NotImplementedError('Method is not implemented')
+
+    def tar_command(self, archive_path):
+        """
+        Packs the current dir into archive_path.
+        """
+        return pipefail("tar -cf - . | %s > %s" % (self.compress_command(), archive_path))
+
+    def untar_command(self, archive_path):
+        """
+        Unpacks archive_path into the current dir.
+        """
+        return pipefail("%s < %s | tar -xf -" % (self.decompress_command(), archive_path))
+
+
+class NoneCompressor(Compressor):
+    name = 'none'
+    suffix = ''
+
+    def compress_command(self):
+        return "cat"
+
+    def decompress_command(self):
+        return "cat"
+
+
+class GzipCompressor(Compressor):
+    name = 'gzip'
+    suffix = '.gz'
+    default_level = 6
+
+    def compress_command(self):
+        return "gzip -%d" % self.level
+
+    def decompress_command(self):
+        return "gzip -dc"
+
+
+class PigzCompressor(Compressor):
+    """
+    Parallel gzip, the archives are compatible with gzip.
+    """
+    name = 'pigz'
+    suffix = '.gz'
+    package = 'pigz'
+    default_level = 6
+
+    def compress_command(self):
+        if self.threads:
+            return "pigz -%d -p %d" % (self.level, self.threads)
+        return "pigz -%d" % self.level
+
+    def decompress_command(self):
+        return "pigz -dc"
+
+
+class ZstdCompressor(Compressor):
+    name = 'zstd'
+    suffix = '.zst'
+    package = 'zstd'
+    default_level = 3
+
+    def compress_command(self):
+        return "zstd -%d -T%d -q -c" % (self.level, self.threads)
+
+    def decompress_command(self):
+        return "zstd -dc -q"
+
+
+COMPRESSORS = dict((compressor.name, compressor) for compressor in
+                   (NoneCompressor, GzipCompressor, PigzCompressor, ZstdCompressor))
+
+
+def get_compressor(compressor=None, level=None, threads=0):
+    """
+    Returns a Compressor for a codec name or the compressor itself. None stands for gzip.
+    """
+    if isinstance(compressor, Compressor):
+        return compressor
+
+    compressor_class = COMPRESSORS.get(compressor or 'gzip')
+    if not compressor_class:
+        raise CompressorException("Unknown compressor '%s', use one of: %s" %
+                                  (compressor, ", ".join(sorted(COMPRESSORS))))
+    return compressor_class(level, threads)
+
+
+def compressor_for_file(file_name, codec=None, default=None):
+    """
+    Returns the Compressor a dump was written with: the codec recorded for it (see bount.catalog), else the
+    codec its suffix stands for, else the default.
+    """
+    default = get_compressor(default)
+    if codec in COMPRESSORS:
+        return default if default.name == codec else get_compressor(codec)
+    if default.suffix and file_name.endswith(default.suffix):
+        return default
+    for name in sorted(COMPRESSORS):
+        if COMPRESSORS[name].suffix and file_name.endswith(COMPRESSORS[name].suffix):
+            return get_compressor(name)
+    return default
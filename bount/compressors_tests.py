@@ -0,0 +1,56 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from bount.compressors import get_compressor, CompressorException, ZstdCompressor, GzipCompressor, PigzCompressor, \
+    compressor_for_file
+from bount.utils import pipefail
+
+__author__ = 'mturilin'
+
+
+class CompressorTest(unittest.TestCase):
+    def test_get_compressor(self):
+        self.assertTrue(isinstance(get_compressor(), GzipCompressor))
+        self.assertEquals(get_compressor('pigz', threads=8).compress_command(), "pigz -6 -p 8")
+        self.assertEquals(get_compressor('zstd', level=1).compress_command(), "zstd -1 -T0 -q -c")
+        self.assertEquals(get_compressor('zstd').suffix, ".zst")
+
+        compressor = ZstdCompressor(level=10, threads=4)
+        self.assertTrue(get_compressor(compressor) is compressor)
+        self.assertRaises(CompressorException, get_compressor, 'rar')
+
+    def test_compressor_for_file(self):
+        zstd = get_compressor('zstd')
+        self.assertTrue(isinstance(compressor_for_file('db.sql.gz', 'gzip', zstd), GzipCompressor))
+        self.assertTrue(isinstance(compressor_for_file('db.sql.gz', None, zstd), GzipCompressor))
+        self.assertTrue(compressor_for_file('db.sql.zst', None, zstd) is zstd)
+        # the configured compressor is kept for its own suffix
+        self.assertTrue(isinstance(compressor_for_file('db.sql.gz', None, 'pigz'), PigzCompressor))
+
+    def test_tar_round_trip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            compressor = get_compressor('gzip', level=1)
+            source_dir = os.path.join(temp_dir, 'source')
+            target_dir = os.path.join(temp_dir, 'target')
+            archive_path = os.path.join(temp_dir, 'media.tar' + compressor.suffix)
+            os.makedirs(source_dir)
+            os.makedirs(target_dir)
+            with open(os.path.join(source_dir, 'a.txt'), 'w') as file:
+                file.write("media")
+
+            subprocess.check_call(compressor.tar_command(archive_path), shell=True, cwd=source_dir,
+                                  stdout=open(os.devnull, 'w'))
+            subprocess.check_call(compressor.untar_command(archive_path), shell=True, cwd=target_dir,
+                                  stdout=open(os.devnull, 'w'))
+
+            with open(os.path.join(target_dir, 'a.txt')) as file:
+                self.assertEquals(file.read(), "media")
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_pipefail(self):
+        self.assertEquals(subprocess.call("false | cat", shell=True), 0)
+        self.assertNotEquals(subprocess.call(pipefail("false | cat"), shell=True), 0)
@@ -38,7 +38,8 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import os, base64, bz2, string, re, random, crypt
+import os, base64, bz2, string, re, random, crypt, hashlib, shutil
+from StringIO import StringIO
 import fabric, fabric.api, fabric.context_managers
 from fabric.operations import local
 
@@ -54,6 +55,16 @@ mode = MODE_USER
 
 SUDO_AS = None
 
+BATCH = None
+
+FACTS = {}
+PATH_FACTS = ("file", "dir")
+
+
+# content larger than this is streamed with 'put' instead of being inlined into the
+# command line, which is limited by ARG_MAX
+FILE_STREAM_THRESHOLD = 64 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
 
 RE_SPACES = re.compile("[\s\t]+")
 WINDOWS_EOL = "\r\n"
@@ -105,9 +116,147 @@ class cuisine_local(cuisine_mode):
         super(cuisine_local, self).__init__(MODE_LOCAL)
 
 
+class BatchResult(object):
+    """A future-like handle for an operation queued by 'cuisine_batch'. The value
+     is available through 'result()' once the batch has been executed."""
+
+    def __init__(self, command=None, parse=None, op_mode=None, as_root=False):
+        self.command = command
+        self.parse = parse or (lambda _:_)
+        self.mode = op_mode or mode
+        self.sudo_as = None if as_root else SUDO_AS
+        self.output = None
+        self.status = None
+        self.value = None
+
+    @classmethod
+    def resolved(cls, value):
+        """Returns a result that is already done, used for answers known without
+         asking the remote host."""
+        res = cls()
+        res.status = 0
+        res.value = value
+        return res
+
+    def done(self):
+        return self.status is not None
+
+    def failed(self):
+        return self.done() and self.status != 0
+
+    def resolve(self, output, status):
+        self.output = output
+        self.status = status
+        if status == 0:
+            self.value = self.parse(output)
+
+    def result(self):
+        assert self.done(), "Batched operation was not executed yet: %s" % (self.command)
+        if self.status != 0:
+            raise RuntimeError("Batched operation failed with status %s: %s\n%s" % (self.status, self.command, self.output))
+        return self.value
+
+    def __nonzero__(self):
+        # 'if file_exists(...)' within a batch would otherwise always be true
+        if not self.done():
+            raise RuntimeError("Batched operation was not executed yet, use 'resolve()' or test it after the "
+                               "batch: %s" % self.command)
+        return bool(self.result())
+
+
+class cuisine_batch(object):
+    """Queues the idempotent cuisine operations (dir_ensure, file_attribs, file_exists,
+     package_ensure, group_check...) and executes them as a single generated shell
+     script when the block exits, so that the whole block costs one remote call
+     per mode instead of one call per operation.
+
+     Queued operations return 'BatchResult' objects instead of values:
+
+     >   with cuisine_batch():
+     >       exists = file_exists("/etc/myfile")
+     >       dir_ensure("/var/www", owner="www-data")
+     >   print exists.result()
+
+     Any other command executed inside the block (run, sudo) flushes the queue
+     first, so the operations are always executed in order. Note that queued
+     commands don't see the Fabric 'cd' and 'prefix' context they were queued in,
+     so batched helpers should be called with absolute paths."""
+
+    def __init__(self):
+        self.operations = []
+        self.token = "@@cuisine_batch_%08x" % random.getrandbits(32)
+
+    def __enter__(self):
+        global BATCH
+        self.saved_batch = BATCH
+        BATCH = self
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        global BATCH
+        try:
+            if exception_type is None:
+                self.flush()
+        finally:
+            BATCH = self.saved_batch
+
+    def add(self, command, parse=None, op_mode=None, as_root=False):
+        res = BatchResult(command, parse, op_mode, as_root)
+        self.operations.append(res)
+        return res
+
+    def flush(self):
+        """Executes the queued operations, consecutive operations sharing the same
+         mode are executed as a single script."""
+        operations, self.operations = self.operations, []
+        while operations:
+            group = [operations.pop(0)]
+            while operations and (operations[0].mode, operations[0].sudo_as) == (group[0].mode, group[0].sudo_as):
+                group.append(operations.pop(0))
+            self.execute(group)
+
+    def script(self, group):
+        """Generates the shell script for the given operations. Each operation is
+         followed by a marker line carrying its index and exit status, the script
+         stops at the first failed operation."""
+        return " ; ".join(
+            "( %s ) 2>&1 ; s=$? ; echo \"%s:%d:$s\" ; [ $s -eq 0 ] || exit 0" % (op.command, self.token, i)
+            for i, op in enumerate(group))
+
+    def parse_output(self, group, output):
+        lines = []
+        for line in output.replace("\r", "").split("\n"):
+            pos = line.find(self.token + ":")
+            if pos == -1:
+                lines.append(line)
+                continue
+            if pos > 0:
+                lines.append(line[:pos])
+            _, index, status = line[pos:].split(":")
+            group[int(index)].resolve("\n".join(lines).strip(), int(status))
+            lines = []
+
+    def execute(self, group):
+        global SUDO_AS
+        script = self.script(group)
+        with cuisine_mode(group[0].mode):
+            saved_sudo_as, SUDO_AS = SUDO_AS, group[0].sudo_as
+            try:
+                with fabric.context_managers.settings(warn_only=True):
+                    output = run(script)
+            finally:
+                SUDO_AS = saved_sudo_as
+        self.parse_output(group, output)
+
+        failed = [op for op in group if not op.done() or op.failed()]
+        if failed and not fabric.api.env.warn_only:
+            fabric.api.abort("Batched operation failed: %s\n%s" % (failed[0].command, failed[0].output or ""))
 
 
 def sudo(*args, **kwargs):
+    if BATCH is not None:
+        BATCH.flush()
+
     if SUDO_AS != "":
         return fabric.api.sudo(*args, user=SUDO_AS, **kwargs)
 
@@ -117,6 +266,9 @@ def sudo(*args, **kwargs):
 def run(*args, **kwargs):
     """A wrapper to Fabric's run/sudo commands, using the 'cuisine.SUDO_MODE' global
      to tell wether the command should be run as regular user or sudo."""
+    if BATCH is not None:
+        BATCH.flush()
+
     if mode == MODE_SUDO:
         return sudo(*args, **kwargs)
     elif mode == MODE_USER:
@@ -125,6 +277,97 @@ def run(*args, **kwargs):
         return fabric.operations.local(capture=True, *args, **kwargs)
 
 
+def run_batchable(command, parse=None, op_mode=None):
+    """Runs the given command and returns its parsed output, or queues it and
+     returns a 'BatchResult' when called within a 'cuisine_batch' block."""
+    parse = parse or (lambda _:_)
+    if BATCH is not None:
+        return BATCH.add(command, parse, op_mode)
+    if op_mode:
+        with cuisine_mode(op_mode):
+            return parse(run(command))
+    return parse(run(command))
+
+
+def resolve(value):
+    """Returns the value of a probe. If the probe was queued by 'cuisine_batch' the
+     queue is executed first, so the helpers that need the answer to go on work
+     within a batch too."""
+    if isinstance(value, BatchResult):
+        if not value.done() and BATCH is not None:
+            BATCH.flush()
+        return value.result()
+    return value
+
+
+def facts_host():
+    """Returns the key under which the facts about the current host are cached."""
+    if mode == MODE_LOCAL:
+        return MODE_LOCAL
+    return fabric.api.env.host_string
+
+
+def host_facts():
+    """Returns the fact cache of the current host, a '{(kind, name):value}' dict."""
+    return FACTS.setdefault(facts_host(), {})
+
+
+def fact_key(kind, name):
+    name = str(name)
+    if kind in PATH_FACTS and len(name) > 1:
+        name = name.rstrip("/")
+    return kind, name
+
+
+def fact_set(kind, name, value):
+    """Records the given fact about the current host, so that the next probe does not
+     have to ask the host again."""
+    host_facts()[fact_key(kind, name)] = value
+
+
+def facts_invalidate(kind=None, name=None):
+    """Forgets cached facts about the current host: all of them, all of the given kind
+     or a single one. Forgetting a 'file' or 'dir' fact also forgets the facts about
+     the locations below it, and forgetting a name without a kind forgets both."""
+    facts = host_facts()
+    if kind is None and name is None:
+        facts.clear()
+        return
+    kinds = (kind,) if kind else PATH_FACTS
+    if name is not None:
+        name = fact_key(kinds[0], name)[1]
+    for fact_kind, fact_name in facts.keys():
+        if fact_kind not in kinds:
+            continue
+        if name is None or fact_name == name or\
+           (fact_kind in PATH_FACTS and fact_name.startswith(name.rstrip("/") + "/")):
+            del facts[(fact_kind, fact_name)]
+
+
+def facts_flush():
+    """Forgets all the cached facts about all the hosts. Commands executed directly
+     with 'run()' or 'sudo()' are not tracked by the cache, flush it (or call
+     'facts_invalidate()') after changing the system behind cuisine's back."""
+    FACTS.clear()
+
+
+def probe(kind, name, command, parse, op_mode=None):
+    """Returns the cached fact or runs the given command to find it out, caching the
+     parsed result. Works with 'cuisine_batch' like 'run_batchable'."""
+    facts = host_facts()
+    key = fact_key(kind, name)
+    if key in facts:
+        if BATCH is not None:
+            return BatchResult.resolved(facts[key])
+        return facts[key]
+
+    def remember(output):
+        facts[key] = parse(output)
+        return facts[key]
+
+    return run_batchable(command, remember, op_mode)
+
+
 def multiargs(function):
     """Decorated functions will be 'map'ed to every element of the first argument
      if it is a list or a tuple, otherwise the function will execute normally."""
@@ -248,28 +491,130 @@ def file_read( location ):
 
 def file_exists( location ):
     """Tests if there is a *remote* file at the given location."""
-    return run("test -f '%s' && echo OK ; true" % (location)) == "OK"
+    return probe("file", location, "test -f '%s' && echo OK ; true" % (location), lambda out:out == "OK")
 
 
 def file_attribs(location, mode=None, owner=None, group=None, recursive=False):
     """Updates the mode/owner/group for the remote file at the given location."""
     recursive = recursive and "-R " or ""
-    if mode:  run("chmod %s %s '%s'" % (recursive, mode, location))
-    if owner: run("chown %s %s '%s'" % (recursive, owner, location))
-    if group: run("chgrp %s %s '%s'" % (recursive, group, location))
+    commands = []
+    if mode:  commands.append("chmod %s %s '%s'" % (recursive, mode, location))
+    if owner: commands.append("chown %s %s '%s'" % (recursive, owner, location))
+    if group: commands.append("chgrp %s %s '%s'" % (recursive, group, location))
+    if commands:
+        return run_batchable(" && ".join(commands))
+
+
+def file_signature( location ):
+    """Returns the sha256 and the attributes of the remote file as
+     '(<sha256>, {"mode":<str>,"owner":<str>,"group":<str>})' using a single call, or
+     '(None, None)' if the file does not exist."""
+    output = run("(sha256sum '%s' 2>/dev/null || shasum -a 256 '%s' 2>/dev/null) | cut -d' ' -f1 ; "
+                 "stat -c '%%a %%U %%G' '%s' 2>/dev/null || stat -f '%%Lp %%Su %%Sg' '%s' 2>/dev/null ; true"
+                 % (location, location, location, location))
+    lines = [line.strip() for line in output.split("\n") if line.strip()]
+    if len(lines) != 2:
+        return None, None
+    attribs = lines[1].split()
+    return lines[0], dict(mode=attribs[0], owner=attribs[1], group=attribs[2])
+
+
+def file_attribs_match( attribs, mode=None, owner=None, group=None ):
+    """Tells if the attributes returned by 'file_signature' are the requested ones,
+     symbolic modes never match."""
+    if mode:
+        mode = str(mode)
+        if not mode.isdigit() or mode.lstrip("0") != attribs["mode"].lstrip("0"):
+            return False
+    if owner and str(owner) != attribs["owner"]: return False
+    if group and str(group) != attribs["group"]: return False
+    return True
+
+
+def content_sha256( content ):
+    """Returns the sha256 of the given string or file-like object, file-like objects
+     are read in chunks and rewound."""
+    if not hasattr(content, "read"):
+        return hashlib.sha256(content).hexdigest()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda:content.read(STREAM_CHUNK_SIZE), ""):
+        sha256.update(chunk)
+    content.seek(0)
+    return sha256.hexdigest()
+
+
+def content_is_large( content ):
+    """Tells if the content should be streamed rather than inlined into a command."""
+    return hasattr(content, "read") or len(content) > FILE_STREAM_THRESHOLD
+
+
+def file_upload( location, content, append=False ):
+    """Streams the given string or file-like object to the remote file at the given
+     location, replacing or appending to its content.
+
+     The content goes through Fabric's 'put' into a temporary file and is then moved
+     into place by 'cat' respecting the current cuisine mode, so neither the size of
+     the command line nor the memory depend on the size of the content."""
+    if not hasattr(content, "read"):
+        content = StringIO(content)
+
+    if mode == MODE_LOCAL:
+        with open(location, append and "ab" or "wb") as local_file:
+            shutil.copyfileobj(content, local_file, STREAM_CHUNK_SIZE)
+        return
+
+    # the content may be a key or settings file, so the temp file is never readable by the others:
+    # mktemp creates it with mode 0600 under an unpredictable name before anything is written into
+    # it, and it's given to the user we sudo as instead (root reads it anyway)
+    temp_location = fabric.api.run("mktemp /tmp/cuisine_upload_XXXXXXXX")
+    if temp_location.failed:
+        fabric.api.abort("Can't create a temporary file for the upload of %s:\n%s" % (location, temp_location))
+    try:
+        if fabric.operations.put(content, temp_location, mode=0600).failed:
+            fabric.api.abort("Upload of %s failed" % location)
+        if mode == MODE_SUDO and SUDO_AS and fabric.api.sudo("chown '%s' '%s'" % (SUDO_AS, temp_location)).failed:
+            fabric.api.abort("Can't give the upload of %s to %s" % (location, SUDO_AS))
+        result = run("cat '%s' %s \"%s\"" % (temp_location, append and ">>" or ">", location))
+        if result.failed:
+            fabric.api.abort("Can't write %s:\n%s" % (location, result))
+    finally:
+        # the file may belong to the user we sudo as by now
+        (fabric.api.sudo if mode == MODE_SUDO else fabric.api.run)("rm -f '%s'" % temp_location)
 
 
 def file_write( location, content, mode=None, owner=None, group=None ):
     """Writes the given content to the file at the given remote location, optionally
-     setting mode/owner/group."""
+     setting mode/owner/group. The content is either a string or a file-like object,
+     large contents are streamed with 'file_upload'.
+
+     The remote checksum is compared with the content first and nothing is uploaded
+     when the file is already there, so the function returns 'True' if the file was
+     changed and 'False' if it was left untouched."""
+    if type(content) is unicode:
+        content = content.encode("utf-8")
     # Hides the output, which is especially important
     with fabric.context_managers.settings(
         fabric.api.hide('warnings', 'running', 'stdout'),
         warn_only=True
     ):
-        # We use bz2 compression
-        run("echo '%s' | base64 -d | bzcat > \"%s\"" % (base64.b64encode(bz2.compress(content)), location))
+        remote_sha256, attribs = file_signature(location)
+        if remote_sha256 == content_sha256(content):
+            fact_set("file", location, True)
+            if file_attribs_match(attribs, mode, owner, group):
+                return False
+        else:
+            # a failed write may have left a partial file, or none
+            facts_invalidate("file", location)
+            if content_is_large(content):
+                file_upload(location, content)
+            else:
+                # We use bz2 compression
+                result = run("echo '%s' | base64 -d | bzcat > \"%s\"" % (base64.b64encode(bz2.compress(content)), location))
+                if result.failed:
+                    fabric.api.abort("Can't write %s:\n%s" % (location, result))
+            fact_set("file", location, True)
         file_attribs(location, mode, owner, group)
+        return True
 
 
 def file_update( location, updater=lambda x:x):
@@ -280,17 +625,25 @@ def file_update( location, updater=lambda x:x):
 
      >   file_update("/etc/myfile", lambda _:_.upper())
      """
-    assert file_exists(location), "File does not exists: " + location
+    assert resolve(file_exists(location)), "File does not exists: " + location
     new_content = updater(file_read(location))
     assert type(new_content) in (str, unicode, fabric.operations._AttributeString)\
     , "Updater must be like (string)->string, got: %s() = %s" % (updater, type(new_content))
-    run("echo '%s' | base64 -d > \"%s\"" % (base64.b64encode(new_content), location))
+    if content_is_large(new_content):
+        file_upload(location, new_content)
+    else:
+        run("echo '%s' | base64 -d > \"%s\"" % (base64.b64encode(new_content), location))
 
 
 def file_append( location, content, mode=None, owner=None, group=None ):
     """Appends the given content to the remote file at the given location, optionally
-     updating its mode/owner/group."""
-    run("echo '%s' | base64 -d >> \"%s\"" % (base64.b64encode(content), location))
+     updating its mode/owner/group. The content is either a string or a file-like
+     object, large contents are streamed with 'file_upload'."""
+    if content_is_large(content):
+        file_upload(location, content, append=True)
+    else:
+        run("echo '%s' | base64 -d >> \"%s\"" % (base64.b64encode(content), location))
+    fact_set("file", location, True)
     file_attribs(location, mode, owner, group)
 
 
@@ -301,7 +654,12 @@ def dir_attribs(location, mode=None, owner=None, group=None, recursive=False):
 
 def dir_exists( location ):
     """Tells if there is a remote directory at the given location."""
-    return run("test -d '%s' && echo OK ; true" % (location)).endswith("OK")
+    return probe("dir", location, "test -d '%s' && echo OK ; true" % (location), lambda out:out.endswith("OK"))
+
+
+def dir_exists_cached( location ):
+    """Tells if the directory is known to exist without asking the remote host."""
+    return host_facts().get(fact_key("dir", location)) is True
 
 
 def dir_ensure( location, recursive=False, mode=None, owner=None, group=None ):
@@ -314,14 +672,25 @@ def dir_ensure( location, recursive=False, mode=None, owner=None, group=None ):
         mode_arg = "-m %s" % (mode)
     else:
         mode_arg = ""
-    run("test -d '%s' || mkdir %s %s '%s' && echo OK ; true" % (location, recursive and "-p" or "", mode_arg, location))
+    if dir_exists_cached(location):
+        res = BatchResult.resolved("OK") if BATCH is not None else None
+    else:
+        facts = host_facts()
+
+        def remember(output):
+            if output.endswith("OK"):
+                facts[fact_key("dir", location)] = True
+            return output
+
+        res = run_batchable("test -d '%s' || mkdir %s %s '%s' && echo OK ; true" % (location, recursive and "-p" or "", mode_arg, location), remember)
     if owner or group:
         dir_attribs(location, owner=owner, group=group)
+    return res
 
 
 def command_check( command ):
     """Tests if the given command is available on the system."""
-    return run("which '%s' >& /dev/null && echo OK ; true" % command).endswith("OK")
+    return probe("command", command, "which '%s' > /dev/null 2>&1 && echo OK ; true" % command, lambda out:out.endswith("OK"))
 
 
 def package_update( package=None ):
@@ -338,24 +707,82 @@ def package_install( package, update=False ):
     """Installs the given package/list of package, optionnaly updating the package
      database."""
     if update: sudo("apt-get --yes update")
-    if type(package) in (list, tuple): package = " ".join(package)
-    sudo("apt-get --yes install %s" % (package))
+    packages = package if type(package) in (list, tuple) else package.split()
+    sudo("apt-get --yes install %s" % (" ".join(packages)))
+    for name in packages:
+        fact_set("package", name, True)
+    # new packages usually bring new commands
+    facts_invalidate("command")
 
 
 @multiargs
 def package_ensure( package):
     """Tests if the given package is installed, and installes it in case it's not
      already there."""
-    if run("dpkg-query -W -f='${Status}' %s ; true" % package).find("install ok installed") == -1:
+    facts = host_facts()
+    key = fact_key("package", package)
+    if facts.get(key) is True:
+        return BatchResult.resolved(True) if BATCH is not None else None
+
+    if BATCH is not None:
+        def remember(output):
+            facts[key] = True
+            facts_invalidate("command")
+            return True
+
+        return BATCH.add("dpkg-query -W -f='${Status}' %s 2>/dev/null | grep -q 'install ok installed' || apt-get --yes install %s"
+                         % (package, package), remember, op_mode=MODE_SUDO, as_root=True)
+    if not probe("package", package, "dpkg-query -W -f='${Status}' %s ; true" % package,
+                 lambda out:out.find("install ok installed") != -1):
         package_install(package)
 
 
+def package_status( packages ):
+    """Tells which of the given packages are installed with a single dpkg-query call,
+     returning a '{<package>:<bool>}' dict. Answers are taken from and stored into
+     the fact cache."""
+    facts = host_facts()
+    status = {}
+    unknown = []
+    for package in packages:
+        key = fact_key("package", package)
+        if key in facts:
+            status[package] = facts[key]
+        else:
+            unknown.append(package)
+
+    if unknown:
+        installed = set()
+        output = run("dpkg-query -W -f='${Package} ${Status}\\n' %s 2>/dev/null ; true" % " ".join(unknown))
+        for line in output.split("\n"):
+            parts = line.strip().split(" ", 1)
+            if len(parts) == 2 and parts[1].find("install ok installed") != -1:
+                installed.add(parts[0])
+        for package in unknown:
+            status[package] = package.split(":")[0] in installed
+            facts[fact_key("package", package)] = status[package]
+
+    return status
+
+
+def package_ensure_bulk( packages, update=False ):
+    """Ensures that all the given packages are installed, querying their status at
+     once and installing the missing ones in a single apt-get transaction. Returns
+     the list of packages that were installed."""
+    packages = [package for package in packages if package]
+    status = package_status(packages)
+    missing = [package for package in packages if not status[package]]
+    if missing:
+        package_install(missing, update)
+    return missing
+
+
 def command_ensure( command, package=None ):
     """Ensures that the given command is present, if not installs the package with the given
      name, which is the same as the command by default."""
     if package is None: package = command
-    if not command_check(command): package_install(package)
-    assert command_check(command), "Command was not installed, check for errors: %s" % (command)
+    if not resolve(command_check(command)): package_install(package)
+    assert resolve(command_check(command)), "Command was not installed, check for errors: %s" % (command)
 
 
 def user_create( name, passwd=None, home=None, uid=None, gid=None, shell=None, uid_min=None, uid_max=None,
@@ -376,12 +803,18 @@ def user_create( name, passwd=None, home=None, uid=None, gid=None, shell=None, u
     if uid_max:  options.append("-K UID_MAX='%s'" % (uid_max))
     if supplementary_gid: options.append("-G '%s'" % (supplementary_gid))
     sudo("useradd %s '%s'" % (" ".join(options), name))
+    facts_invalidate("user", name)
 
 
 def user_check( name ):
     """Checks if there is a user defined with the given name, returning its information
      as a '{"name":<str>,"uid":<str>,"gid":<str>,"home":<str>,"shell":<str>}' or 'None' if
      the user does not exists."""
+    facts = host_facts()
+    key = fact_key("user", name)
+    if key in facts:
+        return facts[key]
+
     d = sudo("cat /etc/passwd | egrep '^%s:' ; true" % (name))
     s = sudo("cat /etc/shadow | egrep '^%s:' | awk -F':' '{print $2}'" % (name))
     results = {}
@@ -390,10 +823,8 @@ def user_check( name ):
         results = dict(name=d[0], uid=d[2], gid=d[3], home=d[5], shell=d[6])
     if s:
         results['passwd'] = s
-    if results:
-        return results
-    else:
-        return None
+    facts[key] = results or None
+    return facts[key]
 
 
 def user_ensure( name, passwd=None, home=None, uid=None, gid=None, shell=None, supplementary_gid=None):
@@ -427,6 +858,7 @@ def user_ensure( name, passwd=None, home=None, uid=None, gid=None, shell=None, s
             options.append("-s '%s'" % (shell))
         if options:
             sudo("usermod %s '%s'" % (" ".join(options), name))
+            facts_invalidate("user", name)
 
 
 def group_create( name, gid=None ):
@@ -434,34 +866,38 @@ def group_create( name, gid=None ):
     options = []
     if gid:  options.append("-g '%s'" % (gid))
     sudo("groupadd %s '%s'" % (" ".join(options), name))
+    facts_invalidate("group", name)
 
 
 def group_check( name ):
     """Checks if there is a group defined with the given name, returning its information
      as a '{"name":<str>,"gid":<str>,"members":<list[str]>}' or 'None' if the group
      does not exists."""
-    group_data = run("cat /etc/group | egrep '^%s:' ; true" % (name))
-    if group_data:
-        name, _, gid, members = group_data.split(":", 4)
-        return dict(name=name, gid=gid, members=tuple(m.strip() for m in members.split(",")))
-    else:
-        return None
+    def parse(group_data):
+        if group_data:
+            name, _, gid, members = group_data.split(":", 4)
+            return dict(name=name, gid=gid, members=tuple(m.strip() for m in members.split(",")))
+        else:
+            return None
+
+    return probe("group", name, "cat /etc/group | egrep '^%s:' ; true" % (name), parse)
 
 
 def group_ensure( name, gid=None ):
     """Ensures that the group with the given name (and optional gid) exists."""
-    d = group_check(name)
+    d = resolve(group_check(name))
     if not d:
         group_create(name, gid)
     else:
         if gid != None and d.get("gid") != gid:
             sudo("groupmod -g %s '%s'" % (gid, name))
+            facts_invalidate("group", name)
 
 
 def group_user_check( group, user ):
     """Checks if the given user is a member of the given group. It will return 'False'
      if the group does not exist."""
-    d = group_check(group)
+    d = resolve(group_check(group))
     if d is None:
         return False
     else:
@@ -471,14 +907,15 @@ def group_user_check( group, user ):
 @multiargs
 def group_user_add( group, user ):
     """Adds the given user/list of users to the given group/groups."""
-    assert group_check(group), "Group does not exist: %s" % (group)
+    assert resolve(group_check(group)), "Group does not exist: %s" % (group)
     if not group_user_check(group, user):
         sudo("usermod -a -G '%s' '%s'" % (group, user))
+        facts_invalidate("group", group)
 
 
 def group_user_ensure( group, user):
     """Ensure that a given user is a member of a given group."""
-    d = group_check(group)
+    d = resolve(group_check(group))
     if user not in d["members"]:
         group_user_add(group, user)
 
@@ -488,9 +925,10 @@ def ssh_keygen( user, keytype="dsa" ):
     d = user_check(user)
     assert d, "User does not exist: %s" % (user)
     home = d["home"]
-    if not file_exists(home + "/.ssh/id_%s.pub" % keytype):
+    if not resolve(file_exists(home + "/.ssh/id_%s.pub" % keytype)):
         dir_ensure(home + "/.ssh", mode="0700", owner=user, group=user)
         run("ssh-keygen -q -t %s -f '%s/.ssh/id_%s' -N ''" % (home, keytype, keytype))
+        facts_invalidate("file", home + "/.ssh")
         file_attribs(home + "/.ssh/id_%s" % keytype, owner=user, group=user)
         file_attribs(home + "/.ssh/id_%s.pub" % keytype, owner=user, group=user)
 
@@ -499,7 +937,7 @@ def ssh_authorize( user, key ):
     """Adds the given key to the '.ssh/authorized_keys' for the given user."""
     d = user_check(user)
     keyf = d["home"] + "/.ssh/authorized_keys"
-    if file_exists(keyf):
+    if resolve(file_exists(keyf)):
         if file_read(keyf).find(key) == -1:
             file_append(keyf, key)
     else:
@@ -0,0 +1,291 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+import fabric.api
+import fabric.operations
+from fabric.context_managers import settings, hide
+from bount import cuisine
+from bount.cuisine import cuisine_batch, cuisine_local
+
+__author__ = 'mturilin'
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.calls = []
+        self.saved_local = fabric.operations.local
+
+        def counting_local(command, *args, **kwargs):
+            self.calls.append(command)
+            return self.saved_local(command, *args, **kwargs)
+
+        fabric.operations.local = counting_local
+
+    def tearDown(self):
+        fabric.operations.local = self.saved_local
+        shutil.rmtree(self.temp_dir)
+
+    def test_single_call(self):
+        new_dir = os.path.join(self.temp_dir, 'a', 'b')
+
+        with cuisine_local(), cuisine_batch():
+            created = cuisine.dir_ensure(new_dir, recursive=True)
+            dir_exists = cuisine.dir_exists(new_dir)
+            file_exists = cuisine.file_exists(os.path.join(new_dir, 'missing'))
+            self.assertFalse(dir_exists.done())
+
+        self.assertEquals(len(self.calls), 1)
+        self.assertEquals(created.result(), "OK")
+        self.assertTrue(dir_exists.result())
+        self.assertFalse(file_exists.result())
+
+    def test_truth_value(self):
+        with cuisine_local(), cuisine_batch():
+            dir_exists = cuisine.dir_exists(self.temp_dir)
+            file_exists = cuisine.file_exists(os.path.join(self.temp_dir, 'missing'))
+            self.assertRaises(RuntimeError, bool, dir_exists)
+
+        self.assertTrue(dir_exists)
+        self.assertFalse(file_exists)
+
+    def test_stops_on_failure(self):
+        with settings(warn_only=True), cuisine_local(), cuisine_batch():
+            first = cuisine.run_batchable("echo before ; false")
+            second = cuisine.dir_ensure(os.path.join(self.temp_dir, 'never'))
+
+        self.assertTrue(first.failed())
+        self.assertEquals(first.output, "before")
+        self.assertFalse(second.done())
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'never')))
+        self.assertRaises(RuntimeError, first.result)
+
+    def test_run_flushes_queue(self):
+        marker = os.path.join(self.temp_dir, 'marker')
+
+        with cuisine_local(), cuisine_batch():
+            cuisine.dir_ensure(marker)
+            listing = cuisine.run("ls '%s'" % self.temp_dir)
+
+        self.assertEquals(listing, "marker")
+        self.assertEquals(len(self.calls), 2)
+
+    def test_helpers_resolve_probes(self):
+        with cuisine_local(), cuisine_batch():
+            cuisine.command_ensure("sh")
+            cuisine.group_ensure("root")
+            self.assertFalse(cuisine.group_user_check("root", "no-such-user"))
+
+    def test_package_ensure_runs_as_root(self):
+        with cuisine.cuisine_sudo("postgres"), cuisine_batch() as batch:
+            cuisine.package_ensure("ntp")
+            self.assertEquals(batch.operations[0].sudo_as, None)
+            batch.operations = []
+
+
+class FactsTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.calls = []
+        self.saved_local = fabric.operations.local
+
+        def counting_local(command, *args, **kwargs):
+            self.calls.append(command)
+            return self.saved_local(command, *args, **kwargs)
+
+        fabric.operations.local = counting_local
+        cuisine.facts_flush()
+
+    def tearDown(self):
+        fabric.operations.local = self.saved_local
+        cuisine.facts_flush()
+        shutil.rmtree(self.temp_dir)
+
+    def test_probe_is_cached(self):
+        with cuisine_local():
+            self.assertTrue(cuisine.dir_exists(self.temp_dir))
+            self.assertTrue(cuisine.dir_exists(self.temp_dir + "/"))
+
+        self.assertEquals(len(self.calls), 1)
+
+    def test_mutators_update_facts(self):
+        new_dir = os.path.join(self.temp_dir, 'new')
+        new_file = os.path.join(new_dir, 'file.txt')
+
+        with cuisine_local():
+            self.assertFalse(cuisine.file_exists(new_file))
+            cuisine.dir_ensure(new_dir)
+            cuisine.dir_ensure(new_dir)
+            self.assertTrue(cuisine.dir_exists(new_dir))
+            cuisine.file_write(new_file, "content")
+            self.assertTrue(cuisine.file_exists(new_file))
+
+        # probe, mkdir, signature, write
+        self.assertEquals(len(self.calls), 4)
+
+    def test_invalidate_subtree(self):
+        with cuisine_local():
+            cuisine.fact_set("dir", "/srv/app", True)
+            cuisine.fact_set("file", "/srv/app/site/wsgi.py", True)
+            cuisine.fact_set("file", "/srv/application.py", True)
+            cuisine.fact_set("command", "git", True)
+
+            cuisine.facts_invalidate(name="/srv/app/")
+
+            facts = cuisine.host_facts()
+
+        self.assertEquals(sorted(facts.keys()), [("command", "git"), ("file", "/srv/application.py")])
+
+
+class FileWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        cuisine.facts_flush()
+
+    def tearDown(self):
+        cuisine.facts_flush()
+        shutil.rmtree(self.temp_dir)
+
+    def test_unchanged_content_is_skipped(self):
+        location = os.path.join(self.temp_dir, 'config')
+
+        with cuisine_local():
+            self.assertTrue(cuisine.file_write(location, "a = 1\n", mode="0640"))
+            self.assertFalse(cuisine.file_write(location, "a = 1\n", mode="640"))
+            self.assertTrue(cuisine.file_write(location, "a = 1\n", mode="600"))
+            self.assertTrue(cuisine.file_write(location, "a = 2\n"))
+
+        with open(location) as config:
+            self.assertEquals(config.read(), "a = 2\n")
+        self.assertEquals(os.stat(location).st_mode & 0777, 0600)
+
+    def test_failed_write(self):
+        location = os.path.join(self.temp_dir, 'missing', 'config')
+
+        with cuisine_local(), settings(hide('aborts')):
+            cuisine.fact_set("file", location, True)
+            self.assertRaises(SystemExit, cuisine.file_write, location, "a = 1\n")
+            self.assertFalse(("file", location) in cuisine.host_facts())
+
+    def test_attribs_match(self):
+        attribs = dict(mode="755", owner="www-data", group="www-data")
+
+        self.assertTrue(cuisine.file_attribs_match(attribs))
+        self.assertTrue(cuisine.file_attribs_match(attribs, mode=755, owner="www-data"))
+        self.assertFalse(cuisine.file_attribs_match(attribs, mode="u+x"))
+        self.assertFalse(cuisine.file_attribs_match(attribs, group="root"))
+
+    def test_large_content_is_streamed(self):
+        location = os.path.join(self.temp_dir, 'large')
+        content = "x" * (cuisine.FILE_STREAM_THRESHOLD + 1)
+        saved_upload = cuisine.file_upload
+        uploads = []
+
+        def recording_upload(*args, **kwargs):
+            uploads.append(args[0])
+            return saved_upload(*args, **kwargs)
+
+        cuisine.file_upload = recording_upload
+        try:
+            with cuisine_local():
+                self.assertTrue(cuisine.file_write(location, content))
+                self.assertFalse(cuisine.file_write(location, StringIO(content)))
+                cuisine.file_append(location, StringIO("tail"))
+        finally:
+            cuisine.file_upload = saved_upload
+
+        self.assertEquals(uploads, [location, location])
+        with open(location) as large:
+            self.assertEquals(large.read(), content + "tail")
+
+
+class FileUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.commands = []
+        self.fail_put = False
+        self.saved = fabric.api.run, fabric.operations.put
+
+        def fake_run(command):
+            self.commands.append(command)
+            with settings(warn_only=True):
+                return fabric.operations.local(command, capture=True)
+
+        def fake_put(content, remote_path, mode=None):
+            with open(remote_path, 'w') as remote_file:
+                remote_file.write(content.read())
+            return FakePutResult(self.fail_put)
+
+        fabric.api.run, fabric.operations.put = fake_run, fake_put
+
+    def tearDown(self):
+        fabric.api.run, fabric.operations.put = self.saved
+        shutil.rmtree(self.temp_dir)
+
+    def test_upload(self):
+        location = os.path.join(self.temp_dir, 'config')
+        with settings(hide('running')):
+            cuisine.file_upload(location, "a = 1")
+
+        with open(location) as config:
+            self.assertEquals(config.read(), "a = 1")
+        self.assertTrue(self.commands[0].startswith("mktemp "))
+        self.assertTrue(self.commands[-1].startswith("rm -f "))
+        self.assertFalse(os.path.exists(self.commands[-1].split("'")[1]))
+
+    def test_failed_upload_is_cleaned(self):
+        self.fail_put = True
+        with settings(hide('running', 'aborts')):
+            self.assertRaises(SystemExit, cuisine.file_upload, os.path.join(self.temp_dir, 'config'), "a = 1")
+
+        self.assertEquals(len(self.commands), 2)
+        self.assertTrue(self.commands[-1].startswith("rm -f "))
+        self.assertFalse(os.path.exists(self.commands[-1].split("'")[1]))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'config')))
+
+
+class FakePutResult(list):
+    def __init__(self, failed):
+        list.__init__(self)
+        self.failed = ['remote'] if failed else []
+
+
+class PackageTest(unittest.TestCase):
+    DPKG_OUTPUT = "apache2 install ok installed\r\n" \
+                  "unzip deinstall ok config-files\r\n" \
+                  "git install ok installed"
+
+    def setUp(self):
+        self.commands = []
+        self.saved_run = cuisine.run
+        self.saved_install = cuisine.package_install
+        cuisine.facts_flush()
+
+        def fake_run(command):
+            self.commands.append(command)
+            return self.DPKG_OUTPUT
+
+        cuisine.run = fake_run
+        cuisine.package_install = lambda package, update=False: self.commands.append(("install", package))
+
+    def tearDown(self):
+        cuisine.run = self.saved_run
+        cuisine.package_install = self.saved_install
+        cuisine.facts_flush()
+
+    def test_bulk_ensure(self):
+        missing = cuisine.package_ensure_bulk(["apache2", "unzip", "git", "ntp", ""])
+
+        self.assertEquals(missing, ["unzip", "ntp"])
+        self.assertEquals(len(self.commands), 2)
+        self.assertEquals(self.commands[1], ("install", ["unzip", "ntp"]))
+
+    def test_status_is_cached(self):
+        cuisine.package_status(["apache2", "git"])
+        status = cuisine.package_status(["apache2", "git", "unzip"])
+
+        self.assertEquals(status, {"apache2": True, "git": True, "unzip": False})
+        self.assertEquals(len(self.commands), 2)
+        self.assertTrue(self.commands[1].endswith(" unzip 2>/dev/null ; true"))
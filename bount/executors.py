@@ -0,0 +1,125 @@
+from fabric.decorators import parallel
+from fabric.state import env
+from fabric.tasks import execute
+
+__author__ = 'mturilin'
+
+
+class DeploymentException(StandardError):
+    pass
+
+
+def to_bool(value):
+    """
+    Converts fab command line arguments (always strings) to bool.
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+
+def guarded(func):
+    """
+    Wraps the function so that it returns (True, result) or (False, error message) instead of raising.
+    Fabric's abort() raises SystemExit, so we catch it as well to keep the other hosts running.
+    """
+
+    def guarded_func(*args, **kwargs):
+        try:
+            return True, func(*args, **kwargs)
+        except (Exception, SystemExit), e:
+            return False, "%s: %s" % (e.__class__.__name__, e)
+
+    guarded_func.__name__ = func.__name__
+    return guarded_func
+
+
+class RollingExecutor(object):
+    """
+    Runs deployment steps on many hosts in parallel waves of pool_size hosts.
+
+    Failure policy:
+    - fail_fast - stop after the first wave with a failed host
+    - max_failures - otherwise stop as soon as more than max_failures hosts failed
+
+    The hosts that were not reached because of the policy are reported as skipped. Steps that must run
+    on a single host (migrations, backups) are executed with run_once() on the primary host, which is the
+    first host of the list that didn't fail.
+
+    Fabric forks a process per host, so the steps must not rely on state changed by the other hosts.
+    """
+
+    def __init__(self, hosts=None, pool_size=4, fail_fast=True, max_failures=0):
+        self.hosts = list(hosts if hosts is not None else env.hosts)
+        if not self.hosts:
+            raise DeploymentException("No hosts to deploy to, set env.hosts first")
+
+        self.pool_size = max(1, int(pool_size))
+        self.fail_fast = to_bool(fail_fast)
+        self.max_failures = int(max_failures)
+        self.failed_hosts = {}
+
+    @property
+    def primary_host(self):
+        hosts = self.live_hosts()
+        if not hosts:
+            raise DeploymentException("All the hosts failed, there is no primary host")
+        return hosts[0]
+
+    def live_hosts(self):
+        return [host for host in self.hosts if host not in self.failed_hosts]
+
+    def waves(self, hosts):
+        return [hosts[i:i + self.pool_size] for i in range(0, len(hosts), self.pool_size)]
+
+    def should_stop(self):
+        if self.fail_fast:
+            return bool(self.failed_hosts)
+        return len(self.failed_hosts) > self.max_failures
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs the function on all the hosts that didn't fail yet. Returns {host: result} for the hosts that
+        succeeded and raises DeploymentException when the failure policy says to stop.
+        """
+        task = parallel(pool_size=self.pool_size)(guarded(func))
+        results = dict()
+        failures = dict()
+        hosts = self.live_hosts()
+
+        # keep Fabric's [host] prefix, so the interleaved output stays readable
+        env.output_prefix = True
+
+        for wave_index, wave in enumerate(self.waves(hosts)):
+            for host, (success, result) in execute(task, *args, hosts=wave, **kwargs).iteritems():
+                if success:
+                    results[host] = result
+                else:
+                    failures[host] = self.failed_hosts[host] = result
+
+            if self.should_stop():
+                skipped = [host for wave in self.waves(hosts)[wave_index + 1:] for host in wave]
+                self.report(func.__name__, failures, skipped)
+                raise DeploymentException("Stopped '%s' after %d failed host(s)" %
+                                          (func.__name__, len(self.failed_hosts)))
+
+        self.report(func.__name__, failures)
+        return results
+
+    def run_once(self, func, *args, **kwargs):
+        """
+        Runs the function on the primary host only. Any failure stops the deployment.
+        """
+        host = self.primary_host
+        success, result = execute(guarded(func), *args, hosts=[host], **kwargs)[host]
+        if not success:
+            self.failed_hosts[host] = result
+            self.report(func.__name__, {host: result})
+            raise DeploymentException("'%s' failed on %s: %s" % (func.__name__, host, result))
+        return result
+
+    def report(self, step_name, failures, skipped=None):
+        for host, error in sorted(failures.iteritems()):
+            print("[%s] %s FAILED: %s" % (host, step_name, error))
+        for host in skipped or []:
+            print("[%s] %s skipped" % (host, step_name))
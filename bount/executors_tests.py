@@ -0,0 +1,55 @@
+import unittest
+from fabric.state import env
+from bount.executors import RollingExecutor, DeploymentException, to_bool
+
+__author__ = 'mturilin'
+
+
+def host_name():
+    return env.host_string
+
+
+def fail_on_b():
+    if env.host_string.startswith('b'):
+        raise RuntimeError("broken host")
+    return env.host_string
+
+
+class RollingExecutorTest(unittest.TestCase):
+    hosts = ['a1', 'b1', 'a2', 'a3', 'b2']
+
+    def test_all_hosts(self):
+        executor = RollingExecutor(self.hosts, pool_size=2)
+
+        self.assertEquals(executor.run(host_name), dict((host, host) for host in self.hosts))
+        self.assertEquals(executor.run_once(host_name), 'a1')
+
+    def test_fail_fast(self):
+        executor = RollingExecutor(self.hosts, pool_size=2, fail_fast='true')
+
+        self.assertRaises(DeploymentException, executor.run, fail_on_b)
+        self.assertEquals(executor.failed_hosts.keys(), ['b1'])
+
+    def test_max_failures(self):
+        executor = RollingExecutor(self.hosts, pool_size=2, fail_fast='false', max_failures=2)
+
+        results = executor.run(fail_on_b)
+
+        self.assertEquals(sorted(results.keys()), ['a1', 'a2', 'a3'])
+        self.assertEquals(sorted(executor.failed_hosts.keys()), ['b1', 'b2'])
+        # failed hosts are left out of the next steps
+        self.assertEquals(sorted(executor.run(host_name).keys()), ['a1', 'a2', 'a3'])
+
+    def test_primary_host_is_live(self):
+        executor = RollingExecutor(['b1', 'a1', 'b2'], pool_size=3, fail_fast='false', max_failures=2)
+        executor.run(fail_on_b)
+        self.assertEquals(executor.run_once(host_name), 'a1')
+
+        executor = RollingExecutor(['b1'], fail_fast='false', max_failures=1)
+        executor.run(fail_on_b)
+        self.assertRaises(DeploymentException, executor.run_once, host_name)
+
+    def test_to_bool(self):
+        self.assertTrue(to_bool('True'))
+        self.assertFalse(to_bool('false'))
+        self.assertFalse(to_bool(0))
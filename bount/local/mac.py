@@ -2,6 +2,8 @@ import os
 import bount
 from bount.cuisine import run
 from bount import timestamp_str
+from bount.catalog import DumpCatalog
+from bount.compressors import get_compressor, compressor_for_file
 from bount.local import LocalDbManager
 from path import path
 
@@ -15,11 +17,14 @@ class MacLocalPostgres9Manager(LocalDbManager):
     2. psql should be in $PATH (it usually is)
     3. pg_ctl should be in $PATH (ex: a new file "postgres" should be placed to /etc/paths.d/
     More info at: http://serverfault.com/questions/16355/how-to-set-global-path-on-os-x
+
+    compressor - codec name or Compressor for zipped dumps, see bount.compressors
+    keep_dumps - number of the newest dumps kept in backup_path
     """
 
     def __init__(self, database_name, user, password, backup_path, dba_login="", dba_password="",
                  host="localhost", port=5432, bin_path="/usr/local/Cellar/postgresql/9.1.2/bin", use_zip=True,
-                 backup_prefix=None, pgdata='/usr/local/var/postgres'):
+                 backup_prefix=None, pgdata='/usr/local/var/postgres', compressor=None, keep_dumps=None):
         self.database_name = database_name
         self.user = user
         self.password = password
@@ -33,6 +38,9 @@ class MacLocalPostgres9Manager(LocalDbManager):
         self.dba_password = dba_password
         self.backup_prefix = backup_prefix
         self.pgdata = pgdata
+        self.compressor = get_compressor(compressor)
+        self.keep_dumps = keep_dumps
+        self.catalog = DumpCatalog(backup_path)
 
     def psql_command(self, database='', query=None, as_dba=False):
         if as_dba:
@@ -94,8 +102,13 @@ class MacLocalPostgres9Manager(LocalDbManager):
 
 
     def latest_db_dump_basename(self):
+        latest = self.catalog.latest('db')
+        if latest:
+            return latest
+
+        # dumps taken before the catalog was introduced
         sql_file_list = [filename for filename in os.listdir(self.backup_path)
-                         if filename.endswith(".sql.gz") and filename.startswith(self.backup_prefix)]
+                         if filename.endswith(self.dump_suffix()) and filename.startswith(self.backup_prefix)]
         if not sql_file_list:
             raise RuntimeError("No files found")
 
@@ -103,21 +116,31 @@ class MacLocalPostgres9Manager(LocalDbManager):
 
     def restore_database(self, file_name, delete_if_exists=False):
         self.create_database(delete_if_exists)
-        if self.use_zip:
-            command = "cat %s | gunzip | %s"
-        else:
-            command = "cat %s | %s"
 
         if not file_name:
             file_name = self.latest_db_dump_basename()
 
         init_sql_file = path(self.backup_path).joinpath(file_name)
+        entry = self.catalog.get(file_name)
+        if entry:
+            self.catalog.verify(file_name)
+
+        # the dump is decompressed with the codec it was written with
+        codec = entry and entry.get('codec')
+        if codec == 'none' or not codec and not self.use_zip:
+            command = "cat %s | %s"
+        else:
+            compressor = compressor_for_file(file_name, codec, self.compressor)
+            command = "cat %s | " + compressor.decompress_command() + " | %s"
 
         return run(command % (init_sql_file, self.psql_command_db()))
 
     def _create_db_backup_name(self):
         prefix = self.backup_prefix if self.backup_prefix else self.database_name
-        return "%s_db_%s_local.sql.gz" % (prefix, timestamp_str())
+        return "%s_db_%s_local%s" % (prefix, timestamp_str(), self.dump_suffix())
+
+    def dump_suffix(self):
+        return ".sql%s" % self.compressor.suffix if self.use_zip else ".sql"
 
     def backup_database(self, file_name=''):
         filepath = path(self.backup_path).joinpath(self._create_db_backup_name() if file_name == '' else file_name)
@@ -125,18 +148,23 @@ class MacLocalPostgres9Manager(LocalDbManager):
         dump_command = "%s/pg_dump -O -x %s -U %s -w -h %s" % (self.bin_path, self.database_name, self.user, self.host)
 
         if self.use_zip:
-            command = "%s | gzip > %s" % (dump_command, filepath)
+            command = "%s | %s > %s" % (dump_command, self.compressor.compress_command(), filepath)
         else:
             command = "%s > %s" % (dump_command, filepath)
         run(command)
 
+        self.catalog.add('db', filepath, codec=self.compressor.name if self.use_zip else 'none', host='localhost')
+        if self.keep_dumps:
+            self.catalog.prune('db', keep=self.keep_dumps)
+
     @classmethod
     def build_manager(cls, database_name, user, password, backup_path,
                       dba_login="", dba_password="",
                       host="localhost", port=5432, bin_path="/usr/local/Cellar/postgresql/9.1.2/bin", use_zip=True,
-                      backup_prefix=None):
+                      backup_prefix=None, compressor=None, keep_dumps=None):
         bount.local.current_local_db_manager = MacLocalPostgres9Manager(database_name, user, password, backup_path,
-            dba_login, dba_password, host, port, bin_path, use_zip, backup_prefix)
+            dba_login, dba_password, host, port, bin_path, use_zip, backup_prefix, compressor=compressor,
+            keep_dumps=keep_dumps)
 
     def psql(self, command, database="", as_dba=False):
         return run("echo \"%s\" | %s" % (command, self.psql_command(database, as_dba=as_dba)))
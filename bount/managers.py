@@ -1,37 +1,55 @@
+import hashlib
+import multiprocessing
 import os
+import pipes
+import shutil
+import subprocess
+import time
 from contextlib import contextmanager
 from functools import wraps
 from fabric import operations
 import logging
-from fabric.context_managers import lcd, cd, prefix
+from fabric.context_managers import lcd, cd, prefix, settings
 from path import path
 import re
 import types
+import urllib
 from bount import timestamp_str
 from bount import cuisine
+from bount.compressors import get_compressor
+from bount.precompilers import run_precompilers, CompilerDaemon
 from bount.cuisine import cuisine_sudo, dir_ensure, file_read, text_ensure_line, file_write, dir_attribs, file_exists, sudo, run
-from bount.utils import local_file_delete, file_delete, python_egg_ensure, file_unzip, text_replace_line_re, sudo_pipeline, clear_dir, dir_delete, remote_home, unix_eol, local_dir_ensure, local_dirs_delete
+from bount.utils import local_file_delete, file_delete, python_egg_ensure, file_unzip, file_untar, text_replace_line_re, sudo_pipeline, pipefail, clear_dir, dir_delete, remote_home, unix_eol, local_dir_ensure, local_dirs_delete, ls_re, local_pipe_to_remote, run_concurrently, remote_exec_stream
 
 __author__ = 'mturilin'
 
 logger = logging.getLogger(__file__)
 
+def dependency_str(dep):
+    if isinstance(dep, str):
+        return dep
+    elif isinstance(dep, tuple) or isinstance(dep, types.ListType):
+        print(dep)
+        return dep[0] if len(dep) == 1 else "%s==%s" % tuple(dep)
+    else:
+        raise RuntimeError("Dependency must be string or tuple, %s found" % str(dep))
+
+
 def generic_install(dependencies, command):
     for dep in dependencies:
-        if isinstance(dep, str):
-            dep_str = dep
-        elif isinstance(dep, tuple) or isinstance(dep, types.ListType):
-            print(dep)
-            dep_str = dep[0] if len(dep) == 1 else "%s==%s" % tuple(dep)
-        else:
-            raise RuntimeError("Dependency must be string or tuple, %s found" % str(dep))
+        command(dependency_str(dep))
 
-        command(dep_str)
 
-
-def aptget_install(dependencies):
-    generic_install(dependencies, lambda dep_str: cuisine.package_ensure(dep_str
-    ))
+def aptget_install(dependencies, bulk=True):
+    """
+    Installs missing OS packages. In bulk mode all the packages are checked with one dpkg-query
+    and installed with one apt-get call, otherwise the packages are ensured one by one.
+    """
+    if bulk:
+        cuisine.package_ensure_bulk([dependency_str(dep).strip() for dep in dependencies if dep])
+    else:
+        generic_install(dependencies, lambda dep_str: cuisine.package_ensure(dep_str
+        ))
 
 
 def pip_install(dependencies):
@@ -44,8 +62,8 @@ class UbuntuManager():
     def __init__(self):
         self.dependencies = []
 
-    def setup_dependencies(self):
-        aptget_install(self.dependencies)
+    def setup_dependencies(self, bulk=True):
+        aptget_install(self.dependencies, bulk)
 
 
     def refresh_sources(self):
@@ -143,6 +161,8 @@ class PythonManager():
 
 
 class DatabaseManager(object):
+    dump_format = 'plain'
+
     def create_user(self):
         pass
 
@@ -158,7 +178,7 @@ class DatabaseManager(object):
     def backup_database(self, filename, zip=False, folder=None, ignore_tables=None):
         pass
 
-    def init_database(self, init_sql_file, delete_if_exists=False, unzip=False):
+    def init_database(self, init_sql_file, delete_if_exists=False, unzip=False, compressor=None):
         pass
 
     def create_backup_script(self, folder=None, project_name=None):
@@ -171,13 +191,27 @@ class SqliteManager(DatabaseManager):
 
 
 class PostgresManager(DatabaseManager):
-    def __init__(self, database_name, user, password, superuser_login="postgres", host="localhost"):
+    """
+    dump_format - 'plain' for SQL dumps restored with psql or 'directory' for pg_dump -Fd dumps, which are
+    written and restored with dump_jobs parallel jobs (the number of remote CPUs by default)
+    compressor - codec name or Compressor for the plain SQL dumps, see bount.compressors
+    """
+    DUMP_FORMATS = ('plain', 'directory')
+
+    def __init__(self, database_name, user, password, superuser_login="postgres", host="localhost",
+                 dump_format='plain', dump_jobs=None, compressor=None):
+        if dump_format not in self.DUMP_FORMATS:
+            raise ConfigurationException("Unknown dump format '%s', use one of %s" % (dump_format, self.DUMP_FORMATS))
+
         self.database_name = database_name
         self.user = user
         self.password = password
         self.superuser_login = superuser_login
         self.host = host
         self.db_backup_folder = "/tmp"
+        self.dump_format = dump_format
+        self.dump_jobs = dump_jobs
+        self.compressor = get_compressor(compressor)
 
     def version(self):
         version_info = cuisine.run("psql --version")
@@ -278,7 +312,13 @@ class PostgresManager(DatabaseManager):
         run("rm ~/.pgpass")
 
 
+    def jobs(self):
+        return self.dump_jobs or int(cuisine.run("nproc"))
+
     def backup_database(self, filename, zip=False, folder=None, ignore_tables=None):
+        """
+        With the directory format the dump is a directory named filename, it's always compressed.
+        """
         folder = folder or self.db_backup_folder
 
         with cuisine.cuisine_sudo():
@@ -286,26 +326,64 @@ class PostgresManager(DatabaseManager):
 
         file_full_path = "/".join([folder, filename])
 
-        additional_argument = ''
+        additional_argument = self.ignore_tables_argument(ignore_tables)
 
-        if ignore_tables:
-            for table in ignore_tables:
-                additional_argument = "%s -T '%s'" % (additional_argument, table)
+        if self.dump_format == 'directory':
+            command = "pg_dump -O -x -Fd -j %d %s %s -f %s" % (
+                self.jobs(), self.database_name, additional_argument, file_full_path)
+        else:
+            command = ("pg_dump -O -x %s %s | " + self.compressor.compress_command() + " > %s" if zip
+                       else "pg_dump %s %s > %s") % (self.database_name, additional_argument, file_full_path)
 
         with self.pg_pass():
-            sudo_pipeline(("pg_dump -O -x %s %s | gzip > %s" if zip else "pg_dump %s %s > %s")
-            % (self.database_name, additional_argument, file_full_path), user=self.superuser_login)
+            sudo_pipeline(command, user=self.superuser_login, pipefail=True)
+
+    def ignore_tables_argument(self, ignore_tables):
+        return "".join(" -T '%s'" % table for table in ignore_tables or [])
 
-    def init_database(self, init_sql_file, delete_if_exists=False, unzip=False):
+    def stream_database(self, stdout, ignore_tables=None):
+        """
+        Streams the compressed SQL dump into the file-like stdout over the SSH channel, without a remote file.
+        """
+        with self.pg_pass():
+            # without pipefail a failed pg_dump would leave an empty or truncated dump
+            remote_exec_stream(pipefail("pg_dump -O -x -w -U %s %s%s | %s" % (
+                self.user, self.database_name, self.ignore_tables_argument(ignore_tables),
+                self.compressor.compress_command())), stdout=stdout)
+
+    def init_database(self, init_sql_file, delete_if_exists=False, unzip=False, compressor=None):
+        """
+        init_sql_file is either an SQL file or a directory format dump, the latter is restored with pg_restore.
+        compressor - the Compressor the file was written with, the manager's compressor by default
+        """
         self.create_database(delete_if_exists)
-        if unzip:
-            command = "cat %s | gunzip | psql %s -w -U %s"
+        if cuisine.dir_exists(init_sql_file):
+            command = "pg_restore -O -x -j %d -d %s -w -U %s %s" % (
+                self.jobs(), self.database_name, self.user, init_sql_file)
+        elif unzip:
+            command = "cat %s | %s | psql %s -w -U %s" % (
+                init_sql_file, (compressor or self.compressor).decompress_command(), self.database_name, self.user)
         else:
-            command = "cat %s | psql %s -w -U %s"
+            command = "cat %s | psql %s -w -U %s" % (init_sql_file, self.database_name, self.user)
 
         with self.pg_pass():
-            run(command % (init_sql_file, self.database_name, self.user))
+            run(command)
 
+        self.grant_database()
+
+    def init_database_stream(self, stdin, delete_if_exists=False, unzip=False, compressor=None):
+        """
+        Same as init_database, but the SQL dump is read from the file-like stdin over the SSH channel.
+        """
+        self.create_database(delete_if_exists)
+
+        with self.pg_pass():
+            decompress = "%s | " % (compressor or self.compressor).decompress_command() if unzip else ""
+            remote_exec_stream("%spsql %s -q -w -U %s" % (decompress, self.database_name, self.user), stdin=stdin)
+
+        self.grant_database()
+
+    def grant_database(self):
         sudo_pipeline("echo GRANT ALL ON SCHEMA public TO %s | psql" % self.user, user=self.superuser_login)
         sudo_pipeline("echo ALTER DATABASE %s OWNER TO %s | psql" % (self.database_name, self.user), user=self.superuser_login)
 
@@ -317,8 +395,8 @@ class PostgresManager(DatabaseManager):
             """
             |echo *:*:${database_name}:${user}:${password} > ~/.pgpass
             |chmod 0600 ~/.pgpass
-            |file_full_path="${folder}/${project_name}_db_`date +%s`.sql.gz"
-            |pg_dump -O -x ${database_name} | gzip > $file_full_path
+            |file_full_path="${folder}/${project_name}_db_`date +%s`.sql${suffix}"
+            |pg_dump -O -x ${database_name} | ${compress} > $file_full_path
             |echo $file_full_path | env python /usr/local/bin/s3.py
             |rm ~/.pgpass
             |rm $file_full_path
@@ -330,6 +408,8 @@ class PostgresManager(DatabaseManager):
             'password': self.password,
             'folder': folder,
             'project_name': project_name,
+            'suffix': self.compressor.suffix,
+            'compress': self.compressor.compress_command(),
         }
 
         return cuisine.text_template(tmpl, context)
@@ -341,13 +421,26 @@ class ApacheManagerForUbuntu():
         self.webserver_group = "www-data"
 
     def status(self):
-        result = run("service apache2 status")
-        if "running" in result:
+        # the status command fails when Apache is stopped, older init scripts print "Apache2 is NOT running."
+        with settings(warn_only=True):
+            result = run("service apache2 status")
+        if result.succeeded and "not running" not in result.lower():
             return "running"
         else:
             return "stopped"
 
+    def configtest(self):
+        """
+        Raises ConfigurationException if Apache doesn't accept the config, so a broken config never takes
+        the running server down.
+        """
+        with settings(warn_only=True):
+            result = sudo("apache2ctl configtest 2>&1")
+        if result.failed:
+            raise ConfigurationException("Apache config test failed:\n%s" % result)
+
     def restart(self):
+        self.configtest()
         sudo("service apache2 restart")
 
     def start(self):
@@ -356,38 +449,127 @@ class ApacheManagerForUbuntu():
     def stop(self):
         sudo("service apache2 stop")
 
+    def reload(self):
+        """
+        Graceful restart: the workers finish the requests they serve before reloading.
+        """
+        self.configtest()
+        sudo("service apache2 reload")
+
 
     def configure_webserver(self, name, config, delete_other_sites=False):
+        """
+        Writes the site config and enables the required modules. Returns True if anything was changed and
+        the webserver needs a restart.
+        """
+        changed = False
         if delete_other_sites:
             with cuisine_sudo():
-                clear_dir('/etc/apache2/sites-enabled')
+                deleted = run("find /etc/apache2/sites-enabled -mindepth 1 -maxdepth 1 ! -name '%s' -print "
+                              "-exec rm -rf {} +" % name)
+                cuisine.facts_invalidate(name='/etc/apache2/sites-enabled')
+                changed = bool(deleted.strip())
 
         with cuisine_sudo():
-            cuisine.file_write('/etc/apache2/sites-enabled/%s' % name, config)
-            run("ln -fs /etc/apache2/mods-available/rewrite.load /etc/apache2/mods-enabled/rewrite.load")
+            changed = cuisine.file_write('/etc/apache2/sites-enabled/%s' % name, config) or changed
+
+            rewrite_load = '/etc/apache2/mods-enabled/rewrite.load'
+            if not file_exists(rewrite_load):
+                run("ln -fs /etc/apache2/mods-available/rewrite.load %s" % rewrite_load)
+                changed = True
 
             ssl_load = '/etc/apache2/mods-enabled/ssl.load'
             if not file_exists(ssl_load):
                 run("ln -s /etc/apache2/mods-available/ssl.load /etc/apache2/mods-enabled/ssl.load")
+                changed = True
+
+            if changed:
+                print("Apache configured\n%s" % config)
+            else:
+                print("Apache configuration is up to date")
 
-            print("Apache configured\n%s" % config)
+        return changed
+
+
+class ArchiveCache(object):
+    """
+    Local cache of git archives keyed by (repository path, tree SHA). Deploying the same tree again, or
+    to many hosts, reuses the archive instead of running git archive. The least recently used archives
+    are evicted when the cache grows over max_size bytes.
+
+    Archives are written to a temp file and renamed, so several processes can share the cache.
+    """
+
+    def __init__(self, root=None, max_size=1024 * 1024 * 1024):
+        self.root = path(root or os.path.expanduser('~/.bount/archive_cache'))
+        self.max_size = max_size
+
+    def archive_path(self, repo_dir, tree, suffix='.zip'):
+        repo_key = hashlib.sha1(os.path.abspath(repo_dir)).hexdigest()[:16]
+        return self.root.joinpath('%s_%s%s' % (repo_key, tree, suffix))
+
+    def get(self, repo_dir, tree, target):
+        """
+        Links or copies the cached archive to target. Returns False if there's no such archive.
+        """
+        archive_path = self.archive_path(repo_dir, tree)
+        try:
+            # mtime is the LRU clock
+            os.utime(archive_path, None)
+        except OSError:
+            return False
+
+        try:
+            os.link(archive_path, target)
+        except OSError:
+            shutil.copyfile(archive_path, target)
+        return True
+
+    def put(self, repo_dir, tree, source):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+        archive_path = self.archive_path(repo_dir, tree)
+        temp_path = '%s.%d.tmp' % (archive_path, os.getpid())
+        shutil.copyfile(source, temp_path)
+        os.rename(temp_path, archive_path)
+        self.evict()
+
+    def evict(self):
+        archives = []
+        for name in os.listdir(self.root):
+            archive_path = self.root.joinpath(name)
+            try:
+                stat = os.stat(archive_path)
+            except OSError:
+                continue
+            if not name.endswith('.tmp'):
+                archives.append((stat.st_mtime, stat.st_size, archive_path))
+
+        total_size = sum(size for mtime, size, archive_path in archives)
+        for mtime, size, archive_path in sorted(archives):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(archive_path)
+            except OSError:
+                pass
+            total_size -= size
 
 
 class GitManager:
-    def __init__(self, dir):
+    def __init__(self, dir, cache=None):
         self.dir = dir
+        self.cache = cache
 
     def basename(self):
         return "%s_%s" %\
                ("gitarchive_",
                 timestamp_str())
 
-    def local_archive(self, file_path, include_submodules=True):
-        basename_prefix = self.basename()
-        files = dict()
+    def dirs(self, include_submodules=True):
         dirs = [''] # we have atleast one dir
 
-
         # adding dirs from submodules
         if include_submodules:
             gitmodule_path = path(self.dir).joinpath('.gitmodules')
@@ -395,18 +577,142 @@ class GitManager:
                 with open(gitmodule_path, 'r') as file:
                     lines = file.read().split('\n')
                     regex = re.compile('\\s*path\\s*=\\s*(.*)\\s*')
-                    dirs += [regex.match(line).group(1) for line in lines if regex.match(line)]
+                    dirs += [regex.match(line).group(1).strip() for line in lines if regex.match(line)]
 
-        i = 0
-        for cur_dir in dirs:
-            cur_dur_full_path = path(self.dir).joinpath(cur_dir)
-            with lcd(cur_dur_full_path):
-                basename = '%s_%d.zip' % (basename_prefix, i)
-                operations.local("git archive %s --format zip --output %s" % ("HEAD", path(file_path).joinpath(basename)))
+        return dirs
+
+    def revisions(self, include_submodules=True):
+        """
+        Returns {dir: HEAD commit} for the repository and its submodules.
+        """
+        revisions = dict()
+        for cur_dir in self.dirs(include_submodules):
+            with lcd(path(self.dir).joinpath(cur_dir)):
+                revisions[cur_dir] = operations.local("git rev-parse HEAD", capture=True).strip()
+        return revisions
+
+    def changes(self, cur_dir, since, submodule_dirs=()):
+        """
+        Returns (changed, deleted) lists of paths changed in the dir between the commit and HEAD, or None if
+        the commit is not known locally. Submodule paths are skipped, they are archived separately.
+        """
+        with lcd(path(self.dir).joinpath(cur_dir)):
+            known = operations.local("git cat-file -e %s^{commit} && echo OK ; true" % since, capture=True)
+            if known.strip() != "OK":
+                return None
+            diff = operations.local("git diff --name-status --no-renames %s HEAD" % since, capture=True)
+
+        prefix = cur_dir + '/' if cur_dir else ''
+        submodules = set(sub_dir[len(prefix):] for sub_dir in submodule_dirs
+                         if sub_dir and sub_dir != cur_dir and sub_dir.startswith(prefix))
+        changed, deleted = [], []
+        for line in diff.split('\n'):
+            if not line.strip():
+                continue
+            status, file_path = line.split('\t', 1)
+            if file_path in submodules:
+                continue
+            if status.startswith('D'):
+                deleted.append(file_path)
+            else:
+                changed.append(file_path)
+        return changed, deleted
+
+    def archive_command(self, paths=None, compress=None):
+        """
+        Returns the shell command writing the tar archive of HEAD (or of the given paths only) to stdout.
+        The command fails if git archive fails, not only if the compressor does.
+        """
+        command = "git archive --format tar HEAD"
+        if paths:
+            command += " -- " + " ".join(pipes.quote(file) for file in paths)
+        if compress:
+            command = pipefail(command + " | " + compress)
+        return command
+
+    def local_archive_changes(self, file_path, changes):
+        """
+        Archives only the changed files of every dir into tar.gz files. Takes {dir: (changed, deleted)} and
+        returns {dir: archive basename} for the dirs that have changed files.
+        """
+        basename_prefix = self.basename()
+        files = dict()
+        for i, (cur_dir, (changed, deleted)) in enumerate(sorted(changes.iteritems())):
+            if not changed:
+                continue
+            with lcd(path(self.dir).joinpath(cur_dir)):
+                basename = '%s_%d.tar.gz' % (basename_prefix, i)
+                operations.local("%s > %s" % (self.archive_command(changed, "gzip"), path(file_path).joinpath(basename)))
                 files[cur_dir] = basename
-                i += 1
         return files
 
+    def local_export(self, file_path, include_submodules=True):
+        """
+        Unpacks HEAD of the repository and of its submodules into file_path, so the changes that are not
+        committed are left out.
+        """
+        for cur_dir in self.dirs(include_submodules):
+            export_dir = path(file_path).joinpath(cur_dir)
+            if not export_dir.exists():
+                export_dir.makedirs()
+            with lcd(path(self.dir).joinpath(cur_dir)):
+                operations.local(pipefail("%s | tar -xf - -C %s" % (self.archive_command(), export_dir)))
+
+    def archive_basename(self, dir, tree):
+        """
+        Archive names depend only on the dir and the tree it contains, so equal trees get equal names.
+        The dir is quoted, so different dirs (a/b and a_b, or a submodule named root) never share a name.
+        """
+        return 'gitarchive_%s_%s.zip' % ('sub_' + urllib.quote(dir, safe='') if dir else 'root', tree)
+
+    def local_archive(self, file_path, include_submodules=True):
+        """
+        Archives HEAD of the repository and of its submodules into file_path, in parallel processes.
+        Returns {dir: archive basename}.
+        """
+        jobs = [(self, dir, str(file_path)) for dir in self.dirs(include_submodules)]
+
+        if len(jobs) == 1:
+            results = [git_archive_job(jobs[0])]
+        else:
+            pool = multiprocessing.Pool(min(multiprocessing.cpu_count(), len(jobs)))
+            try:
+                # map_async + get with a timeout keeps Ctrl+C working in Python 2
+                results = pool.map_async(git_archive_job, jobs).get(24 * 60 * 60)
+            finally:
+                pool.close()
+                pool.join()
+
+        return dict(results)
+
+    def tree(self, dir=''):
+        return subprocess.check_output(["git", "rev-parse", "HEAD^{tree}"],
+                                       cwd=path(self.dir).joinpath(dir)).strip()
+
+    def archive_dir(self, dir, file_path):
+        repo_dir = path(self.dir).joinpath(dir)
+        tree = self.tree(dir)
+        basename = self.archive_basename(dir, tree)
+        archive_path = str(path(file_path).joinpath(basename))
+
+        if self.cache and self.cache.get(repo_dir, tree, archive_path):
+            print("Archive of '%s' (tree %s) found in cache" % (dir, tree))
+            return basename
+
+        print("Archiving '%s' (tree %s)" % (dir, tree))
+        subprocess.check_call(["git", "archive", "HEAD", "--format", "zip", "--output", archive_path], cwd=repo_dir)
+        if self.cache:
+            self.cache.put(repo_dir, tree, archive_path)
+        return basename
+
+
+def git_archive_job(job):
+    """
+    Pool worker for GitManager.local_archive, has to be a module function to be picklable.
+    """
+    scm, dir, file_path = job
+    return dir, scm.archive_dir(dir, file_path)
+
 
 class HgManager:
     def __init__(self, path):
@@ -489,7 +795,9 @@ class DjangoManager:
                  use_virtualenv=True, virtualenv_path=None, virtualenv_name='ENV',
                  media_root=None, media_url=None, static_root=None, static_url=None,
                  static_dirs=None,
-                 server_admin=None, precompilers=None, settings=None):
+                 server_admin=None, precompilers=None, settings=None, use_releases=False, keep_releases=5,
+                 incremental_upload=False, stream_upload=False, stream_codec='gzip', archive_cache_size=None,
+                 wsgi_options=None, local_precompile=False, compiler_daemon=False, compressor=None):
         logger.info("Creating DjangoManager")
 
         self.remote_project_path = remote_project_path
@@ -499,10 +807,65 @@ class DjangoManager:
 
         self.log_path = None
 
-        self.scm = GitManager(self.project_local_path)
+        # archive_cache_size - max size of the local archive cache in bytes, None disables the cache
+        self.scm = GitManager(self.project_local_path,
+                              ArchiveCache(max_size=archive_cache_size) if archive_cache_size else None)
+
+        # release layout: the code is unpacked into releases/<timestamp> and served through
+        # the 'current' symlink, src_root should point inside 'current' then
+        self.use_releases = use_releases
+        self.keep_releases = keep_releases
+        self.releases_path = path(self.remote_project_path).joinpath('releases')
+        self.current_release_path = path(self.remote_project_path).joinpath('current')
+
+        # incremental upload ships only the files changed since the commits recorded in revisions_file_name
+        self.incremental_upload = incremental_upload
+        self.revisions_file_name = '.bount_revisions'
+        self.max_incremental_files = 1000
+
+        # stream upload pipes git archive into tar on the server instead of uploading zip files,
+        # stream_codec is a codec name (fast level by default) or Compressor
+        self.stream_upload = stream_upload
+        self.stream_codec = get_compressor(stream_codec, level=1)
+        # compressor - codec name or Compressor for the media backups, see bount.compressors
+        self.compressor = get_compressor(compressor)
+
+        # local precompile runs the precompilers once per deploy on the workstation (precompile_locally),
+        # into local_precompile_root, and uploads the outputs with the code, so the servers don't need the
+        # compilers
+        self.local_precompile = local_precompile
+        self.local_precompile_root = path(os.path.expanduser('~/.bount/precompiled')).joinpath(project_name)
+        # compiler daemon compiles the LESS and CoffeeScript files in one Node process instead of starting
+        # lessc or coffee for every file, compiler_daemon is True or a CompilerDaemon
+        if compiler_daemon is True:
+            compiler_daemon = CompilerDaemon()
+        self.compiler_daemon = compiler_daemon or None
 
         self.env_path = "/usr/local"
         self.wsgi_handler_path = self.remote_site_path + "/wsgi_handler.py"
+        # the application runs in the mod_wsgi daemon processes of this group, which restart when the WSGI
+        # handler is touched, %{GLOBAL} runs it in the Apache processes (embedded mode)
+        self.wsgi_process_group = project_name
+
+        # mod_wsgi daemon settings, None leaves the option out (mod_wsgi default)
+        # wsgi_processes - None means as many as the host's CPUs and memory allow with
+        # wsgi_process_memory megabytes per process and half of the memory left to the database
+        self.wsgi_processes = None
+        self.wsgi_threads = 5
+        self.wsgi_maximum_requests = 1000
+        self.wsgi_inactivity_timeout = 300
+        # wsgi_queue_timeout - needs mod_wsgi 4.x, Ubuntu ships 3.x
+        self.wsgi_queue_timeout = None
+        self.wsgi_process_memory = 200
+        # wsgi_preload - load Django, the middleware, the URLconf and wsgi_preload_modules when the daemon
+        # process starts (WSGIImportScript) instead of on its first request
+        self.wsgi_preload = False
+        self.wsgi_preload_modules = []
+
+        for name, value in (wsgi_options or {}).iteritems():
+            if not hasattr(self, 'wsgi_%s' % name):
+                raise ConfigurationException("Unknown WSGI option: %s" % name)
+            setattr(self, 'wsgi_%s' % name, value)
 
         self.settings_module = settings_module
         self.use_virtualenv = use_virtualenv
@@ -543,14 +906,15 @@ class DjangoManager:
                 'export DJANGO_SETTINGS_MODULE="%s"' % self.settings_module)
 
             if new_activate_text != activate_text:
-                file_write(activate_file_name, unix_eol(new_activate_text))
+                return file_write(activate_file_name, unix_eol(new_activate_text))
+        return False
 
     @django_check_config
     def init(self):
         """
         Should be called at least one before uploading the code. Creates project dirs and copies static_upload files.
         """
-        with cuisine_sudo():
+        with cuisine.cuisine_batch(), cuisine_sudo():
             cuisine.dir_ensure(self.remote_project_path, recursive=True,
                 owner=self.webserver.webserver_user, group=self.webserver.webserver_group)
 
@@ -566,6 +930,9 @@ class DjangoManager:
             cuisine.dir_ensure(self.static_root, recursive=True,
                 owner=self.webserver.webserver_user, group=self.webserver.webserver_group)
 
+            if self.use_releases:
+                cuisine.dir_ensure(self.releases_path, recursive=True, mode='777')
+
         self.configure_virtualenv()
 
 
@@ -594,15 +961,128 @@ class DjangoManager:
                 'home_dir': home_dir
             })
 
-    @django_check_config
-    def upload_code(self, update_submodules=True):
-        self.before_upload_code()
+    def releases(self):
+        """
+        Returns the release dir names sorted from the oldest to the newest.
+        """
+        if not cuisine.dir_exists(self.releases_path):
+            return []
+        return sorted(ls_re(self.releases_path, '^\\d{8}_\\d+$'))
 
-        # we need to ensure the directory is open for writing
+    def current_release(self):
+        """
+        Returns the name of the release the 'current' symlink points to or None.
+        """
+        target = cuisine.run("readlink %s ; true" % self.current_release_path).strip()
+        return path(target).name if target else None
+
+    def create_release(self):
+        release_path = self.releases_path.joinpath(timestamp_str())
         with cuisine_sudo():
-            dir_attribs(self.remote_project_path, mode='777')
+            dir_ensure(release_path, recursive=True, mode='777')
+        return release_path
+
+    def switch_release(self, release_name, reload=True):
+        """
+        Points the 'current' symlink to the release. The new link is created aside and renamed over the old
+        one, so the switch is atomic, then the code is reloaded unless reload is False.
+        """
+        release_path = self.releases_path.joinpath(release_name)
+        new_link = "%s.new" % self.current_release_path
+        with cuisine_sudo():
+            cuisine.run("ln -sfn %s %s && mv -Tf %s %s" % (release_path, new_link, new_link, self.current_release_path))
+            cuisine.facts_invalidate(name=self.current_release_path)
+
+        if reload and self.webserver:
+            self.reload_code()
 
+        print("Current release: %s" % release_name)
 
+    def prune_releases(self):
+        """
+        Deletes all releases but the keep_releases newest ones and the current one.
+        """
+        releases = self.releases()
+        current = self.current_release()
+        with cuisine_sudo():
+            for release_name in releases[:-max(1, self.keep_releases)]:
+                if release_name != current:
+                    dir_delete(self.releases_path.joinpath(release_name))
+
+    def rollback(self):
+        """
+        Points 'current' back to the release preceding the current one. Database migrations are not rolled
+        back.
+        """
+        releases = self.releases()
+        current = self.current_release()
+        if current not in releases or releases.index(current) == 0:
+            raise RuntimeError("There's no release to roll back to from %s, releases: %s" % (current, releases))
+
+        self.switch_release(releases[releases.index(current) - 1])
+
+    def deployed_code_root(self):
+        return self.current_release_path if self.use_releases else path(self.remote_project_path)
+
+    def deployed_revisions(self):
+        """
+        Returns {dir: commit} recorded on the server by the last upload.
+        """
+        revisions_file = self.deployed_code_root().joinpath(self.revisions_file_name)
+        revisions = dict()
+        for line in cuisine.run("cat %s 2>/dev/null ; true" % revisions_file).split('\n'):
+            parts = line.strip().split(' ', 1)
+            if len(parts) == 2:
+                revisions[parts[1] if parts[1] != '.' else ''] = parts[0]
+        return revisions
+
+    def write_revisions(self, code_root, revisions):
+        text = "".join("%s %s\n" % (commit, cur_dir or '.') for cur_dir, commit in sorted(revisions.iteritems()))
+        cuisine.file_write(code_root.joinpath(self.revisions_file_name), text)
+
+    def code_changes(self, dirs, deployed):
+        """
+        Returns {dir: (changed, deleted)} since the deployed revisions, or None if a full upload is needed
+        because a dir was never deployed, its commit is unknown locally or too many files changed.
+        """
+        changes = dict()
+        for cur_dir in dirs:
+            if cur_dir not in deployed:
+                print("No deployed revision for '%s', uploading everything" % cur_dir)
+                return None
+
+            dir_changes = self.scm.changes(cur_dir, deployed[cur_dir], dirs)
+            if dir_changes is None:
+                print("Deployed revision %s of '%s' is unknown, uploading everything" % (deployed[cur_dir], cur_dir))
+                return None
+            if len(dir_changes[0]) + len(dir_changes[1]) > self.max_incremental_files:
+                print("Too many changes in '%s', uploading everything" % cur_dir)
+                return None
+
+            changes[cur_dir] = dir_changes
+        return changes
+
+    def prepare_code_root(self, code_root, changes):
+        """
+        Makes the code root ready for unpacking: a full upload outside of the release mode wipes the project
+        dir, an incremental one deletes the files removed from the repository.
+        """
+        if not self.use_releases and changes is None:
+            self.reset_project_dir()
+
+        # delete the files removed from the repository
+        if changes is not None:
+            for dir, (changed, deleted) in changes.iteritems():
+                if deleted:
+                    with cuisine_sudo():
+                        cuisine.run("cd %s && rm -f -- %s" % (code_root.joinpath(dir).abspath(),
+                                                             " ".join(pipes.quote(file) for file in deleted)))
+                    cuisine.facts_invalidate(name=code_root.joinpath(dir).abspath())
+
+    def transfer_archives(self, code_root, changes, update_submodules):
+        """
+        Builds the archives in a local temp dir, uploads them to a remote temp dir and unpacks them.
+        """
         temp_dir_prefix = 'django_temp_'
 
         # zip and upload file
@@ -614,7 +1094,10 @@ class DjangoManager:
         with cuisine_sudo():
             dir_ensure(temp_remote_path, recursive=True, mode='666')
 
-        files = self.scm.local_archive(temp_local_path, include_submodules=update_submodules)
+        if changes is None:
+            files = self.scm.local_archive(temp_local_path, include_submodules=update_submodules)
+        else:
+            files = self.scm.local_archive_changes(temp_local_path, changes)
 
         # upload files
         for dir, file in files.iteritems():
@@ -623,8 +1106,11 @@ class DjangoManager:
             operations.put(str(local_archive_path), str(temp_remote_path), use_sudo=True)
             local_file_delete(local_archive_path)
 
-        # reset project dir
-        self.reset_project_dir()
+        self.prepare_code_root(code_root, changes)
+
+        # without releases the code is replaced in place, so the webserver doesn't serve a half-unpacked tree
+        if self.webserver and not self.use_releases:
+            self.webserver.stop()
 
         # unpack files
         for dir, file in files.iteritems():
@@ -632,25 +1118,165 @@ class DjangoManager:
 
             #unzip file
             with cuisine_sudo():
-                if self.webserver:
-                    self.webserver.stop()
-
-                extdir = path(self.remote_project_path).joinpath(dir).abspath()
+                extdir = code_root.joinpath(dir).abspath()
                 dir_ensure(extdir, recursive=True, mode='777')
-                file_unzip(remote_archive_path, extdir)
+                if file.endswith('.tar.gz'):
+                    file_untar(remote_archive_path, extdir)
+                else:
+                    file_unzip(remote_archive_path, extdir)
                 file_delete(remote_archive_path)
 
-        cuisine.run("cd %s" % self.src_root)
-        cuisine.run("pwd")
+        # clear old archives
+        local_dirs_delete(self.project_local_path, '%s%s.*' % (temp_dir_prefix, self.project_name))
+
+    def stream_code(self, code_root, dirs, changes):
+        """
+        Pipes git archive of every dir straight into tar on the server, one SSH channel per dir, all dirs
+        at the same time. Nothing is written to disk on either side. The channels have no tty, so tar runs
+        through passwordless sudo, like the unzip of the archive upload.
+        """
+        compress, decompress = self.stream_codec.compress_command(), self.stream_codec.decompress_command()
+
+        self.prepare_code_root(code_root, changes)
+
+        if self.webserver and not self.use_releases:
+            self.webserver.stop()
+
+        streams = []
+        for dir in dirs:
+            paths = changes[dir][0] if changes is not None else None
+            if paths is not None and not paths:
+                continue
+            extdir = code_root.joinpath(dir).abspath()
+            streams.append((self.scm.archive_command(paths, compress), path(self.project_local_path).joinpath(dir),
+                            "sudo -n " + pipefail("mkdir -p %s && %s | tar -xf - -C %s" % (extdir, decompress, extdir))))
+
+        run_concurrently([lambda stream=stream: local_pipe_to_remote(*stream) for stream in streams])
+        cuisine.facts_invalidate(name=code_root)
+
+    def precompiled_archive_path(self):
+        """
+        The local archive of the files compiled from HEAD of the repository and of its submodules.
+        """
+        revisions = self.scm.revisions()
+        key = hashlib.sha1("".join("%s %s\n" % item for item in sorted(revisions.iteritems()))).hexdigest()
+        return self.local_precompile_root.dirname().joinpath("precompiled_%s_%s.tar%s" % (
+            self.project_name, key[:12], self.stream_codec.suffix))
+
+    def precompile_locally(self):
+        """
+        Compiles HEAD (not the working tree) into local_precompile_root and packs the outputs for
+        upload_precompiled. Runs once per deploy, before the code goes to the hosts, and does nothing if
+        HEAD is compiled already. The outputs of the previous compile are kept, so only the changed LESS
+        files are compiled.
+        """
+        if not self.precompilers:
+            return
+
+        archive_path = self.precompiled_archive_path()
+        if archive_path.exists():
+            print("Precompiled files of this revision found in %s" % archive_path)
+            return
+
+        source_root = path("%s.head" % self.local_precompile_root)
+        if source_root.exists():
+            shutil.rmtree(source_root)
+        self.scm.local_export(source_root)
+
+        try:
+            for precomp in self.precompilers:
+                precomp.root = source_root
+                precomp.output_root = self.local_precompile_root
+                precomp.previous_root = None
+
+            with cuisine.cuisine_local():
+                run_precompilers(self.precompilers, daemon=self.compiler_daemon)
+        finally:
+            shutil.rmtree(source_root)
+
+        for old_archive_path in archive_path.dirname().files("precompiled_%s_*" % self.project_name):
+            old_archive_path.remove()
+
+        # packed under a temp name, so an upload never sees a partial archive
+        temp_path = "%s.%d.tmp" % (archive_path, os.getpid())
+        with lcd(self.local_precompile_root):
+            operations.local(self.stream_codec.tar_command(temp_path))
+        os.rename(temp_path, archive_path)
+
+    def upload_precompiled(self, code_root):
+        """
+        Unpacks the outputs of the local compile of HEAD into the code root.
+        """
+        if not self.precompilers:
+            return
+
+        local_archive_path = self.precompiled_archive_path()
+        if not local_archive_path.exists():
+            raise ConfigurationException("HEAD is not precompiled, run precompile_locally before the upload")
+        remote_archive_path = path(remote_home()).joinpath('tmp').joinpath(local_archive_path.basename())
 
         with cuisine_sudo():
-            cuisine.dir_attribs(self.remote_project_path, mode="777", recursive=True)
+            dir_ensure(remote_archive_path.dirname(), recursive=True, mode='777')
+        operations.put(str(local_archive_path), str(remote_archive_path), use_sudo=True)
 
-        for precomp in self.precompilers:
-            precomp.compile()
+        with cuisine_sudo(), cd(code_root):
+            cuisine.run(self.stream_codec.untar_command(remote_archive_path))
+            file_delete(remote_archive_path)
 
-        # clear old archives
-        local_dirs_delete(self.project_local_path, '%s%s.*' % (temp_dir_prefix, self.project_name))
+    @django_check_config
+    def upload_code(self, update_submodules=True):
+        self.before_upload_code()
+
+        # we need to ensure the directory is open for writing
+        with cuisine_sudo():
+            dir_attribs(self.remote_project_path, mode='777')
+
+        dirs = self.scm.dirs(include_submodules=update_submodules)
+        deployed = self.deployed_revisions() if self.incremental_upload else dict()
+        changes = self.code_changes(dirs, deployed) if self.incremental_upload else None
+        # a full upload replaces everything, so only the uploaded dirs are recorded
+        revisions = dict(deployed) if changes is not None else dict()
+        revisions.update(self.scm.revisions(include_submodules=update_submodules))
+
+        if changes is not None:
+            changed_count = sum(len(changed) for changed, deleted in changes.values())
+            deleted_count = sum(len(deleted) for changed, deleted in changes.values())
+            print("Incremental upload: %d changed file(s), %d deleted file(s)" % (changed_count, deleted_count))
+
+        # the old release keeps serving until the new one is ready
+        if self.use_releases:
+            code_root = self.create_release()
+            if changes is not None:
+                with cuisine_sudo():
+                    cuisine.run("cp -a %s/. %s" % (self.current_release_path, code_root))
+        else:
+            code_root = path(self.remote_project_path)
+
+        if self.stream_upload:
+            self.stream_code(code_root, dirs, changes)
+        else:
+            self.transfer_archives(code_root, changes, update_submodules)
+
+        with cuisine_sudo():
+            cuisine.dir_attribs(code_root, mode="777", recursive=True)
+            self.write_revisions(code_root, revisions)
+
+        if self.local_precompile:
+            self.upload_precompiled(code_root)
+        else:
+            for precomp in self.precompilers:
+                precomp.root = code_root
+                # unchanged outputs are taken from the release that is serving now
+                precomp.previous_root = self.current_release_path if self.use_releases else None
+            run_precompilers(self.precompilers, daemon=self.compiler_daemon)
+
+        # the stack reloads the code after the upload
+        if self.use_releases:
+            self.switch_release(code_root.name, reload=False)
+            self.prune_releases()
+
+        cuisine.run("cd %s" % self.src_root)
+        cuisine.run("pwd")
 
         ## upload ends here
         self.after_upload_code()
@@ -727,17 +1353,38 @@ class DjangoManager:
             |
             |    WSGIScriptAlias / $wsgi_handler_path
             |
-            |    WSGIDaemonProcess $project_name
-            |    WSGIProcessGroup %{GLOBAL}
+            |    WSGIDaemonProcess $project_name $wsgi_daemon_options
+            |    WSGIProcessGroup $wsgi_process_group
+            |    WSGIApplicationGroup %{GLOBAL}
+            |    $wsgi_import_script
             |
             |</VirtualHost>
             """)
 
     @django_check_config
     def create_apache_config(self):
-
-
-        return cuisine.text_template(self.apache_template, self.__dict__)
+        context = dict(self.__dict__, wsgi_daemon_options=self.wsgi_daemon_options(), wsgi_import_script='')
+        if self.wsgi_preload and self.wsgi_daemon_mode():
+            context['wsgi_import_script'] = "WSGIImportScript %s process-group=%s application-group=%%{GLOBAL}" % (
+                self.wsgi_handler_path, self.wsgi_process_group)
+        return cuisine.text_template(self.apache_template, context)
+
+    def wsgi_processes_for_host(self):
+        cpus = cuisine.probe("host", "nproc", "nproc", int)
+        memory = cuisine.probe("host", "memory", "grep MemTotal /proc/meminfo",
+            lambda out: int(out.split()[1]) / 1024)
+        return max(1, min(cpus, memory / 2 / self.wsgi_process_memory))
+
+    def wsgi_daemon_options(self):
+        options = [
+            ('processes', self.wsgi_processes or self.wsgi_processes_for_host()),
+            ('threads', self.wsgi_threads),
+            ('maximum-requests', self.wsgi_maximum_requests),
+            ('inactivity-timeout', self.wsgi_inactivity_timeout),
+            ('queue-timeout', self.wsgi_queue_timeout),
+            ('display-name', '%{GROUP}'),
+        ]
+        return " ".join("%s=%s" % (name, value) for name, value in options if value is not None)
 
 
     wsgi_template = cuisine.text_strip_margin(
@@ -774,8 +1421,33 @@ class DjangoManager:
         |
         |os.environ['DJANGO_SETTINGS_MODULE'] = '$settings_module'
         |
+        |$wsgi_setup_code
         |import django.core.handlers.wsgi
         |application = django.core.handlers.wsgi.WSGIHandler()
+        |$wsgi_preload_code
+        """)
+
+    # the apps are loaded before the handler is created (Django 1.7+)
+    wsgi_setup_template = cuisine.text_strip_margin(
+        """
+        |import django
+        |if hasattr(django, 'setup'):
+        |    django.setup()
+        """)
+
+    # preloads everything the first request would load
+    wsgi_preload_template = cuisine.text_strip_margin(
+        """
+        |if getattr(application, '_request_middleware', None) is None:
+        |    application.load_middleware()
+        |
+        |from django.core import urlresolvers
+        |resolver = urlresolvers.get_resolver(None)
+        |resolver.url_patterns
+        |resolver.reverse_dict
+        |
+        |for module_name in $wsgi_preload_modules:
+        |    __import__(module_name)
         """)
 
     @django_check_config
@@ -798,20 +1470,44 @@ class DjangoManager:
         else:
             virtualenv_path = ''
 
+        if self.wsgi_preload:
+            wsgi_setup_code = self.wsgi_setup_template
+            wsgi_preload_code = cuisine.text_template(self.wsgi_preload_template,
+                {'wsgi_preload_modules': repr(list(self.wsgi_preload_modules))})
+        else:
+            wsgi_setup_code = wsgi_preload_code = ''
+
         if self.env_path:
             context = self.settings.__dict__
             context.update(self.__dict__.copy())
             context['virtualenv_path'] = virtualenv_path
+            context['wsgi_setup_code'] = wsgi_setup_code
+            context['wsgi_preload_code'] = wsgi_preload_code
             return cuisine.text_template(self.wsgi_template, context)
         else:
             raise RuntimeError("Properties env_path and $project_local_path should be set to configure web server")
 
 
+    def wsgi_daemon_mode(self):
+        return self.wsgi_process_group != '%{GLOBAL}'
+
+    def reload_code(self):
+        """
+        Makes the webserver load the new Python code: touches the WSGI handler in daemon mode, the daemon
+        processes restart on the next request, otherwise reloads the webserver gracefully.
+        """
+        if self.wsgi_daemon_mode():
+            with cuisine_sudo():
+                cuisine.run("touch %s" % self.wsgi_handler_path)
+        else:
+            self.webserver.reload()
+
     @django_check_config
     def configure_wsgi(self):
         wsgi_handler = self.create_wsgi_handler()
-        cuisine.file_write(self.wsgi_handler_path, wsgi_handler)
+        changed = cuisine.file_write(self.wsgi_handler_path, wsgi_handler)
         print(wsgi_handler)
+        return changed
 
 
     @django_check_config
@@ -831,8 +1527,8 @@ class DjangoManager:
 
         tmpl = cuisine.text_strip_margin(
             """
-            |media_full_path="${folder}/${project_name}_media_`date +%s`.tar.gz"
-            |tar -cvzf $media_full_path ${media_root}
+            |media_full_path="${folder}/${project_name}_media_`date +%s`.tar${suffix}"
+            |cd ${media_root} && tar -cf - . | ${compress} > $media_full_path
             |echo $media_full_path | env python /usr/local/bin/s3.py
             |rm $media_full_path
             """)
@@ -840,7 +1536,9 @@ class DjangoManager:
         context = {
             'project_name': self.project_name,
             'media_root': self.media_root,
-            'folder': folder
+            'folder': folder,
+            'suffix': self.compressor.suffix,
+            'compress': self.compressor.compress_command(),
         }
 
         return cuisine.text_template(tmpl, context)
@@ -1,14 +1,20 @@
 from functools import wraps
+import shutil
+import tempfile
 import unittest
-from fabric.operations import local
+from fabric.api import settings, hide
+from fabric.operations import local, _AttributeString
 from fabric.state import env
 import os
 import getpass
 from fabric.tasks import execute
 from bount import cuisine
 from bount.cuisine import run
-from bount.managers import PythonManager
-from managers import PostgresManager
+from bount.managers import PythonManager, GitManager, ArchiveCache
+from bount.precompilers import Precompiler
+from managers import PostgresManager, ConfigurationException, ApacheManagerForUbuntu, DjangoManager
+import managers
+from path import path
 
 __author__ = 'mturilin'
 
@@ -64,3 +70,277 @@ class PostgresTest(unittest.TestCase):
 
         self.assertNotEquals(a, None)
         self.assertRegexpMatches(a, "\\d+\\.\\d+")
+
+    def test_dump_format(self):
+        self.assertRaises(ConfigurationException, PostgresManager, "aaa", "bbb", "ccc", dump_format="custom")
+
+        cuisine.run = lambda arg: "16"
+        self.assertEquals(PostgresManager("aaa", "bbb", "ccc", dump_format="directory").jobs(), 16)
+        self.assertEquals(PostgresManager("aaa", "bbb", "ccc", dump_format="directory", dump_jobs=4).jobs(), 4)
+
+
+
+class GitTest(unittest.TestCase):
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        self.git("init -q")
+        self.write("a.py", "a = 1")
+        self.write("b.py", "b = 1")
+        self.first_commit = self.commit("first")
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def git(self, command, dir=''):
+        return local("cd %s && git -c user.name=bount -c user.email=bount@localhost %s" %
+                     (os.path.join(self.repo_dir, dir), command), capture=True)
+
+    def write(self, name, content):
+        with open(os.path.join(self.repo_dir, name), 'w') as file:
+            file.write(content)
+
+    def commit(self, message):
+        self.git("add -A")
+        self.git("commit -q -m %s" % message)
+        return self.git("rev-parse HEAD")
+
+    def test_changes(self):
+        self.write("a.py", "a = 2")
+        self.write("c.py", "c = 1")
+        os.remove(os.path.join(self.repo_dir, "b.py"))
+        self.commit("second")
+
+        git_manager = GitManager(self.repo_dir)
+
+        self.assertEquals(git_manager.revisions(), {'': self.git("rev-parse HEAD")})
+        self.assertEquals(git_manager.changes('', self.first_commit), (['a.py', 'c.py'], ['b.py']))
+        self.assertEquals(git_manager.changes('', "0" * 40), None)
+
+    def test_archive_command_fails_with_git(self):
+        git_manager = GitManager(self.repo_dir)
+        self.assertEquals(local("cd %s && %s | tar -tzf -" % (self.repo_dir, git_manager.archive_command(
+            compress="gzip")), capture=True).split(), ['a.py', 'b.py'])
+
+        with settings(warn_only=True):
+            result = local("cd %s && %s > /dev/null" % (self.repo_dir, git_manager.archive_command(
+                ['missing.py'], "gzip")), capture=True)
+        self.assertTrue(result.failed)
+
+    def test_local_export(self):
+        self.write("a.py", "a = 2")
+        export_dir = tempfile.mkdtemp()
+        try:
+            GitManager(self.repo_dir).local_export(export_dir)
+            self.assertEquals(sorted(os.listdir(export_dir)), ['a.py', 'b.py'])
+            with open(os.path.join(export_dir, "a.py")) as file:
+                self.assertEquals(file.read(), "a = 1")
+        finally:
+            shutil.rmtree(export_dir)
+
+    def test_local_precompile(self):
+        os.mkdir(os.path.join(self.repo_dir, "js"))
+        self.write("js/app.js", "app = 1")
+        self.commit("js")
+        self.write("js/app.js", "app = 2")
+
+        django = DjangoManager("proj", "/srv/proj", self.repo_dir, "/srv/proj/site",
+                               precompilers=[CopyPrecompiler("js", "compiled")], local_precompile=True)
+        build_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build_dir)
+        django.local_precompile_root = path(build_dir).joinpath("proj")
+
+        with settings(hide('running', 'stdout')):
+            django.precompile_locally()
+            archive_path = django.precompiled_archive_path()
+            self.assertTrue(os.path.exists(archive_path))
+            # HEAD is compiled, not the working tree
+            self.assertEquals(local("tar -xzOf %s ./compiled/app.js" % archive_path, capture=True), "app = 1")
+
+            # the next host gets the same archive
+            os.utime(archive_path, (1, 1))
+            django.precompile_locally()
+            self.assertEquals(os.stat(archive_path).st_mtime, 1)
+
+            self.commit("edit")
+            django.precompile_locally()
+            self.assertFalse(os.path.exists(archive_path))
+            self.assertEquals(local("tar -xzOf %s ./compiled/app.js" % django.precompiled_archive_path(),
+                                    capture=True), "app = 2")
+
+    def test_archive_basename(self):
+        git_manager = GitManager(self.repo_dir)
+        names = [git_manager.archive_basename(dir, 'aaa') for dir in ('', 'root', 'a/b', 'a_b', 'a%2Fb')]
+        self.assertEquals(names[:3], ['gitarchive_root_aaa.zip', 'gitarchive_sub_root_aaa.zip',
+                                      'gitarchive_sub_a%2Fb_aaa.zip'])
+        self.assertEquals(len(set(names)), len(names))
+
+    def test_local_archive(self):
+        os.mkdir(os.path.join(self.repo_dir, "lib"))
+        self.git("init -q", "lib")
+        self.write("lib/lib.py", "lib = 1")
+        self.git("add -A", "lib")
+        self.git("commit -q -m lib", "lib")
+        self.write(".gitmodules", '[submodule "lib"]\n\tpath = lib\n\turl = ../lib\n')
+        self.commit("submodule")
+
+        archive_dir = tempfile.mkdtemp()
+        try:
+            git_manager = GitManager(self.repo_dir)
+            files = git_manager.local_archive(archive_dir)
+
+            self.assertEquals(files, {
+                '': 'gitarchive_root_%s.zip' % self.git("rev-parse HEAD^{tree}"),
+                'lib': 'gitarchive_sub_lib_%s.zip' % self.git("rev-parse HEAD^{tree}", "lib"),
+            })
+            self.assertEquals(sorted(os.listdir(archive_dir)), sorted(files.values()))
+            self.assertEquals(git_manager.local_archive(archive_dir, include_submodules=False), {'': files['']})
+        finally:
+            shutil.rmtree(archive_dir)
+
+
+class CopyPrecompiler(Precompiler):
+    def prepare(self):
+        super(CopyPrecompiler, self).prepare()
+        return [(input, self.abs_dir_to().joinpath(input.basename())) for input in self.abs_dir_from().files()]
+
+    def command(self, input, output):
+        return "cp %s %s" % (input, output)
+
+
+class ArchiveCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = ArchiveCache(os.path.join(self.temp_dir, 'cache'), max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def archive(self, name, content):
+        archive_path = os.path.join(self.temp_dir, name)
+        with open(archive_path, 'w') as file:
+            file.write(content)
+        return archive_path
+
+    def test_get_put(self):
+        target = os.path.join(self.temp_dir, 'target.zip')
+
+        self.assertFalse(self.cache.get('/repo', 'aaa', target))
+        self.cache.put('/repo', 'aaa', self.archive('a.zip', '12345'))
+
+        self.assertFalse(self.cache.get('/other_repo', 'aaa', target))
+        self.assertTrue(self.cache.get('/repo', 'aaa', target))
+        with open(target) as file:
+            self.assertEquals(file.read(), '12345')
+
+    def test_lru_eviction(self):
+        target = os.path.join(self.temp_dir, 'target.zip')
+        self.cache.put('/repo', 'aaa', self.archive('a.zip', '1234'))
+        self.cache.put('/repo', 'bbb', self.archive('b.zip', '1234'))
+        os.utime(self.cache.archive_path('/repo', 'aaa'), (1, 1))
+        os.utime(self.cache.archive_path('/repo', 'bbb'), (2, 2))
+
+        # touches aaa, so bbb is the least recently used one
+        self.assertTrue(self.cache.get('/repo', 'aaa', target))
+        self.cache.put('/repo', 'ccc', self.archive('c.zip', '1234'))
+
+        self.assertTrue(os.path.exists(self.cache.archive_path('/repo', 'aaa')))
+        self.assertFalse(os.path.exists(self.cache.archive_path('/repo', 'bbb')))
+        self.assertTrue(os.path.exists(self.cache.archive_path('/repo', 'ccc')))
+
+
+class ApacheTest(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        self.saved_sudo = managers.sudo
+        self.saved_run = managers.run
+
+    def tearDown(self):
+        managers.sudo = self.saved_sudo
+        managers.run = self.saved_run
+
+    def fake_run(self, output, failed):
+        def run(command):
+            result = _AttributeString(output)
+            result.failed = failed
+            result.succeeded = not failed
+            return result
+        return run
+
+    def fake_sudo(self, failed_command):
+        def sudo(command):
+            self.commands.append(command)
+            result = _AttributeString("Syntax error on line 1" if command == failed_command else "Syntax OK")
+            result.failed = command == failed_command
+            return result
+        return sudo
+
+    def test_reload_is_tested(self):
+        managers.sudo = self.fake_sudo(None)
+        ApacheManagerForUbuntu().reload()
+        self.assertEquals(self.commands, ["apache2ctl configtest 2>&1", "service apache2 reload"])
+
+    def test_broken_config_is_not_loaded(self):
+        managers.sudo = self.fake_sudo("apache2ctl configtest 2>&1")
+        self.assertRaises(ConfigurationException, ApacheManagerForUbuntu().reload)
+        self.assertEquals(self.commands, ["apache2ctl configtest 2>&1"])
+
+    def test_status(self):
+        managers.run = self.fake_run("Apache2 is running (pid 1234).", False)
+        self.assertEquals(ApacheManagerForUbuntu().status(), "running")
+        managers.run = self.fake_run("Apache2 is NOT running.", True)
+        self.assertEquals(ApacheManagerForUbuntu().status(), "stopped")
+        managers.run = self.fake_run("Apache2 is NOT running.", False)
+        self.assertEquals(ApacheManagerForUbuntu().status(), "stopped")
+
+
+class DjangoBackupScriptTest(unittest.TestCase):
+    def test_media_backup_uses_compressor(self):
+        django = DjangoManager("proj", "/srv/proj", "/tmp/proj", "/srv/proj/site", media_root="/srv/proj/media",
+                               compressor="zstd")
+        script = django.create_backup_script("/backups")
+        self.assertIn('media_full_path="/backups/proj_media_`date +%s`.tar.zst"', script)
+        self.assertIn("cd /srv/proj/media && tar -cf - . | zstd -3 -T0 -q -c > $media_full_path", script)
+        self.assertNotIn("tar -cv", script)
+
+
+class WsgiOptionsTest(unittest.TestCase):
+    def setUp(self):
+        cuisine.facts_flush()
+        cuisine.fact_set("host", "nproc", 8)
+
+    def tearDown(self):
+        cuisine.facts_flush()
+
+    def django_manager(self, **wsgi_options):
+        return DjangoManager("proj", "/srv/proj", "/tmp/proj", "/srv/proj/site", wsgi_options=wsgi_options)
+
+    def test_processes_from_host(self):
+        cuisine.fact_set("host", "memory", 1024)
+        self.assertEquals(self.django_manager().wsgi_daemon_options(),
+            "processes=2 threads=5 maximum-requests=1000 inactivity-timeout=300 "
+            "display-name=%{GROUP}")
+
+        cuisine.fact_set("host", "memory", 64 * 1024)
+        self.assertTrue(self.django_manager().wsgi_daemon_options().startswith("processes=8 "))
+
+    def test_options(self):
+        django = self.django_manager(processes=3, queue_timeout=45)
+        self.assertEquals(django.wsgi_daemon_options(),
+            "processes=3 threads=5 maximum-requests=1000 inactivity-timeout=300 queue-timeout=45 "
+            "display-name=%{GROUP}")
+        self.assertRaises(ConfigurationException, self.django_manager, thread=10)
+
+    def test_preload(self):
+        cuisine.fact_set("host", "memory", 1024)
+        django = DjangoManager("proj", "/srv/proj", "/tmp/proj", "/srv/proj/site", src_root="/srv/proj/src",
+            media_root="/srv/proj/media", media_url="/media/", static_root="/srv/proj/static", static_url="/static/",
+            server_admin="admin@example.com", settings=type("Settings", (object,), {})(),
+            wsgi_options=dict(preload=True, preload_modules=["app.signals"]))
+        django.webserver = ApacheManagerForUbuntu()
+        django.python = type("Python", (object,), {"get_short_version": lambda self: "2.7"})()
+
+        self.assertTrue("WSGIImportScript /srv/proj/site/wsgi_handler.py process-group=proj" in
+                        django.create_apache_config())
+        handler = django.create_wsgi_handler()
+        self.assertTrue(handler.index("django.setup()") < handler.index("WSGIHandler()"))
+        self.assertTrue("for module_name in ['app.signals']:" in handler)
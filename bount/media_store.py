@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import time
+from bount.utils import write_atomic
+
+__author__ = 'mturilin'
+
+
+class MediaStoreException(StandardError):
+    pass
+
+
+class MediaStore(object):
+    """
+    Deduplicated backup store for media dirs. Files are split into fixed size chunks, every chunk is stored
+    once under its SHA-256, so a snapshot costs only the chunks that are not in the store yet.
+
+    Layout:
+    - objects/ab/abcd... - chunks
+    - snapshots/<name>.json - manifest of a snapshot: path, size, mtime, mode and chunks of every file
+    - index.json - snapshots in the order they were taken, the last one is the latest
+
+    Only regular files are stored, symlinks and empty dirs are skipped.
+    """
+
+    def __init__(self, root, chunk_size=4 * 1024 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.objects_dir = os.path.join(root, 'objects')
+        self.snapshots_dir = os.path.join(root, 'snapshots')
+        self.index_path = os.path.join(root, 'index.json')
+
+    def snapshots(self):
+        """
+        Returns the index: a list of {name, created, files, size} dicts, oldest first.
+        """
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path) as index_file:
+            return json.load(index_file)
+
+    def latest(self):
+        snapshots = self.snapshots()
+        return snapshots[-1]['name'] if snapshots else None
+
+    def manifest(self, name):
+        manifest_path = os.path.join(self.snapshots_dir, "%s.json" % name)
+        if not os.path.exists(manifest_path):
+            raise MediaStoreException("Snapshot not found: %s" % name)
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def put_chunk(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            if not os.path.exists(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path))
+            write_atomic(object_path, data)
+        return digest
+
+    def put_file(self, file_path):
+        chunks = []
+        with open(file_path, 'rb') as source_file:
+            for data in iter(lambda: source_file.read(self.chunk_size), ''):
+                chunks.append(self.put_chunk(data))
+        return chunks
+
+    def walk(self, source_dir):
+        for dir_path, dir_names, file_names in os.walk(source_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                if os.path.isfile(file_path) and not os.path.islink(file_path):
+                    yield os.path.relpath(file_path, source_dir).replace(os.sep, '/'), file_path
+
+    def snapshot(self, source_dir, name):
+        """
+        Stores the content of source_dir as a new snapshot. Files with the same size and mtime as in the
+        latest snapshot are not read again.
+        """
+        for dir in (self.objects_dir, self.snapshots_dir):
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+
+        if any(snapshot['name'] == name for snapshot in self.snapshots()):
+            raise MediaStoreException("Snapshot already exists: %s" % name)
+
+        latest = self.latest()
+        previous = dict((entry['path'], entry) for entry in self.manifest(latest)['files']) if latest else {}
+
+        files = []
+        for relative_path, file_path in self.walk(source_dir):
+            stat = os.stat(file_path)
+            entry = previous.get(relative_path)
+            if not entry or entry['size'] != stat.st_size or entry['mtime'] != int(stat.st_mtime):
+                entry = dict(path=relative_path, size=stat.st_size, mtime=int(stat.st_mtime),
+                             chunks=self.put_file(file_path))
+            entry['mode'] = stat.st_mode & 0777
+            files.append(entry)
+
+        created = time.time()
+        write_atomic(os.path.join(self.snapshots_dir, "%s.json" % name),
+                     json.dumps(dict(name=name, created=created, files=files)))
+
+        # the index is written last, so a snapshot is never listed before its manifest and chunks exist
+        index = self.snapshots()
+        index.append(dict(name=name, created=created, files=len(files), size=sum(entry['size'] for entry in files)))
+        write_atomic(self.index_path, json.dumps(index, indent=1))
+        return name
+
+    def restore(self, name, target_dir):
+        """
+        Makes target_dir match the snapshot. Files with the snapshot's size and mtime are left as they are,
+        the files that are not in the snapshot are deleted.
+        """
+        files = self.manifest(name)['files']
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+
+        snapshot_paths = set(entry['path'] for entry in files)
+        for relative_path, file_path in list(self.walk(target_dir)):
+            if relative_path not in snapshot_paths:
+                os.remove(file_path)
+
+        for entry in files:
+            file_path = os.path.join(target_dir, *entry['path'].split('/'))
+            if os.path.exists(file_path):
+                stat = os.stat(file_path)
+                if stat.st_size == entry['size'] and int(stat.st_mtime) == entry['mtime']:
+                    os.chmod(file_path, entry['mode'])
+                    continue
+
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'wb') as target_file:
+                for digest in entry['chunks']:
+                    with open(self.object_path(digest), 'rb') as chunk_file:
+                        target_file.write(chunk_file.read())
+            os.chmod(file_path, entry['mode'])
+            os.utime(file_path, (entry['mtime'], entry['mtime']))
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+from bount.media_store import MediaStore, MediaStoreException
+
+__author__ = 'mturilin'
+
+
+class MediaStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.media_dir = os.path.join(self.temp_dir, 'media')
+        self.store = MediaStore(os.path.join(self.temp_dir, 'store'), chunk_size=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, root, name, content):
+        file_path = os.path.join(root, name)
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'w') as file:
+            file.write(content)
+
+    def read(self, root, name):
+        with open(os.path.join(root, name)) as file:
+            return file.read()
+
+    def objects(self):
+        return sum(len(file_names) for dir_path, dir_names, file_names in os.walk(self.store.objects_dir))
+
+    def test_snapshots_are_deduplicated(self):
+        self.write(self.media_dir, 'a.txt', 'aaaabbbb')
+        self.write(self.media_dir, 'img/b.txt', 'aaaa')
+        self.store.snapshot(self.media_dir, 'first')
+        self.assertEquals(self.objects(), 2)
+
+        self.write(self.media_dir, 'img/c.txt', 'bbbbcccc')
+        self.store.snapshot(self.media_dir, 'second')
+        self.assertEquals(self.objects(), 3)
+
+        self.assertEquals([snapshot['name'] for snapshot in self.store.snapshots()], ['first', 'second'])
+        self.assertEquals(self.store.latest(), 'second')
+        self.assertRaises(MediaStoreException, self.store.snapshot, self.media_dir, 'second')
+
+    def test_restore(self):
+        self.write(self.media_dir, 'a.txt', 'first version')
+        self.store.snapshot(self.media_dir, 'first')
+        self.write(self.media_dir, 'a.txt', 'second version')
+        self.write(self.media_dir, 'img/b.txt', 'new file')
+        self.store.snapshot(self.media_dir, 'second')
+
+        target_dir = os.path.join(self.temp_dir, 'target')
+        self.store.restore('second', target_dir)
+        self.assertEquals(self.read(target_dir, 'a.txt'), 'second version')
+        self.assertEquals(self.read(target_dir, 'img/b.txt'), 'new file')
+
+        self.store.restore('first', target_dir)
+        self.assertEquals(self.read(target_dir, 'a.txt'), 'first version')
+        self.assertFalse(os.path.exists(os.path.join(target_dir, 'img', 'b.txt')))
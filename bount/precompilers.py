@@ -1,31 +1,247 @@
+import hashlib
+import json
+import pipes
+import posixpath
+import re
+import struct
+import subprocess
+from StringIO import StringIO
 from bount import memorize
 from bount import cuisine
 from bount.cuisine import dir_ensure
 from bount.cuisine import file_exists
 from fabric.context_managers import cd
 from path import path
-from utils import local_ls_re, ls_re, remote_home
+from utils import remote_home, remote_exec_stream
 
 __author__ = 'mturilin'
 
 
+class PrecompilerException(StandardError):
+    pass
+
+
+def sudo_mode():
+    """
+    Context for the commands that need root on the server, local compiles run as the current user.
+    """
+    if cuisine.mode == cuisine.MODE_LOCAL:
+        return cuisine.cuisine_local()
+    return cuisine.cuisine_sudo()
+
+
+def run_parallel(commands, jobs=None):
+    """
+    Runs the shell commands in one xargs job, jobs (the number of CPUs by default) at a time. Fails if any of
+    the commands fails.
+    """
+    if not commands:
+        return
+    jobs = jobs or cuisine.probe("host", "nproc", "getconf _NPROCESSORS_ONLN", int)
+
+    with sudo_mode():
+        if len(commands) == 1:
+            cuisine.run(commands[0])
+            return
+
+        job_file = cuisine.run("mktemp").strip()
+        try:
+            cuisine.file_write(job_file, "\n".join(commands) + "\n")
+            cuisine.run("tr '\\n' '\\0' < %s | xargs -0 -n 1 -P %d sh -c" % (job_file, jobs))
+        finally:
+            cuisine.run("rm -f %s" % job_file)
+            cuisine.facts_invalidate(name=job_file)
+
+
+def file_hashes(dir, find_expression='', names=None):
+    """
+    Returns {relative path: sha256} of the files in dir that match the find expression, or of the listed
+    names (relative to dir, the missing files are left out). One command for all the files.
+    """
+    hashes = dict()
+    # Mac OS has shasum instead of sha256sum
+    hash_command = "sh -c 'sha256sum \"$@\" 2>/dev/null || shasum -a 256 \"$@\" 2>/dev/null' sh"
+    if names is None:
+        command = "cd %s && find . %s -type f -exec %s {} + ; true" % (dir, find_expression, hash_command)
+    else:
+        command = "cd %s && %s %s ; true" % (dir, hash_command, " ".join(pipes.quote(name) for name in names))
+    for line in cuisine.run(command).splitlines():
+        parts = line.strip().split(None, 1)
+        if len(parts) == 2:
+            hashes[posixpath.normpath(parts[1])] = parts[0]
+    return hashes
+
+
+def encode_frame(message):
+    body = json.dumps(message)
+    return struct.pack('>I', len(body)) + body
+
+
+def decode_frames(data):
+    messages = []
+    offset = 0
+    while offset + 4 <= len(data):
+        length, = struct.unpack('>I', data[offset:offset + 4])
+        if offset + 4 + length > len(data):
+            break
+        messages.append(json.loads(data[offset + 4:offset + 4 + length]))
+        offset += 4 + length
+    if offset != len(data):
+        raise PrecompilerException("Incomplete message from the compiler daemon")
+    return messages
+
+
+class CompilerDaemon(object):
+    """
+    Compiles the files of all the precompilers in one Node process (compiler_daemon.js), so Node and the
+    compilers start once per deploy and the LESS imports are read once. The files are sent to the process
+    stdin as JSON requests framed with a 4-byte length, the results come back the same way from stdout.
+    """
+    script_name = 'compiler_daemon.js'
+    # the script needs a native Promise
+    min_node_version = (0, 12)
+
+    def __init__(self, node='node'):
+        self.node = node
+
+    def node_version(self):
+        """
+        Returns the version of the host's Node as a tuple of ints, () if Node is not installed.
+        """
+        return cuisine.probe("node", self.node, "%s --version 2> /dev/null || true" % self.node,
+                             lambda output: tuple(int(part) for part in re.findall(r"\d+", output)[:3]))
+
+    def supported(self):
+        return self.node_version() >= self.min_node_version
+
+    def script_path(self):
+        if cuisine.mode == cuisine.MODE_LOCAL:
+            return path(__file__).abspath().dirname().joinpath(self.script_name)
+        return path(remote_home()).joinpath('.bount').joinpath(self.script_name)
+
+    def upload(self):
+        if cuisine.mode == cuisine.MODE_LOCAL:
+            return
+        with open(path(__file__).abspath().dirname().joinpath(self.script_name)) as script_file:
+            dir_ensure(self.script_path().dirname(), recursive=True)
+            cuisine.file_write(self.script_path(), script_file.read())
+
+    def command(self):
+        # compilers installed globally or into the home dir (see LessPrecompiler.setup)
+        command = 'env NODE_PATH="$(npm root -g 2>/dev/null):$HOME/node_modules:$NODE_PATH" %s %s' % (
+            self.node, self.script_path())
+        # the outputs belong to the same user as the ones of run_parallel (sudo_mode), the channel has no
+        # tty for a password prompt
+        if cuisine.mode != cuisine.MODE_LOCAL:
+            command = "sudo -n " + command
+        return command
+
+    def compile(self, files):
+        """
+        files - [(compiler, input, output)], compiler is 'less' or 'coffee'. Raises PrecompilerException
+        with the errors of all the files that failed.
+        """
+        if not files:
+            return
+        self.upload()
+
+        requests = "".join(encode_frame(dict(id=id, compiler=compiler, input=str(input), output=str(output)))
+                           for id, (compiler, input, output) in enumerate(files))
+
+        if cuisine.mode == cuisine.MODE_LOCAL:
+            process = subprocess.Popen(self.command(), shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output, error = process.communicate(requests)
+            if process.returncode != 0:
+                raise PrecompilerException("Compiler daemon failed with status %d" % process.returncode)
+        else:
+            stdout = StringIO()
+            remote_exec_stream(self.command(), stdin=StringIO(requests), stdout=stdout)
+            output = stdout.getvalue()
+
+        responses = decode_frames(output)
+        if len(responses) != len(files):
+            raise PrecompilerException("Compiler daemon answered %d of %d files" % (len(responses), len(files)))
+        errors = [response['error'] for response in sorted(responses, key=lambda response: response['id'])
+                  if response['error']]
+        if errors:
+            raise PrecompilerException("Compilation failed:\n%s" % "\n".join(errors))
+
+
+def run_precompilers(precompilers, jobs=None, daemon=None):
+    """
+    Compiles with all the precompilers at once: the files of all of them go to the same parallel job, or
+    to the daemon (CompilerDaemon) if the precompiler supports it.
+    """
+    files = []
+    for precompiler in precompilers:
+        files.extend((precompiler, input, output) for input, output in precompiler.prepare())
+    print("Precompiling %d file(s)" % len(files))
+
+    if daemon and not daemon.supported():
+        print("The compiler daemon needs Node %s or newer, found %s, compiling every file in its own process" % (
+            ".".join(map(str, daemon.min_node_version)), ".".join(map(str, daemon.node_version())) or "none"))
+        daemon = None
+
+    if daemon:
+        daemon.compile([(precompiler.compiler, input, output)
+                        for precompiler, input, output in files if precompiler.compiler])
+    run_parallel([precompiler.command(input, output)
+                  for precompiler, input, output in files if not (daemon and precompiler.compiler)], jobs)
+
+    for precompiler in precompilers:
+        precompiler.finish()
+
+    for precompiler in precompilers:
+        if precompiler.post_processor:
+            precompiler.post_processor.process(precompiler.abs_dir_to(), jobs)
+
 
 class Precompiler(object):
     """
     Server side file compiler
     """
-    def __init__(self, dir_from, dir_to, root=None):
+    # name of the compiler in compiler_daemon.js, None if the daemon can't compile the files
+    compiler = None
+
+    def __init__(self, dir_from, dir_to, root=None, post_processor=None):
         """
         dir_from, dir_to - relative from project_root paths for the directories
+        post_processor - PostProcessor for the compiled files
         """
         self.dir_from = dir_from
         self.dir_to = dir_to
         self.root = root
+        self.post_processor = post_processor
+        # root for dir_to if the outputs don't go next to the sources (local precompile)
+        self.output_root = None
+        # root of the previous release, its outputs are reused when the inputs didn't change
+        self.previous_root = None
 
     def compile(self):
-        dir_ensure(self.abs_dir_to())
+        run_precompilers([self])
         return self.dir_to
 
+    def prepare(self):
+        """
+        Creates dir_to and returns [(input, output)] - absolute paths of the files to compile. The files are
+        compiled in parallel.
+        """
+        with sudo_mode():
+            dir_ensure(self.abs_dir_to(), mode='777', recursive=True)
+        return []
+
+    def command(self, input, output):
+        """
+        The shell command that compiles input into output.
+        """
+        raise NotImplementedError('Method is not implemented')
+
+    def finish(self):
+        """
+        Called after all the files are compiled.
+        """
+        pass
+
     def get_os_dependencies(args):
         return []
 
@@ -36,14 +252,47 @@ class Precompiler(object):
         return path(self.root).joinpath(self.dir_from)
 
     def abs_dir_to(self):
-        return path(self.root).joinpath(self.dir_to)
+        return path(self.output_root or self.root).joinpath(self.dir_to)
+
+    def previous_dir_to(self):
+        return path(self.previous_root or self.output_root or self.root).joinpath(self.dir_to)
 
     def setup(self):
         pass
 
 
+LESS_IMPORT_RE = re.compile(r"""@import\s*(?:\([^)]*\)\s*)?(?:url\(\s*)?["']([^"']+)["']""")
+
+
+def less_imports(file_name, line):
+    """
+    Returns the .less files imported in the line of file_name, relative to the same dir as file_name.
+    """
+    imports = []
+    for target in LESS_IMPORT_RE.findall(line):
+        if target.endswith('.css') or '://' in target:
+            continue
+        if not posixpath.splitext(target)[1]:
+            target += '.less'
+        imports.append(posixpath.normpath(posixpath.join(posixpath.dirname(file_name), target)))
+    return imports
+
+
+def dependency_closure(graph, name):
+    closure = set()
+    stack = [name]
+    while stack:
+        current = stack.pop()
+        if current not in closure:
+            closure.add(current)
+            stack.extend(graph.get(current, ()))
+    return closure
+
+
 
 class LessPrecompiler(Precompiler):
+    compiler = 'less'
+
     def get_os_dependencies(args):
         return [
             'npm'
@@ -61,48 +310,292 @@ class LessPrecompiler(Precompiler):
 
             with cd('~'):
                 cuisine.run("sudo npm install less")
+            cuisine.facts_invalidate("file", self.lessc_path())
         else:
             print ("Less is already installed")
 
-    @memorize
     def lessc_path(self):
+        # on the workstation lessc is taken from PATH
+        if cuisine.mode == cuisine.MODE_LOCAL:
+            return 'lessc'
+        return self.remote_lessc_path()
+
+    @memorize
+    def remote_lessc_path(self):
         return "%s/node_modules/less/bin/lessc" % remote_home()
-#        return 'lessc'
 
+    manifest_name = '.bount_less_manifest'
 
-    def compile(self):
-        super(LessPrecompiler, self).compile()
-        abs_dir_from = self.abs_dir_from()
+    def scan(self):
+        """
+        Returns ({file: sha256}, {file: [imported files]}) for the .less files in dir_from and the files they
+        import from outside of it. Two commands for the tree, then two for every level of the outside
+        imports. The paths are relative to dir_from, the imports that are not found have no hash.
+        """
+        hashes = file_hashes(self.abs_dir_from(), "-name '*.less'")
+        graph = dict((name, []) for name in hashes)
+        self.scan_imports(graph, "grep -r --include='*.less' -H '@import' .")
+
+        pending = self.unscanned_imports(graph)
+        while pending:
+            hashes.update(file_hashes(self.abs_dir_from(), names=pending))
+            graph.update((name, []) for name in pending)
+            found = [name for name in pending if name in hashes]
+            if found:
+                self.scan_imports(graph, "grep -H '@import' %s" % " ".join(pipes.quote(name) for name in found))
+            pending = self.unscanned_imports(graph)
+
+        return hashes, graph
+
+    def scan_imports(self, graph, grep_command):
+        for line in cuisine.run("cd %s && %s ; true" % (self.abs_dir_from(), grep_command)).splitlines():
+            file_name, separator, text = line.partition(':')
+            file_name = posixpath.normpath(file_name)
+            if separator and file_name in graph:
+                graph[file_name].extend(less_imports(file_name, text))
+
+    def unscanned_imports(self, graph):
+        return sorted(set(name for imports in graph.values() for name in imports if name not in graph))
+
+    def entry_points(self, graph):
+        """
+        The top level .less files that are not imported by the other files. Partials start with '_'.
+        """
+        imported = set(name for imports in graph.values() for name in imports)
+        return sorted(name for name in graph
+                      if '/' not in name and not name.startswith('_') and name not in imported)
+
+    def digests(self, hashes, graph):
+        """
+        Returns {entry point: digest of all the files it includes}. The digest is None if an included file
+        wasn't found (lessc may find it on its include paths), such entry points are always compiled.
+        """
+        digests = dict()
+        for entry in self.entry_points(graph):
+            closure = sorted(dependency_closure(graph, entry))
+            if any(name not in hashes for name in closure):
+                digests[entry] = None
+                continue
+            digest = hashlib.sha256(self.lessc_path())
+            for name in closure:
+                digest.update("%s %s\n" % (name, hashes[name]))
+            digests[entry] = digest.hexdigest()
+        return digests
+
+    def read_manifest(self, dir):
+        content = cuisine.run("cat %s 2>/dev/null ; true" % dir.joinpath(self.manifest_name))
+        try:
+            return json.loads(content)
+        except ValueError:
+            return dict()
+
+    def command(self, input, output):
+        return '%s %s %s' % (self.lessc_path(), input, output)
+
+    def prepare(self):
+        """
+        Returns the entry points whose inputs changed since the previous compile, the other outputs are
+        taken from the previous release.
+        """
+        super(LessPrecompiler, self).prepare()
         abs_dir_to = self.abs_dir_to()
+        previous_dir_to = self.previous_dir_to()
+
+        hashes, graph = self.scan()
+        self.digests_to_save = self.digests(hashes, graph)
+        previous = self.read_manifest(previous_dir_to)
 
-        with cuisine.cuisine_sudo():
-            dir_ensure(abs_dir_to, mode='777', recursive=True)
+        unchanged = sorted(entry for entry, digest in self.digests_to_save.iteritems()
+                           if digest is not None and previous.get(entry) == digest)
+        changed = sorted(entry for entry in self.digests_to_save if entry not in unchanged)
+        print("LESS: %d changed, %d unchanged entry point(s)" % (len(changed), len(unchanged)))
 
-        for a_file in ls_re(abs_dir_from, '.*\\.less'):
-            cuisine.sudo('%(lessc_path)s %(dir_from)s/%(basename)s.less %(dir_to)s/%(basename)s.css' % \
-             {
-                 'lessc_path': self.lessc_path(),
-                 'dir_from': abs_dir_from,
-                 'dir_to': abs_dir_to,
-                 'basename': a_file[:-5]
-             })
+        if unchanged and previous_dir_to != abs_dir_to:
+            with sudo_mode():
+                cuisine.run("cd %s && cp -p %s %s/" % (previous_dir_to,
+                    " ".join("%s.css" % entry[:-5] for entry in unchanged), abs_dir_to))
+
+        return [(self.abs_dir_from().joinpath(entry), abs_dir_to.joinpath("%s.css" % entry[:-5])) for entry in changed]
+
+    def finish(self):
+        # the manifest is written only when all the outputs are there
+        with sudo_mode():
+            cuisine.file_write(self.abs_dir_to().joinpath(self.manifest_name),
+                               json.dumps(self.digests_to_save, indent=1, sort_keys=True))
 
 
 class CoffeePrecompiler(Precompiler):
+    compiler = 'coffee'
+
     def get_os_dependencies(args):
         return [
             'coffeescript'
         ]
 
-    def compile(self):
-        super(CoffeePrecompiler, self).compile()
-
+    def prepare(self):
+        """
+        All the .coffee files, the sub dirs of dir_from are kept in dir_to.
+        """
+        super(CoffeePrecompiler, self).prepare()
         abs_dir_from = self.abs_dir_from()
         abs_dir_to = self.abs_dir_to()
 
-        with cuisine.cuisine_sudo():
-            dir_ensure(abs_dir_to, mode='777', recursive=True)
-        
-        cuisine.sudo('sudo coffee --compile --output %(abs_dir_to)s %(abs_dir_from)s' % {'abs_dir_from': abs_dir_from, 'abs_dir_to': abs_dir_to})
+        files = cuisine.run("cd %s && find . -name '*.coffee' -type f ; true" % abs_dir_from).splitlines()
+        names = sorted(posixpath.normpath(name.strip()) for name in files if name.strip())
+        return [(abs_dir_from.joinpath(name), abs_dir_to.joinpath("%s.js" % name[:-7])) for name in names]
+
+    def command(self, input, output):
+        return 'coffee --compile --output %s %s' % (output.dirname(), input)
+
+
+class PostProcessor(object):
+    """
+    Optional stage after a precompiler. It minifies the .css and .js files of dir_to into x.min.css, copies
+    them to names with the content hash (x.0123456789ab.css) and writes .gz and .br copies next to them.
+    manifest.json in dir_to maps the original names to the names to serve, so the templates can resolve
+    them. Minified and compressed files are made again only when their source is newer. The hashed files
+    of the current and of the previous manifest are kept, the older ones are removed.
+    """
+    extensions = ('.css', '.js')
+    minify_commands = {
+        '.css': '%(cleancss)s -o %(output)s %(input)s',
+        '.js': '%(uglifyjs)s %(input)s -c -m -o %(output)s',
+    }
+    node_packages = ['clean-css-cli', 'uglify-js']
+
+    def __init__(self, minify=True, fingerprint=True, gzip=True, brotli=False, hash_length=12,
+                 manifest_name='manifest.json'):
+        self.minify = minify
+        self.fingerprint = fingerprint
+        self.gzip = gzip
+        self.brotli = brotli
+        self.hash_length = hash_length
+        self.manifest_name = manifest_name
+        self.hashed_name_re = re.compile(r'\.[0-9a-f]{%d}\.[^.]+$' % hash_length)
+
+    def get_os_dependencies(self):
+        return (['npm'] if self.minify else []) + (['brotli'] if self.brotli else [])
+
+    def setup(self):
+        if self.minify and not file_exists(self.node_bin('uglifyjs')):
+            print("Installing the minifiers")
+            with cd('~'):
+                cuisine.run("sudo npm install %s" % " ".join(self.node_packages))
+            cuisine.facts_invalidate("file", self.node_bin('uglifyjs'))
+
+    def node_bin(self, name):
+        # on the workstation the tools are taken from PATH
+        if cuisine.mode == cuisine.MODE_LOCAL:
+            return name
+        return self.remote_node_bin(name)
+
+    @memorize
+    def remote_node_bin(self, name):
+        return "%s/node_modules/.bin/%s" % (remote_home(), name)
+
+    def files(self, dir):
+        return set(posixpath.normpath(name.strip())
+                   for name in cuisine.run("cd %s && find . -type f ; true" % dir).splitlines() if name.strip())
+
+    def sources(self, dir):
+        """
+        The .css and .js files of dir without the files made by the post processor.
+        """
+        names = self.files(dir)
+        sources = []
+        for name in names:
+            base, extension = posixpath.splitext(name)
+            if extension not in self.extensions or self.hashed_name_re.search(name):
+                continue
+            if base.endswith('.min') and base[:-4] + extension in names:
+                continue
+            sources.append(name)
+        return sorted(sources)
+
+    def minify_command(self, input, output):
+        command = self.minify_commands[posixpath.splitext(input)[1]] % {
+            'input': input,
+            'output': "%s.tmp" % output,
+            'cleancss': self.node_bin('cleancss'),
+            'uglifyjs': self.node_bin('uglifyjs'),
+        }
+        return "test %(output)s -nt %(input)s || (%(command)s && mv %(output)s.tmp %(output)s)" % {
+            'input': input, 'output': output, 'command': command}
+
+    def compress_commands(self, file):
+        commands = []
+        if self.gzip:
+            commands.append("(test %(file)s.gz -nt %(file)s || (gzip -9 -n -c %(file)s > %(file)s.gz.tmp && "
+                            "mv %(file)s.gz.tmp %(file)s.gz))" % {'file': file})
+        if self.brotli:
+            commands.append("(test %(file)s.br -nt %(file)s || (brotli -f -q 11 -o %(file)s.br.tmp %(file)s && "
+                            "mv %(file)s.br.tmp %(file)s.br))" % {'file': file})
+        return commands
+
+    def read_manifest(self, dir):
+        content = cuisine.run("cat %s 2>/dev/null ; true" % dir.joinpath(self.manifest_name))
+        try:
+            return json.loads(content)
+        except ValueError:
+            return dict()
+
+    def prune(self, dir, keep):
+        """
+        Removes the hashed files of dir and their .gz and .br copies, except for the names in keep.
+        """
+        stale = []
+        for name in sorted(self.files(dir)):
+            base, extension = posixpath.splitext(name)
+            hashed = base if extension in ('.gz', '.br') else name
+            if self.hashed_name_re.search(hashed) and hashed not in keep:
+                stale.append(name)
+        if stale:
+            print("Removing %d outdated hashed file(s)" % len(stale))
+            with sudo_mode():
+                cuisine.run("cd %s && rm -f %s" % (dir, " ".join(pipes.quote(name) for name in stale)))
+
+    def process(self, dir, jobs=None):
+        """
+        Returns {name: name to serve} for the .css and .js files of dir.
+        """
+        sources = self.sources(dir)
+        served = dict((name, name) for name in sources)
+
+        if self.minify:
+            commands = []
+            for name in sources:
+                base, extension = posixpath.splitext(name)
+                if not base.endswith('.min'):
+                    served[name] = "%s.min%s" % (base, extension)
+                    commands.append(self.minify_command(dir.joinpath(name), dir.joinpath(served[name])))
+            print("Minifying %d file(s)" % len(commands))
+            run_parallel(commands, jobs)
+
+        commands = []
+        hashes = dict()
+        if self.fingerprint:
+            hashes = file_hashes(dir, "\\( %s \\)" % " -o ".join("-name '*%s'" % extension
+                                                                  for extension in self.extensions))
+        for name in sources:
+            steps = []
+            if self.fingerprint:
+                base, extension = posixpath.splitext(served[name])
+                if base.endswith('.min'):
+                    base = base[:-4]
+                hashed = "%s.%s%s" % (base, hashes[served[name]][:self.hash_length], extension)
+                steps.append("(test -f %(hashed)s || cp -p %(file)s %(hashed)s)" % {
+                    'file': dir.joinpath(served[name]), 'hashed': dir.joinpath(hashed)})
+                served[name] = hashed
+            steps.extend(self.compress_commands(dir.joinpath(served[name])))
+            if steps:
+                commands.append(" && ".join(steps))
+        run_parallel(commands, jobs)
 
+        if self.fingerprint:
+            # the pages rendered with the previous manifest may still be open, so its files are kept too
+            self.prune(dir, set(served.values()) | set(self.read_manifest(dir).values()))
 
+        if self.minify or self.fingerprint:
+            with sudo_mode():
+                cuisine.file_write(dir.joinpath(self.manifest_name), json.dumps(served, indent=1, sort_keys=True))
+        return served
@@ -0,0 +1,327 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from fabric.context_managers import settings, hide
+from path import path
+from bount import cuisine
+from bount.cuisine import cuisine_local
+from bount.precompilers import LessPrecompiler, CoffeePrecompiler, less_imports, dependency_closure, run_parallel, \
+    run_precompilers, CompilerDaemon, PrecompilerException, encode_frame, decode_frames, PostProcessor
+
+__author__ = 'mturilin'
+
+
+class LessDependencyTest(unittest.TestCase):
+    def test_less_imports(self):
+        self.assertEquals(less_imports('theme/main.less', '@import "vars";'), ['theme/vars.less'])
+        self.assertEquals(less_imports('main.less', "@import (reference) '../lib/mixins.less';"), ['../lib/mixins.less'])
+        self.assertEquals(less_imports('main.less', '@import url("grid.less");'), ['grid.less'])
+        self.assertEquals(less_imports('main.less', '@import "reset.css";'), [])
+        self.assertEquals(less_imports('main.less', '@import "http://cdn/x.less";'), [])
+
+    def test_entry_points_and_closure(self):
+        graph = {
+            'site.less': ['_vars.less', 'parts/grid.less'],
+            'admin.less': ['_vars.less'],
+            '_vars.less': [],
+            'parts/grid.less': ['parts/mixins.less', 'site.less'],
+            'parts/mixins.less': [],
+            'shared.less': [],
+        }
+        precompiler = LessPrecompiler('less', 'css')
+        # site.less is imported by grid.less, so the only entry points are admin.less and shared.less
+        self.assertEquals(precompiler.entry_points(graph), ['admin.less', 'shared.less'])
+        self.assertEquals(dependency_closure(graph, 'parts/grid.less'),
+                          set(['parts/grid.less', 'parts/mixins.less', 'site.less', '_vars.less']))
+
+
+class LessIncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.temp_dir, 'lessc.log')
+
+        # fake lessc: copies the input and logs the call
+        self.lessc_path = os.path.join(self.temp_dir, 'lessc')
+        with open(self.lessc_path, 'w') as lessc:
+            lessc.write('#!/bin/sh\necho "$1" >> %s\ncat "$1" > "$2"\n' % self.log_path)
+        os.chmod(self.lessc_path, 0755)
+
+    def tearDown(self):
+        cuisine.facts_flush()
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, root, name, content):
+        file_path = os.path.join(root, 'less', name)
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'w') as file:
+            file.write(content)
+
+    def compile(self, root, previous_root=None, output_root=None):
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+        precompiler = LessPrecompiler('less', 'css', root)
+        precompiler.previous_root = previous_root
+        precompiler.output_root = output_root
+        precompiler.lessc_path = lambda: self.lessc_path
+        with settings(hide('running', 'stdout')), cuisine_local():
+            precompiler.compile()
+
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path) as log:
+            return sorted(os.path.basename(line.strip()) for line in log)
+
+    def test_only_changed_entry_points_are_compiled(self):
+        first = os.path.join(self.temp_dir, 'first')
+        self.write(first, 'site.less', '@import "_vars";\nsite\n')
+        self.write(first, 'admin.less', 'admin\n')
+        self.write(first, '_vars.less', 'vars\n')
+        self.assertEquals(self.compile(first), ['admin.less', 'site.less'])
+        self.assertEquals(self.compile(first), [])
+
+        # a new release with a changed partial, admin.css comes from the first release
+        second = os.path.join(self.temp_dir, 'second')
+        shutil.copytree(os.path.join(first, 'less'), os.path.join(second, 'less'))
+        self.write(second, '_vars.less', 'new vars\n')
+        self.assertEquals(self.compile(second, previous_root=first), ['site.less'])
+
+        with open(os.path.join(second, 'css', 'admin.css')) as css:
+            self.assertEquals(css.read(), 'admin\n')
+        self.assertFalse(os.path.exists(os.path.join(second, 'css', '_vars.css')))
+
+    def test_imports_outside_of_dir_from(self):
+        root = os.path.join(self.temp_dir, 'root')
+        self.write(root, 'site.less', '@import "../lib/mixins";\nsite\n')
+        self.write(root, 'admin.less', '@import "missing";\nadmin\n')
+        self.write(root, '../lib/mixins.less', '@import "colors";\n')
+        self.write(root, '../lib/colors.less', 'red\n')
+        self.assertEquals(self.compile(root), ['admin.less', 'site.less'])
+        # the entry point with a missing import is always compiled
+        self.assertEquals(self.compile(root), ['admin.less'])
+
+        self.write(root, '../lib/colors.less', 'blue\n')
+        self.assertEquals(self.compile(root), ['admin.less', 'site.less'])
+
+    def test_output_root(self):
+        source = os.path.join(self.temp_dir, 'source')
+        build = os.path.join(self.temp_dir, 'build')
+        self.write(source, 'site.less', 'site\n')
+        self.assertEquals(self.compile(source, output_root=build), ['site.less'])
+        self.assertEquals(self.compile(source, output_root=build), [])
+
+        self.assertTrue(os.path.exists(os.path.join(build, 'css', 'site.css')))
+        self.assertFalse(os.path.exists(os.path.join(source, 'css')))
+
+
+class RunParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        cuisine.facts_flush()
+        shutil.rmtree(self.temp_dir)
+
+    def test_all_commands_run(self):
+        commands = ["echo %d > %s/%d.txt" % (i, self.temp_dir, i) for i in range(10)]
+        with settings(hide('running', 'stdout')), cuisine_local():
+            run_parallel(commands, jobs=4)
+
+        self.assertEquals(sorted(os.listdir(self.temp_dir)), sorted("%d.txt" % i for i in range(10)))
+
+    def test_failure(self):
+        with settings(hide('everything')), cuisine_local():
+            self.assertRaises(SystemExit, run_parallel, ["true", "false", "true"], 2)
+
+
+# minimal stand-ins for the less and coffeescript modules: less inlines the imports through the file manager
+FAKE_LESS = """
+var fs = require('fs'), path = require('path');
+function FileManager() {}
+FileManager.prototype.loadFile = function (filename, currentDirectory) {
+    global.lessReads = (global.lessReads || 0) + 1;
+    var file = path.join(currentDirectory, filename);
+    return Promise.resolve({filename: file, contents: fs.readFileSync(file, 'utf8')});
+};
+exports.FileManager = FileManager;
+exports.render = function (source, options) {
+    var managers = [];
+    options.plugins.forEach(function (plugin) {
+        plugin.install(exports, {addFileManager: function (manager) { managers.push(manager); }});
+    });
+    var imports = [], re = /@import "([^"]+)";/g, match;
+    while ((match = re.exec(source))) {
+        imports.push(managers[0].loadFile(match[1], path.dirname(options.filename), {}, {}));
+    }
+    if (source.indexOf('error') >= 0) {
+        return Promise.reject({message: 'broken', filename: options.filename, line: 1});
+    }
+    return Promise.all(imports).then(function (files) {
+        var css = source.replace(re, '');
+        files.forEach(function (file) { css = file.contents + css; });
+        return {css: css + '/* reads: ' + global.lessReads + ' */'};
+    });
+};
+"""
+
+FAKE_COFFEE = """
+exports.compile = function (source) { return '// js\\n' + source; };
+"""
+
+
+class CompilerDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        for name, source in (('less', FAKE_LESS), ('coffeescript', FAKE_COFFEE)):
+            os.makedirs(os.path.join(self.temp_dir, 'node_modules', name))
+            with open(os.path.join(self.temp_dir, 'node_modules', name, 'index.js'), 'w') as module:
+                module.write(source)
+        self.saved_node_path = os.environ.get('NODE_PATH')
+        os.environ['NODE_PATH'] = os.path.join(self.temp_dir, 'node_modules')
+
+    def tearDown(self):
+        if self.saved_node_path is None:
+            del os.environ['NODE_PATH']
+        else:
+            os.environ['NODE_PATH'] = self.saved_node_path
+        cuisine.facts_flush()
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, content):
+        file_path = os.path.join(self.temp_dir, name)
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'w') as file:
+            file.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.temp_dir, name)) as file:
+            return file.read()
+
+    def test_node_version(self):
+        daemon = CompilerDaemon()
+        with cuisine_local():
+            cuisine.fact_set("node", "node", (0, 10, 48))
+            self.assertFalse(daemon.supported())
+            cuisine.fact_set("node", "node", (4, 2, 6))
+            self.assertTrue(daemon.supported())
+
+            with settings(hide('running', 'stdout')):
+                self.assertEquals(CompilerDaemon('/nonexistent/node').node_version(), ())
+                self.assertFalse(CompilerDaemon('/nonexistent/node').supported())
+
+    def test_command_user(self):
+        daemon = CompilerDaemon()
+        daemon.script_path = lambda: '/home/deploy/.bount/compiler_daemon.js'
+        with cuisine_local():
+            self.assertTrue(daemon.command().startswith('env NODE_PATH='))
+        with cuisine.cuisine_sudo():
+            self.assertTrue(daemon.command().startswith('sudo -n env NODE_PATH='))
+            self.assertTrue(daemon.command().endswith(' node /home/deploy/.bount/compiler_daemon.js'))
+
+    def test_frames(self):
+        messages = [dict(id=1, error=None), dict(id=2, error=u"broken")]
+        self.assertEquals(decode_frames("".join(encode_frame(message) for message in messages)), messages)
+        self.assertRaises(PrecompilerException, decode_frames, encode_frame(messages[0])[:-1])
+
+    @unittest.skipUnless(find_executable('node'), "node is not installed")
+    def test_compile(self):
+        self.write('less/_vars.less', 'vars;')
+        self.write('less/site.less', '@import "_vars.less";site;')
+        self.write('less/admin.less', '@import "_vars.less";admin;')
+        self.write('coffee/app/main.coffee', 'main')
+
+        precompilers = [LessPrecompiler('less', 'css', self.temp_dir), CoffeePrecompiler('coffee', 'js', self.temp_dir)]
+        with settings(hide('running', 'stdout')), cuisine_local():
+            run_precompilers(precompilers, daemon=CompilerDaemon())
+
+        # the partial is read once for both files
+        self.assertEquals(self.read('css/admin.css'), 'vars;admin;/* reads: 1 */')
+        self.assertEquals(self.read('css/site.css'), 'vars;site;/* reads: 1 */')
+        self.assertEquals(self.read('js/app/main.js'), '// js\nmain')
+
+    @unittest.skipUnless(find_executable('node'), "node is not installed")
+    def test_errors(self):
+        self.write('less/site.less', 'error;')
+        daemon = CompilerDaemon()
+        with settings(hide('running', 'stdout')), cuisine_local():
+            try:
+                source = os.path.join(self.temp_dir, 'less/site.less')
+                daemon.compile([('less', source, os.path.join(self.temp_dir, 'site.css')),
+                                ('sass', source, os.path.join(self.temp_dir, 'site.css'))])
+                self.fail("PrecompilerException is expected")
+            except PrecompilerException, e:
+                self.assertTrue('site.less:1: broken' in str(e))
+                self.assertTrue('Unknown compiler: sass' in str(e))
+
+
+class PostProcessorTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.processor = PostProcessor()
+        # fake minifier: removes the spaces
+        self.processor.minify_commands = {
+            '.css': "tr -d ' ' < %(input)s > %(output)s",
+            '.js': "tr -d ' ' < %(input)s > %(output)s",
+        }
+
+    def tearDown(self):
+        cuisine.facts_flush()
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, content):
+        file_path = os.path.join(self.temp_dir, name)
+        if not os.path.exists(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'w') as file:
+            file.write(content)
+
+    def process(self):
+        with settings(hide('running', 'stdout')), cuisine_local():
+            return self.processor.process(path(self.temp_dir))
+
+    def test_process(self):
+        self.write('site.css', 'a { color: red }')
+        self.write('js/app.js', 'var a = 1;')
+        self.write('js/jquery.min.js', 'jquery')
+        self.write('.bount_less_manifest', '{}')
+
+        served = self.process()
+        self.assertEquals(sorted(served.keys()), ['js/app.js', 'js/jquery.min.js', 'site.css'])
+        self.assertTrue(re.match(r'^site\.[0-9a-f]{12}\.css$', served['site.css']))
+        self.assertTrue(re.match(r'^js/jquery\.[0-9a-f]{12}\.js$', served['js/jquery.min.js']))
+
+        with open(os.path.join(self.temp_dir, served['site.css'])) as css:
+            self.assertEquals(css.read(), 'a{color:red}')
+        compressed = gzip.open(os.path.join(self.temp_dir, served['js/app.js'] + '.gz'))
+        self.assertEquals(compressed.read(), 'vara=1;')
+        compressed.close()
+
+        with open(os.path.join(self.temp_dir, 'manifest.json')) as manifest:
+            self.assertEquals(json.load(manifest), served)
+
+        # the generated files are not processed again
+        self.assertEquals(self.process(), served)
+
+        self.write('site.css', 'a { color: blue }')
+        self.assertNotEquals(self.process()['site.css'], served['site.css'])
+
+    def test_prune(self):
+        self.write('site.css', 'a { color: red }')
+        first = self.process()['site.css']
+        self.write('site.css', 'a { color: blue }')
+        second = self.process()['site.css']
+        self.write('site.css', 'a { color: green }')
+        third = self.process()['site.css']
+
+        # the files of the current and of the previous manifest are kept
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, first)))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, first + '.gz')))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, second + '.gz')))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, third + '.gz')))
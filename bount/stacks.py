@@ -1,16 +1,23 @@
 from axel import Event
 from django.utils.importlib import import_module
 from fabric.context_managers import cd, lcd
+from fabric.contrib.project import rsync_project
+from fabric.decorators import runs_once
 from fabric.operations import get, put
+from fabric.state import env
 import os
 from managers import SqliteManager
 from path import path
 import sys
 from bount import timestamp_str
 from bount import cuisine
+from bount.catalog import DumpCatalog
+from bount.compressors import get_compressor, compressor_for_file
 from bount.cuisine import dir_ensure, cuisine_sudo, dir_attribs, sudo, run
+from bount.executors import RollingExecutor
+from bount.media_store import MediaStore
 from bount.managers import UbuntuManager, PythonManager, ApacheManagerForUbuntu, DjangoManager, PostgresManager, ConfigurationException
-from bount.utils import local_dir_ensure, file_delete, remote_home, dir_delete
+from bount.utils import local_dir_ensure, file_delete, remote_home, dir_delete, local_file_delete, remote_exec_stream, StreamProgress
 
 __author__ = 'mturilin'
 
@@ -31,12 +38,21 @@ class Stack(object):
     def upload(self, update_submodules=True):
         raise NotImplementedError('Method is not implemented')
 
+    def precompile(self):
+        """
+        Runs once per deploy before the code is uploaded to the hosts.
+        """
+        pass
+
     def configure_webserver(self):
         raise NotImplementedError('Method is not implemented')
 
     def start_restart_webserver(self):
         raise NotImplementedError('Method is not implemented')
 
+    def reload_webserver(self):
+        raise NotImplementedError('Method is not implemented')
+
     def stop_webserver(self):
         raise NotImplementedError('Method is not implemented')
 
@@ -82,6 +98,9 @@ class Stack(object):
     def django_manage(self, command):
         raise NotImplementedError('Method is not implemented')
 
+    def rollback(self):
+        raise NotImplementedError('Method is not implemented')
+
 #    def update_local_media(self):
 #        raise NotImplementedError('Method is not implemented')
 
@@ -116,6 +135,8 @@ class DalkStack(Stack):
     5. Dakl stack creates ./site directory in the project dir to place WSGI config file and virtualenv
     6. Logging dir will be created if settings or remote specific settings (from symlink) contain
     LOGGING_PATH variable
+    7. With use_releases=True the code is uploaded to releases/<timestamp> and served through the 'current'
+    symlink, media, static and site dirs stay in the project dir and are shared by the releases
 
     """
     ubuntu = None
@@ -125,8 +146,29 @@ class DalkStack(Stack):
     apache = None
 
     def __init__(self, settings_module, dependencies_path, project_name, source_root, use_virtualenv,
-                 local_backup_dir='backup', precompilers=None, ubuntu_dependencies_path=None):
+                 local_backup_dir='backup', precompilers=None, ubuntu_dependencies_path=None,
+                 use_releases=False, keep_releases=5, incremental_upload=False, stream_upload=False,
+                 stream_codec='gzip', archive_cache_size=None, db_dump_format='plain', db_dump_jobs=None,
+                 stream_db_dump=False, compressor='gzip', media_sync=False, media_sync_archive=False,
+                 media_store=False, keep_dumps=None, wsgi_options=None, local_precompile=False,
+                 compiler_daemon=False):
         self.precompilers = precompilers or []
+        # local_precompile - compile on the workstation and upload the outputs, no compilers on the servers
+        self.local_precompile = local_precompile
+        # stream_db_dump - transfer database dumps over the SSH channel without temp files on the server
+        self.stream_db_dump = stream_db_dump
+        # compressor - codec name or Compressor for database and media dumps, see bount.compressors
+        self.compressor = get_compressor(compressor)
+        # media_sync - media snapshots and restores rsync only the changed files through a local mirror dir,
+        # media_sync_archive - also pack the mirror into a tarball as a point-in-time copy
+        # media_store - keep media snapshots in a deduplicated store instead of tarballs, the transfers are
+        # synced like with media_sync
+        self.media_sync = media_sync or media_store
+        self.media_sync_archive = media_sync_archive
+        # keep_dumps - number of the newest database and media dumps kept in the local backup dir
+        # wsgi_options - mod_wsgi daemon settings: processes, threads, maximum_requests, inactivity_timeout,
+        # queue_timeout, process_memory, process_group, preload and preload_modules, see DjangoManager
+        self.keep_dumps = keep_dumps
 
         self.ubuntu = UbuntuManager()
         if ubuntu_dependencies_path:
@@ -152,8 +194,20 @@ class DalkStack(Stack):
                 "ntp"
             ]
 
-        for precomp in self.precompilers:
-            self.ubuntu.dependencies += precomp.get_os_dependencies()
+        if not local_precompile:
+            for precomp in self.precompilers:
+                self.ubuntu.dependencies += precomp.get_os_dependencies()
+                if precomp.post_processor:
+                    self.ubuntu.dependencies += precomp.post_processor.get_os_dependencies()
+
+        codec_packages = [self.compressor.package]
+        if stream_upload:
+            codec_packages.append(get_compressor(stream_codec).package)
+        if self.media_sync:
+            codec_packages.append('rsync')
+        for package in codec_packages:
+            if package and package not in self.ubuntu.dependencies:
+                self.ubuntu.dependencies.append(package)
 
         self.apache = ApacheManagerForUbuntu()
 
@@ -168,7 +222,8 @@ class DalkStack(Stack):
         # SRC - a directory containing settings.py will be considered src path for the server
         # override if necessary
         src_relative_path = path(project_local_path).relpathto(source_root)
-        remote_src_path = path(remote_proj_path).joinpath(src_relative_path)
+        remote_code_path = path(remote_proj_path).joinpath('current') if use_releases else path(remote_proj_path)
+        remote_src_path = remote_code_path.joinpath(src_relative_path)
 
         # remote site path is a directory containing wsgi handler. Also it's recommended to put there
         #
@@ -191,11 +246,16 @@ class DalkStack(Stack):
         except IndexError:
             server_admin = 'NOBODY'
 
+        # compiler_daemon - compile all the files in one Node process, see bount.precompilers.CompilerDaemon
         self.django = DjangoManager(project_name, remote_proj_path, project_local_path, remote_site_path,
             remote_src_path, settings_module=settings_module,
             use_virtualenv=use_virtualenv, virtualenv_path=remote_site_path,
             media_root=media_root, media_url=media_url, static_root=static_root, static_url=static_url,
-            server_admin=server_admin, precompilers=precompilers, settings=settings)
+            server_admin=server_admin, precompilers=precompilers, settings=settings,
+            use_releases=use_releases, keep_releases=keep_releases, incremental_upload=incremental_upload,
+            stream_upload=stream_upload, stream_codec=stream_codec, archive_cache_size=archive_cache_size,
+            wsgi_options=wsgi_options, local_precompile=local_precompile, compiler_daemon=compiler_daemon,
+            compressor=self.compressor)
 
         self.django.webserver = self.apache
 
@@ -212,6 +272,9 @@ class DalkStack(Stack):
                 database_name=settings.DATABASES['default']['NAME'],
                 user=settings.DATABASES['default']['USER'],
                 password=settings.DATABASES['default']['PASSWORD'],
+                dump_format=db_dump_format,
+                dump_jobs=db_dump_jobs,
+                compressor=self.compressor,
             )
         elif 'sqlite' in settings.DATABASES['default']['ENGINE']:
             self.database = SqliteManager('')
@@ -225,6 +288,9 @@ class DalkStack(Stack):
         self.local_backup_dir = path(project_local_path).joinpath(local_backup_dir)
         self.local_db_dump_dir = self.local_backup_dir.joinpath('db_dump')
         self.local_media_dump_dir = self.local_backup_dir.joinpath('media_dump')
+        self.local_media_mirror_dir = self.local_backup_dir.joinpath('media_mirror')
+        self.media_store = MediaStore(self.local_backup_dir.joinpath('media_store')) if media_store else None
+        self.catalog = DumpCatalog(self.local_backup_dir)
 
 
         # Python manage
@@ -250,8 +316,12 @@ class DalkStack(Stack):
 
     def setup_precompilers(self):
         super(DalkStack, self).setup_precompilers()
+        if self.local_precompile:
+            return
         for precomp in self.precompilers:
             precomp.setup()
+            if precomp.post_processor:
+                precomp.post_processor.setup()
 
 
     def init_database(self):
@@ -265,6 +335,10 @@ class DalkStack(Stack):
     def restart_webserver(self):
         self.apache.restart()
 
+    def precompile(self):
+        if self.local_precompile:
+            self.django.precompile_locally()
+
     def upload(self, update_submodules=True):
         self.django.upload_code(update_submodules)
 
@@ -273,20 +347,37 @@ class DalkStack(Stack):
 
 
     def configure_webserver(self):
-        self.django.configure_wsgi()
-        self.apache.configure_webserver(self.django.project_name, self.django.create_apache_config(),
-            delete_other_sites=True)
+        """
+        Returns True if the WSGI handler or the webserver config was changed.
+        """
+        wsgi_changed = self.django.configure_wsgi()
+        webserver_changed = self.apache.configure_webserver(self.django.project_name,
+            self.django.create_apache_config(), delete_other_sites=True)
+        return wsgi_changed or webserver_changed
 
     def start_restart_webserver(self):
         self.apache.restart()
 
+    def reload_webserver(self):
+        """
+        The cheapest correct way to serve the new code: starts the webserver if the upload stopped it,
+        otherwise reloads the code without dropping requests.
+        """
+        if self.apache.status() == "running":
+            self.django.reload_code()
+        else:
+            self.apache.start()
+
     def _create_db_backup_name(self):
-        return "%s_db_%s.sql.gz" %\
+        if self.database.dump_format == 'directory':
+            return "%s_db_%s.dir" % (self.django.project_name, timestamp_str())
+
+        return "%s_db_%s.sql%s" %\
                (self.django.project_name,
-                timestamp_str())
+                timestamp_str(), self.compressor.suffix)
 
     def backup_database(self):
-        self.database.backup_database(self._create_db_backup_name())
+        self.database.backup_database(self._create_db_backup_name(), zip=True)
 
     def migrate_data(self):
         self.django.migrate_data()
@@ -297,17 +388,106 @@ class DalkStack(Stack):
         remote_dir = "/tmp"
         remote_file_path = "%s/%s" % (remote_dir, remote_file_basename)
 
+        local_dir_ensure(self.local_db_dump_dir)
+
+        if self.stream_db_dump and self.database.dump_format == 'plain':
+            local_file_path = self.local_db_dump_dir.joinpath(remote_file_basename)
+            self._stream_to_local(local_file_path,
+                lambda stdout: self.database.stream_database(stdout, ignore_tables=ignore_tables))
+            self._register_dump('db', local_file_path, self.compressor.name)
+            return
+
         dir_ensure(remote_dir, mode='777')
         self.database.backup_database(remote_file_basename, folder=remote_dir, zip=True, ignore_tables=ignore_tables)
 
-        local_dir_ensure(self.local_db_dump_dir)
+        if self.database.dump_format == 'directory':
+            # the tables are compressed already, so the directory is packed without compression
+            dump_dir_path = remote_file_path
+            remote_file_path = "%s.tar" % dump_dir_path
+            tar_command = "tar -cf - -C %s %s" % (remote_dir, remote_file_basename)
+            # pg_dump creates the directory as postgres with mode 0700, tar runs as the login user
+            with cuisine_sudo():
+                cuisine.run("chown -R %s %s" % (env.user, dump_dir_path))
+
+            if self.stream_db_dump:
+                local_file_path = self.local_db_dump_dir.joinpath("%s.tar" % remote_file_basename)
+                try:
+                    self._stream_to_local(local_file_path, lambda stdout: remote_exec_stream(tar_command, stdout=stdout))
+                finally:
+                    with cuisine_sudo(): dir_delete(dump_dir_path)
+                self._register_dump('db', local_file_path, 'directory')
+                return
+
+            cuisine.run("%s > %s" % (tar_command, remote_file_path))
+            with cuisine_sudo(): dir_delete(dump_dir_path)
+
         get(remote_file_path, self.local_db_dump_dir)
 
         with cuisine_sudo(): file_delete(remote_file_path)
 
+        self._register_dump('db', self.local_db_dump_dir.joinpath(path(remote_file_path).basename()),
+            'directory' if self.database.dump_format == 'directory' else self.compressor.name)
+
+    def _register_dump(self, kind, local_file_path, codec, remote=True):
+        """
+        Adds the dump to the catalog with the code revisions it was taken with, then applies keep_dumps.
+        """
+        if remote:
+            host, revisions = env.host_string, self.django.deployed_revisions()
+        else:
+            host, revisions = 'localhost', self.django.scm.revisions()
+        self.catalog.add(kind, local_file_path, codec=codec, host=host, revisions=revisions)
+        if self.keep_dumps:
+            for name in self.catalog.prune(kind, keep=self.keep_dumps):
+                print("Pruned dump %s" % name)
+
+    def _latest_dump_basename(self, kind, dump_dir):
+        """
+        Returns the latest dump of the kind from the catalog, if it's in dump_dir.
+        """
+        name = self.catalog.latest(kind)
+        if name and path(self.catalog.dump_path(name)).parent.abspath() == path(dump_dir).abspath():
+            return path(name).basename()
+        return None
+
+    def _dump_compressor(self, local_file_path):
+        """
+        The dump is decompressed with the codec it was written with, the stack's compressor may have changed.
+        """
+        entry = self.catalog.get(self.catalog.dump_name(local_file_path))
+        return compressor_for_file(str(local_file_path), entry and entry.get('codec'), self.compressor)
+
+    def _verify_dump(self, local_file_path):
+        name = self.catalog.dump_name(local_file_path)
+        if self.catalog.get(name):
+            self.catalog.verify(name)
+
+    def _stream_to_local(self, local_file_path, stream_function):
+        """
+        Calls stream_function with the local file wrapped into a progress meter. The partial file is deleted
+        if the transfer fails, so it's never taken for the latest dump.
+        """
+        local_file = open(local_file_path, 'wb')
+        progress = StreamProgress(local_file, "Downloading %s" % path(local_file_path).basename())
+        try:
+            stream_function(progress)
+        except:
+            local_file.close()
+            local_file_delete(local_file_path)
+            raise
+
+        local_file.close()
+        progress.finish()
+
     def latest_db_dump_basename(self):
+        latest = self._latest_dump_basename('db', self.local_db_dump_dir)
+        if latest:
+            return latest
+
+        # dumps taken before the catalog was introduced
         sql_file_list = [file for file in os.listdir(self.local_db_dump_dir)
-                         if file.endswith(".sql.gz") and file.startswith(self.django.project_name)]
+                         if file.endswith((".sql%s" % self.compressor.suffix, ".dir.tar"))
+                         and file.startswith(self.django.project_name)]
         if not sql_file_list:
             print("No files found")
 
@@ -317,56 +497,133 @@ class DalkStack(Stack):
     def restore_latest_db_dump(self):
         dump_basename = self.latest_db_dump_basename()
         dump_path = path(self.local_db_dump_dir).joinpath(dump_basename)
-        remote_dump_path = "~/%s" % dump_basename
-
-        put(dump_path, "")
-
-        self.database.init_database(init_sql_file=remote_dump_path, delete_if_exists=True, unzip=True)
+        remote_dump_path = "%s/%s" % (remote_home(), dump_basename)
+        self._verify_dump(dump_path)
+
+        if dump_basename.endswith(".tar"):
+            # directory format dump, restored with pg_restore
+            if self.stream_db_dump:
+                self._stream_from_local(dump_path,
+                    lambda stdin: remote_exec_stream("tar -xf - -C %s" % remote_home(), stdin=stdin))
+            else:
+                put(dump_path, "")
+                cuisine.run("tar -xf %s -C %s" % (remote_dump_path, remote_home()))
+                with cuisine_sudo(): file_delete(remote_dump_path)
+
+            remote_dump_dir = remote_dump_path[:-len(".tar")]
+            self.database.init_database(init_sql_file=remote_dump_dir, delete_if_exists=True)
+            with cuisine_sudo(): dir_delete(remote_dump_dir)
+        elif self.stream_db_dump:
+            self._stream_from_local(dump_path, lambda stdin: self.database.init_database_stream(
+                stdin, delete_if_exists=True, unzip=True, compressor=self._dump_compressor(dump_path)))
+        else:
+            put(dump_path, "")
+            self.database.init_database(init_sql_file=remote_dump_path, delete_if_exists=True, unzip=True,
+                                        compressor=self._dump_compressor(dump_path))
+            with cuisine_sudo(): file_delete(remote_dump_path)
 
         self.django.migrate_data()
 
-        with cuisine_sudo(): file_delete(remote_dump_path)
+    def _stream_from_local(self, local_file_path, stream_function):
+        with open(local_file_path, 'rb') as local_file:
+            progress = StreamProgress(local_file, "Uploading %s" % path(local_file_path).basename())
+            stream_function(progress)
+            progress.finish()
 
     def download_media(self):
-        media_dump_basename = "%s_media_%s.tar.gz" % (self.django.project_name, timestamp_str())
+        if self.media_sync:
+            local_dir_ensure(self.local_media_mirror_dir, recursive=True)
+            rsync_project(remote_dir="%s/" % self.django.media_root, local_dir="%s/" % self.local_media_mirror_dir,
+                delete=True, upload=False)
+            if self.media_store:
+                self.media_store.snapshot(self.local_media_mirror_dir, self._create_media_snapshot_name())
+            elif self.media_sync_archive:
+                self._archive_media_mirror()
+            return
+
+        media_dump_basename = "%s_media_%s.tar%s" % (self.django.project_name, timestamp_str(), self.compressor.suffix)
         media_dump_remote_path = "%s/%s" % (remote_home(), media_dump_basename)
 
         media_dump_local_path = self.local_media_dump_dir.joinpath(media_dump_basename)
 
-        with cd(self.django.media_root): cuisine.run("tar -cvzf %s ." % media_dump_remote_path)
+        with cd(self.django.media_root): cuisine.run(self.compressor.tar_command(media_dump_remote_path))
         cuisine.file_attribs(media_dump_remote_path, '777')
 
         get(media_dump_remote_path, media_dump_local_path)
 
         with cuisine_sudo(): file_delete(media_dump_remote_path)
 
+        self._register_dump('media', media_dump_local_path, self.compressor.name)
+
     def archive_local_media(self):
+        if self.media_store:
+            self.media_store.snapshot(self.local_media_root, self._create_media_snapshot_name())
+            return
+
+        if self.media_sync:
+            local_dir_ensure(self.local_media_mirror_dir, recursive=True)
+            cuisine.local("rsync -a --delete %s/ %s/" % (self.local_media_root, self.local_media_mirror_dir))
+            if self.media_sync_archive:
+                self._archive_media_mirror()
+            return
+
         local_dir_ensure(self.local_media_dump_dir)
 
-        media_dump_basename = "%s_media_%s.tar.gz" % (self.django.project_name, timestamp_str())
+        media_dump_basename = "%s_media_%s.tar%s" % (self.django.project_name, timestamp_str(), self.compressor.suffix)
         media_dump_local_path = self.local_media_dump_dir.joinpath(media_dump_basename)
 
-        with lcd(self.local_media_root): cuisine.local("tar -cvzf %s ." % media_dump_local_path)
+        with lcd(self.local_media_root): cuisine.local(self.compressor.tar_command(media_dump_local_path))
+        self._register_dump('media', media_dump_local_path, self.compressor.name, remote=False)
 
 
+    def _archive_media_mirror(self):
+        local_dir_ensure(self.local_media_dump_dir)
+
+        media_dump_basename = "%s_media_%s.tar%s" % (self.django.project_name, timestamp_str(), self.compressor.suffix)
+        media_dump_local_path = self.local_media_dump_dir.joinpath(media_dump_basename)
+
+        with lcd(self.local_media_mirror_dir): cuisine.local(self.compressor.tar_command(media_dump_local_path))
+        self._register_dump('media', media_dump_local_path, self.compressor.name)
+
+    def _create_media_snapshot_name(self):
+        return "%s_media_%s" % (self.django.project_name, timestamp_str())
+
     def latest_media_dump_basename(self):
+        if self.media_store:
+            return self.media_store.latest()
+
+        latest = self._latest_dump_basename('media', self.local_media_dump_dir)
+        if latest:
+            return latest
+
         upload_file_list = [file for file in os.listdir(self.local_media_dump_dir)
-                            if file.endswith(".tar.gz") and file.startswith("%s_media" % self.django.project_name)]
+                            if file.endswith(".tar%s" % self.compressor.suffix)
+                            and file.startswith("%s_media" % self.django.project_name)]
         if not upload_file_list:
             print("No files found")
         upload_basename = sorted(upload_file_list)[-1]
         return upload_basename
 
     def restore_latest_media(self):
+        if self.media_store:
+            self.media_store.restore(self.latest_media_dump_basename(), self.local_media_mirror_dir)
+
+        if self.media_sync:
+            # the mode is set on the transferred files only, instead of chmod -R over the whole media root
+            rsync_project(remote_dir="%s/" % self.django.media_root, local_dir="%s/" % self.local_media_mirror_dir,
+                extra_opts="--chmod=ugo=rwX")
+            return
+
         dump_basename = self.latest_media_dump_basename()
 
         dump_local_path = self.local_media_dump_dir.joinpath(dump_basename)
         dump_remote_path = path(self.django.media_root).joinpath(dump_basename)
+        self._verify_dump(dump_local_path)
 
         put(str(dump_local_path), str(dump_remote_path), use_sudo=True, mode=0777)
 
         with cd(self.django.media_root):
-            sudo("tar -xvzf %s" % dump_remote_path)
+            sudo(self._dump_compressor(dump_local_path).untar_command(dump_remote_path))
 
         with cuisine_sudo():
             dir_attribs(self.django.media_root, mode='777', recursive=True)
@@ -374,33 +631,56 @@ class DalkStack(Stack):
         with cuisine_sudo(): file_delete(dump_remote_path)
 
     def media_restore_local_latest(self):
+        if self.media_store:
+            self.media_store.restore(self.latest_media_dump_basename(), self.local_media_root)
+            return
+
+        if self.media_sync:
+            local_dir_ensure(self.local_media_root, recursive=True)
+            cuisine.local("rsync -a --delete %s/ %s/" % (self.local_media_mirror_dir, self.local_media_root))
+            return
+
         dump_basename = self.latest_media_dump_basename()
         dump_local_path = self.local_media_dump_dir.joinpath(dump_basename)
+        self._verify_dump(dump_local_path)
 
         dir_delete(self.local_media_root)
         dir_ensure(self.local_media_root)
 
         with cd(self.local_media_root):
-            run("tar -xvzf %s" % dump_local_path)
+            run(self._dump_compressor(dump_local_path).untar_command(dump_local_path))
 
 
     @classmethod
     def build_stack(cls, settings_module, dependencies_path, project_name, source_root,
-                    use_virtualenv=True, precompilers=None, ubuntu_dependencies_path=None):
+                    use_virtualenv=True, precompilers=None, ubuntu_dependencies_path=None,
+                    use_releases=False, keep_releases=5, incremental_upload=False, stream_upload=False,
+                    stream_codec='gzip', archive_cache_size=None, db_dump_format='plain', db_dump_jobs=None,
+                    stream_db_dump=False, compressor='gzip', media_sync=False, media_sync_archive=False,
+                    media_store=False, keep_dumps=None, wsgi_options=None, local_precompile=False,
+                    compiler_daemon=False):
         global current_stack
 
         current_stack = cls(settings_module, dependencies_path, project_name, source_root,
-            use_virtualenv, precompilers=precompilers, ubuntu_dependencies_path=ubuntu_dependencies_path)
+            use_virtualenv, precompilers=precompilers, ubuntu_dependencies_path=ubuntu_dependencies_path,
+            use_releases=use_releases, keep_releases=keep_releases, incremental_upload=incremental_upload,
+            stream_upload=stream_upload, stream_codec=stream_codec, archive_cache_size=archive_cache_size,
+            db_dump_format=db_dump_format, db_dump_jobs=db_dump_jobs, stream_db_dump=stream_db_dump,
+            compressor=compressor, media_sync=media_sync, media_sync_archive=media_sync_archive,
+            media_store=media_store, keep_dumps=keep_dumps, wsgi_options=wsgi_options,
+            local_precompile=local_precompile, compiler_daemon=compiler_daemon)
 
         return current_stack
 
     def enable_debug(self):
-        self.django.set_debug(True)
-        self.restart_webserver()
+        changed, replaced = self.django.set_debug(True)
+        if changed:
+            self.reload_webserver()
 
     def disable_debug(self):
-        self.django.set_debug(False)
-        self.restart_webserver()
+        changed, replaced = self.django.set_debug(False)
+        if changed:
+            self.reload_webserver()
 
     def recreate_database(self):
         self.database.create_database(delete_if_exists=True)
@@ -417,6 +697,9 @@ class DalkStack(Stack):
     def django_manage(self, command):
         self.django.manage(command)
 
+    def rollback(self):
+        self.django.rollback()
+
 
 #    def update_local_media(self):
 #        zip_file = path(local_upload_dump_dir).joinpath(self.latest_uploaded_archive())
@@ -427,12 +710,22 @@ after_deployment = Event()
 
 def deployment(func):
     def inner(*args, **kwargs):
+        # every deployment starts with a fresh view of the hosts
+        cuisine.facts_flush()
         res = func(*args, **kwargs)
         after_deployment(func.__name__)
         return res
     return inner
 
 
+@runs_once
+def precompile():
+    """
+    compiles the assets locally (local_precompile) once for all the hosts, before anything is uploaded
+    """
+    current_stack.precompile()
+
+
 before_install = Event()
 after_install = Event()
 
@@ -447,6 +740,7 @@ def install():
     current_stack.init_database()
 
     current_stack.init_dirs()
+    precompile()
     current_stack.upload()
     current_stack.migrate_data()
     current_stack.collect_static()
@@ -462,9 +756,10 @@ after_update_code = Event()
 def update_code():
     before_update_code()
 
+    precompile()
     current_stack.upload()
     #current_stack.setup_python_dependencies()
-    current_stack.start_restart_webserver()
+    current_stack.reload_webserver()
 
     after_update_code()
 
@@ -476,12 +771,13 @@ after_update = Event()
 def update():
     before_update()
 
+    precompile()
     backup_database()
     current_stack.upload()
     #current_stack.setup_python_dependencies()
     current_stack.migrate_data()
     current_stack.collect_static()
-    current_stack.start_restart_webserver()
+    current_stack.reload_webserver()
 
     after_update()
 
@@ -490,11 +786,53 @@ before_update_python_dependencies = Event()
 after_update_python_dependencies = Event()
 
 
+def upload_code_and_restart():
+    current_stack.upload()
+    current_stack.reload_webserver()
+
+
+def collect_static_and_restart():
+    current_stack.collect_static()
+    current_stack.reload_webserver()
+
+
+@runs_once
+@deployment
+def parallel_update_code(pool_size=4, fail_fast=True, max_failures=0):
+    """
+    update_code for all env.hosts, pool_size hosts at a time
+    """
+    executor = RollingExecutor(pool_size=pool_size, fail_fast=fail_fast, max_failures=max_failures)
+
+    before_update_code()
+    precompile()
+    executor.run(upload_code_and_restart)
+    after_update_code()
+
+
+@runs_once
+@deployment
+def parallel_update(pool_size=4, fail_fast=True, max_failures=0):
+    """
+    update for all env.hosts, pool_size hosts at a time. The database is backed up and migrated only on
+    the first host, after the code is uploaded everywhere.
+    """
+    executor = RollingExecutor(pool_size=pool_size, fail_fast=fail_fast, max_failures=max_failures)
+
+    before_update()
+    precompile()
+    executor.run_once(backup_database)
+    executor.run(current_stack.upload)
+    executor.run_once(current_stack.migrate_data)
+    executor.run(collect_static_and_restart)
+    after_update()
+
+
 @deployment
 def migrate():
     backup_database()
     current_stack.migrate_data()
-    current_stack.start_restart_webserver()
+    current_stack.reload_webserver()
 
 
 @deployment
@@ -587,9 +925,15 @@ def collectstatic(clear=False):
 
 
 def configure_webserver():
-    current_stack.apache.stop()
-    current_stack.configure_webserver()
+    if current_stack.configure_webserver():
+        # graceful reload re-reads the config and restarts the mod_wsgi daemons
+        current_stack.apache.reload()
 
 def django_manage(command):
     current_stack.django_manage(command)
 
+
+@deployment
+def rollback():
+    current_stack.rollback()
+
@@ -1,10 +1,16 @@
 import gzip
 import os
+import pipes
 import re
+import subprocess
+import sys
 import tarfile
+import threading
+import time
 import zipfile
 from fabric.context_managers import cd
 from fabric.operations import local, sudo, run
+from fabric.state import connections, env
 from path import path
 import shutil
 from bount import cuisine
@@ -37,6 +43,12 @@ def delete_lines_re(text, lines):
 
 def file_unzip(filename, extdir="."):
     cuisine.run("unzip %s -d %s" % (filename, extdir))
+    cuisine.facts_invalidate(name=extdir)
+
+
+def file_untar(filename, extdir="."):
+    cuisine.run("tar -xzf %s -C %s" % (filename, extdir))
+    cuisine.facts_invalidate(name=extdir)
 
 
 def local_file_delete(file):
@@ -47,20 +59,29 @@ def file_delete(file, only_if_exists=True):
     if only_if_exists and not cuisine.file_exists(file):
         return
     cuisine.run("rm %s" % file)
+    cuisine.facts_invalidate("file", file)
 
 
 def python_egg_ensure(egg_name):
     cuisine.run("pip install %s" % egg_name)
 
 
-def sudo_pipeline(command, user=None):
-    """Enables executing complex commands via sudo"""
+def pipefail(command):
+    """
+    Wraps the shell pipeline so it fails if any of its commands fails, not only the last one.
+    """
+    return "bash -o pipefail -c %s" % pipes.quote(command)
+
+
+def sudo_pipeline(command, user=None, pipefail=False):
+    """Enables executing complex commands via sudo, with pipefail the pipeline fails if any command fails"""
     run_function = lambda(command): local(command) if cuisine.mode == cuisine.MODE_LOCAL else run(command)
+    shell = "bash -o pipefail" if pipefail else "sh"
 
     if user:
-        run_function("echo \"%s\" | sudo -u %s sh" % (command, user))
+        run_function("echo \"%s\" | sudo -u %s %s" % (command, user, shell))
     else:
-        run_function("echo \"%s\" | sudo sh" % command)
+        run_function("echo \"%s\" | sudo %s" % (command, shell))
 
 
 def sym_link(file_from, file_to):
@@ -70,6 +91,7 @@ def sym_link(file_from, file_to):
 def clear_dir(dir):
     cuisine.run("rm -rf %s/*" % dir)
     cuisine.run("rm -rf %s/.??*" % dir)
+    cuisine.facts_invalidate(name=dir)
 
 
 def copy_directory_content(from_dir, to_dir):
@@ -201,6 +223,7 @@ def remote_home():
 
 def dir_delete(dir_name):
     cuisine.run('rm -rf %s' % dir_name)
+    cuisine.facts_invalidate(name=dir_name)
 
 
 def local_ls_re(root_dir, regex):
@@ -262,8 +285,143 @@ def unix_eol(string):
     return string.replace('\r','')
 
 
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def remote_exec_stream(command, stdin=None, stdout=None):
+    """
+    Executes the command on the current host over its own SSH channel, feeding the file-like stdin into
+    the command and writing the command's output into the file-like stdout, chunk by chunk. Nothing is
+    buffered on disk. Fabric's cd() and prefix() are not applied, use absolute paths.
+    """
+    channel = connections[env.host_string].get_transport().open_session()
+    channel.exec_command(command)
+
+    def feed():
+        try:
+            if stdin:
+                for chunk in iter(lambda: stdin.read(STREAM_CHUNK_SIZE), ''):
+                    channel.sendall(chunk)
+        finally:
+            channel.shutdown_write()
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    errors = []
+    while True:
+        if channel.recv_ready():
+            data = channel.recv(STREAM_CHUNK_SIZE)
+            if stdout:
+                stdout.write(data)
+        elif channel.recv_stderr_ready():
+            errors.append(channel.recv_stderr(STREAM_CHUNK_SIZE))
+        elif channel.exit_status_ready():
+            break
+        else:
+            time.sleep(0.01)
+
+    feeder.join()
+    status = channel.recv_exit_status()
+    channel.close()
+    if status != 0:
+        raise RuntimeError("Remote command failed with status %d: %s\n%s" % (status, command, "".join(errors)))
 
 
+def local_pipe_to_remote(local_command, local_dir, remote_command):
+    """
+    Pipes the output of the local command (executed in local_dir) into the remote command.
+    """
+    print("[%s] stream: %s | %s" % (env.host_string, local_command, remote_command))
+    process = subprocess.Popen(local_command, shell=True, cwd=local_dir, stdout=subprocess.PIPE)
+    try:
+        remote_exec_stream(remote_command, stdin=process.stdout)
+    finally:
+        process.stdout.close()
+        process.wait()
 
+    if process.returncode != 0:
+        raise RuntimeError("Local command failed with status %d: %s" % (process.returncode, local_command))
 
 
+def write_atomic(file_path, data):
+    """
+    Writes the local file through a temp file and rename, so readers never see a partial file.
+    """
+    temp_path = "%s.%d.tmp" % (file_path, os.getpid())
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+    os.rename(temp_path, file_path)
+
+
+def size_str(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+class StreamProgress(object):
+    """
+    Wraps a file-like object and prints the transferred size and throughput while the stream is read
+    or written. Call finish() to print the totals.
+    """
+
+    def __init__(self, file, label, interval=1.0):
+        self.file = file
+        self.label = label
+        self.interval = interval
+        self.size = 0
+        self.started = self.printed = time.time()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.update(len(data))
+        return data
+
+    def write(self, data):
+        self.file.write(data)
+        self.update(len(data))
+
+    def update(self, size):
+        self.size += size
+        now = time.time()
+        if now - self.printed >= self.interval:
+            self.printed = now
+            self.report(now)
+
+    def report(self, now, end=""):
+        elapsed = max(now - self.started, 0.001)
+        sys.stdout.write("\r%s: %s, %s/s   %s" % (self.label, size_str(self.size), size_str(self.size / elapsed), end))
+        sys.stdout.flush()
+
+    def finish(self):
+        self.report(time.time(), "\n")
+
+
+def run_concurrently(functions):
+    """
+    Calls the functions in parallel threads and waits for all of them. Re-raises the first error.
+    """
+    # connect in the main thread, so the threads share one SSH connection
+    if env.host_string:
+        connections[env.host_string]
+
+    errors = []
+
+    def call(function):
+        try:
+            function()
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call, args=(function,)) for function in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
@@ -16,6 +16,6 @@ setup(name='Bount',
         'axel',
     ],
     package_data = {
-        '':['git-archive-all.sh']
+        '':['git-archive-all.sh', 'compiler_daemon.js']
     }
 )
\ No newline at end of file